@@ -0,0 +1,336 @@
+'''
+Functions responsible for benchmarking each stage of the pipeline on synthetic data
+Synthetic racesIndex, race results, points lists and athletes are generated at a multiple of the real history,
+	then scraping, ingest, collecting, feature expansion, training and prediction are timed on them
+Results are stored as json and can be compared against a stored baseline
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+
+import numpy as np
+
+import scrape
+import storage
+import fisData
+import dataPreparation
+import trainingData
+import ratings
+import machineLearning
+import evaluation
+import models
+import prediction
+
+# Size of the real history, which scale multiplies
+nSeasons = 22
+racesPerSeason = 35 # Per gender
+athletesPerGender = 600
+listsPerSeason = 8
+defaultRepeat = 3
+regressionThreshold = 1.25 # A stage is flagged when it takes this many times as long as in the baseline
+
+# ______________________________________________________________________
+# Synthetic data
+def getSyntheticTime(seconds):
+	# Returns a race time in the h:mm:ss.s format used on fis-ski.com
+
+	return str(int(seconds // 3600)) + ':' + '%02d' % int(seconds % 3600 // 60) + ':' + '%04.1f' % (seconds % 60)
+
+def getResultsHtml(nAthletes, generator):
+	# Returns the html of a results page with a table of nAthletes results, like the ones scraped from fis-ski.com
+
+	rows = ['<tr><th>Rank</th><th>Bib</th><th>FIS Code</th><th>Athlete</th><th>Year</th><th>Nation</th>' + \
+		'<th>Time</th><th>Diff. Time</th><th>FIS Points</th></tr>']
+	seconds = 1800 + generator.random() * 600
+	for rank in range(1, nAthletes + 1):
+		rows.append('<tr class="row"><td>' + str(rank) + '</td><td>' + str(generator.randint(1, 120)) + '</td><td>' + \
+			str(3400000 + generator.randint(0, 99999)) + '</td><td><a href="#">ATHLETE Name</a></td><td>1990</td>' + \
+			'<td><span class="country">NOR</span></td><td>' + getSyntheticTime(seconds) + '</td><td>+' + \
+			'%.1f' % (rank * 3.2) + '</td><td>' + '%.2f' % (rank * 1.7) + '</td></tr>')
+		seconds += generator.random() * 10
+	return '<html><body><!-- <table>hidden</table> --><table class="results">' + '\n'.join(rows) + '</table></body></html>'
+
+def generateData(directory, scale=1, seed=0):
+	# Writes a synthetic history to directory/data in the same formats as dataPreparation:
+	#	athletes, rankingsIndex and points lists, racesIndex and race results
+	# scale: multiple of the real history's races and athletes per season
+	# Returns the sizes: {'nRaces', 'nAthletes', 'nResults', 'nLists'}
+
+	generator = np.random.RandomState(seed)
+	for subdirectory in ['data', 'data/races', 'data/points']:
+		if not os.path.exists(os.path.join(directory, subdirectory)):
+			os.makedirs(os.path.join(directory, subdirectory))
+
+	# Athletes have a skill and a career of a few seasons
+	nAthletes = int(athletesPerGender * scale)
+	athletes = {}
+	skills = []
+	careers = []
+	for gender in range(0, len(fisData.genders)):
+		fisCodes = [str(3400000 + gender * 10000000 + i) for i in range(0, nAthletes)]
+		for fisCode in fisCodes:
+			athletes[fisCode] = ['ATHLETE ' + fisCode, 'NOR', gender, 1980 + int(generator.randint(0, 25))]
+		firstSeasons = generator.randint(-5, nSeasons, nAthletes)
+		careers.append([fisCodes, firstSeasons, firstSeasons + generator.randint(3, 15, nAthletes)])
+		skills.append(generator.normal(0, 1, nAthletes))
+	storage.storeAsJson(athletes, os.path.join(directory, dataPreparation.athletes_fName))
+
+	# Points lists cover each season back to back
+	firstDate = fisData.getDateAsInt('1.7.' + str(2017 - nSeasons))
+	listLength = 365 // listsPerSeason
+	rankingsIndex = [[0, None, None, firstDate - 1]]
+	for listId in range(1, nSeasons * listsPerSeason + 1):
+		ranking = {}
+		for gender in range(0, len(fisData.genders)):
+			fisCodes = careers[gender][0]
+			points = np.maximum(0, 60 - 25 * skills[gender][:,None] + generator.normal(0, 8, (nAthletes, 2)))
+			for i in range(0, nAthletes):
+				ranking[fisCodes[i]] = [float(points[i,0]), float(points[i,1])]
+		fName = './data/points/points' + str(listId) + '.json'
+		storage.storeAsJson(ranking, os.path.join(directory, fName))
+		beginDate = firstDate + (listId - 1) * listLength
+		rankingsIndex.insert(0, [listId, fName, beginDate, beginDate + listLength - 1])
+	storage.storeAsJson(rankingsIndex, os.path.join(directory, dataPreparation.rankingsIndex_fName))
+
+	# Races are spread through the winter of each season, newest first in racesIndex
+	raceTypes = [fisData.raceTypes.index(raceType) for raceType in ['Individual', 'Mass', 'Sprint Final']]
+	racesIndex = []
+	nResults = 0
+	raceId = 0
+	nRaces = int(racesPerSeason * scale)
+	for season in range(0, nSeasons):
+		seasonStart = firstDate + season * 365 + 130 # Mid November
+		for gender in range(0, len(fisData.genders)):
+			fisCodes, firstSeasons, lastSeasons = careers[gender]
+			active = np.nonzero((firstSeasons <= season) & (lastSeasons >= season))[0]
+			for date in np.sort(seasonStart + generator.randint(0, 120, nRaces)):
+				raceType = raceTypes[generator.randint(0, len(raceTypes))]
+				isSprintFinal = raceType == fisData.raceTypes.index('Sprint Final')
+				field = generator.choice(active, min(len(active), 30 if isSprintFinal else generator.randint(50, 90)), \
+					replace=False)
+				performance = skills[gender][field] + generator.normal(0, .6, len(field))
+				order = np.argsort(-performance)
+				results = {}
+				for rank in range(0, len(order)):
+					if isSprintFinal:
+						results[fisCodes[field[order[rank]]]] = rank + 1
+					else:
+						percentBack = .015 * (performance[order[0]] - performance[order[rank]]) + .002 * generator.random()
+						results[fisCodes[field[order[rank]]]] = [rank + 1, float(percentBack)]
+				fName = './data/races/race' + str(raceId) + '.json'
+				storage.storeAsJson(results, os.path.join(directory, fName))
+				racesIndex.append([raceId, fName, fisData.raceCategories.index('World Cup'), int(date), 'Location, NOR', \
+					raceType, int(generator.randint(0, 2)), gender, None if isSprintFinal else 15, \
+					[dataPreparation.defaultFisPoints] * 4])
+				nResults += len(results)
+				raceId += 1
+	racesIndex.sort(key=lambda raceInfo: -raceInfo[3])
+	storage.storeAsJson(racesIndex, os.path.join(directory, dataPreparation.racesIndex_fName))
+	return {'nRaces': len(racesIndex), 'nAthletes': len(athletes), 'nResults': nResults, 'nLists': len(rankingsIndex) - 1}
+
+# ______________________________________________________________________
+# Scenarios
+# Each scenario runs one stage, reading and adding to a shared context dictionary
+#	Scenarios run in order, so later stages can use the output of earlier ones
+def scrapeTables(context):
+	# Parses synthetic results pages
+
+	for html in context['pages']:
+		scrape.getTables(html)
+
+def recomputeFisPoints(context):
+	# Recomputes race strength for every race
+
+	dataPreparation.recomputeAverageFisPoints()
+
+def collectLookBack(context):
+	# Collects a training set with look-back features, reading every race from disk
+
+	trainingData.clearResultsCache()
+	context['data'] = machineLearning.matrix(trainingData.collectDistanceRankCategory())
+
+def updateRatings(context):
+	# Rates every athlete from scratch
+
+	context['ratings'] = ratings.updateRatings(ratings.newRatings(), context['racesIndex'])[0]
+
+def collectRatings(context):
+	# Collects a training set with rating features
+
+	storage.storeAsJson(context['ratings'], ratings.ratings_fName)
+	trainingData.clearResultsCache()
+	machineLearning.matrix(trainingData.collectDistanceRatingCategory())
+
+def expandFeatures(context):
+	# Expands the collected features to order 3
+
+	machineLearning.expandFeatures(context['data'][:,:-1], 3)
+
+def fitScaler(context):
+	# Computes normalization statistics for the collected features
+
+	context['scaler'] = machineLearning.fitScaler(context['data'][:,:-1])
+
+def getDesignMatrix(context):
+	# Returns the normalized collected features with the constant column
+
+	X = machineLearning.addBiasCol(context['data'][:,:-1])
+	machineLearning.applyScaler(context['scaler'], X[:,1:], X[:,1:])
+	return X
+
+def fitLinear(context):
+	# Fits a linear regression with 200 iterations of gradient descent
+
+	config = {'model': 'linear', 'alpha': .01, 'reg': 0, 'nIterations': 200}
+	context['linear'] = evaluation.fitModel(config, getDesignMatrix(context), context['data'][:,-1:])[0]
+
+def fitLogistic(context):
+	# Fits a logistic regression for top 3 with 200 iterations of gradient descent
+
+	config = {'model': 'logistic', 'alpha': .01, 'reg': 0, 'nIterations': 200}
+	evaluation.fitModel(config, getDesignMatrix(context), (context['data'][:,-1:] == 0).astype(np.float64))
+
+def fitNeuralNetwork(context):
+	# Trains a neural network for 2 epochs of mini batches
+
+	K = int(np.max(context['data'][:,-1]) + 1)
+	config = {'model': 'neuralNetwork', 'alpha': .001, 'reg': 0, 'hidden': [10], 'nLabels': K, 'batchSize': 128, \
+		'nEpochs': 2}
+	Theta = evaluation.fitModel(config, getDesignMatrix(context), context['data'][:,-1:])[0]
+	context['model'] = models.newModel('neuralNetwork', Theta, 1, context['scaler'])
+
+def readResultsMatrix(context):
+	# Builds the results matrix which predictions look back on
+
+	context['matrix'] = trainingData.readResultsMatrix()
+
+def predictStartList(context):
+	# Predicts an upcoming race for a start list of 100 athletes
+
+	racesIndex = context['racesIndex']
+	raceInfo = prediction.newRaceInfo(0, fisData.raceTypes.index('Individual'), 0, racesIndex[0][3] + 1)
+	fisCodes = [fisCode for fisCode in context['athletes'] if context['athletes'][fisCode][2] == 0][:100]
+	prediction.predictRace(context['model'], raceInfo, fisCodes, trainingData.getFuncGetDistanceRankCategoryFeatures(), \
+		context['matrix'])
+
+# [name, function, number of items the stage processes (from the sizes)]
+scenarios = [
+	['scrape.getTables', scrapeTables, 'nPages'],
+	['dataPreparation.recomputeAverageFisPoints', recomputeFisPoints, 'nRaces'],
+	['trainingData.collectDistanceRankCategory', collectLookBack, 'nResults'],
+	['ratings.updateRatings', updateRatings, 'nResults'],
+	['trainingData.collectDistanceRatingCategory', collectRatings, 'nResults'],
+	['machineLearning.expandFeatures', expandFeatures, 'nRows'],
+	['machineLearning.fitScaler', fitScaler, 'nRows'],
+	['evaluation.fitModel linear', fitLinear, 'nRows'],
+	['evaluation.fitModel logistic', fitLogistic, 'nRows'],
+	['evaluation.fitModel neuralNetwork', fitNeuralNetwork, 'nRows'],
+	['trainingData.readResultsMatrix', readResultsMatrix, 'nResults'],
+	['prediction.predictRace', predictStartList, 'nStartList'],
+]
+
+def timeScenario(f_scenario, context, repeat):
+	# Returns [best, mean] seconds over repeat runs of a scenario
+
+	times = []
+	for i in range(0, repeat):
+		started = time.perf_counter()
+		f_scenario(context)
+		times.append(time.perf_counter() - started)
+	return [min(times), sum(times) / len(times)]
+
+def run(directory, scale=1, seed=0, repeat=defaultRepeat, names=None, generate=True):
+	# Generates data at scale in directory (unless generate is False) and times every scenario on it
+	# names: only run scenarios whose name contains one of these strings (scenarios they depend on still run untimed)
+	# Returns the results: {'scale', 'seed', 'sizes', 'environment', 'scenarios': {name: {'best', 'mean', 'perItem'}}}
+
+	directory = os.path.abspath(directory)
+	sizes = generateData(directory, scale, seed) if generate else {}
+	workingDirectory = os.getcwd()
+	os.chdir(directory) # Data is referenced by the same relative paths as the real history
+	try:
+		np.random.seed(seed)
+		pageGenerator = random.Random(seed)
+		context = {'racesIndex': storage.readFromJson(dataPreparation.racesIndex_fName), \
+			'athletes': storage.readFromJson(dataPreparation.athletes_fName), \
+			'pages': [getResultsHtml(80, pageGenerator) for i in range(0, 20)]}
+		if not generate:
+			sizes = {'nRaces': len(context['racesIndex']), 'nAthletes': len(context['athletes']), \
+				'nResults': sum(len(storage.readFromJson(raceInfo[1])) for raceInfo in context['racesIndex'])}
+		sizes['nPages'] = len(context['pages'])
+		sizes['nStartList'] = 100
+		results = {}
+		for name, f_scenario, sizeKey in scenarios:
+			isSelected = names is None or any(selected in name for selected in names)
+			best, mean = timeScenario(f_scenario, context, repeat if isSelected else 1)
+			if 'data' in context:
+				sizes['nRows'] = context['data'].shape[0]
+			if isSelected:
+				results[name] = {'best': best, 'mean': mean, 'perItem': best / max(sizes.get(sizeKey, 1), 1)}
+				print('%-45s %10.4f s  (%.2e s per item)' % (name, best, results[name]['perItem']))
+	finally:
+		os.chdir(workingDirectory)
+	environment = {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(), \
+		'processor': platform.processor()}
+	return {'scale': scale, 'seed': seed, 'repeat': repeat, 'sizes': sizes, 'environment': environment, \
+		'scenarios': results}
+
+def compareResults(results, baseline, threshold=regressionThreshold):
+	# Compares the best time of each scenario against a baseline from run
+	# Returns [[name, baseline seconds, current seconds, ratio, flag], ...] where flag is 'slower', 'faster' or ''
+
+	comparison = []
+	for name in results['scenarios']:
+		if not name in baseline['scenarios']:
+			continue
+		before = baseline['scenarios'][name]['best']
+		after = results['scenarios'][name]['best']
+		ratio = after / before if before > 0 else float('inf')
+		flag = ''
+		if ratio > threshold:
+			flag = 'slower'
+		elif ratio < 1 / threshold:
+			flag = 'faster'
+		comparison.append([name, before, after, ratio, flag])
+	return comparison
+
+def printComparison(comparison):
+	# Prints the output of compareResults as a table
+
+	print('%-45s %10s %10s %8s' % ('Scenario', 'Baseline', 'Current', 'Ratio'))
+	for name, before, after, ratio, flag in comparison:
+		print('%-45s %10.4f %10.4f %8.2f %s' % (name, before, after, ratio, flag))
+
+def main():
+	# Test Module Functionality
+	# python benchmark.py --scale 10 --output bench.json --baseline baseline.json
+
+	parser = argparse.ArgumentParser(description='Benchmark the pipeline on synthetic data')
+	parser.add_argument('--scale', type=float, default=1, help='multiple of the real history (1, 10, 100)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--repeat', type=int, default=defaultRepeat)
+	parser.add_argument('--directory', default='./benchmarkData', help='where the synthetic data is written')
+	parser.add_argument('--reuse', action='store_true', help='reuse the data already in directory')
+	parser.add_argument('--only', nargs='*', help='only time scenarios whose names contain these strings')
+	parser.add_argument('--output', help='store the results in this json file')
+	parser.add_argument('--baseline', help='compare against results stored by --output')
+	parser.add_argument('--threshold', type=float, default=regressionThreshold)
+	args = parser.parse_args()
+
+	results = run(args.directory, args.scale, args.seed, args.repeat, args.only, not args.reuse)
+	if args.output:
+		with open(args.output, 'w') as outFile:
+			json.dump(results, outFile, indent=2, sort_keys=True)
+	if args.baseline:
+		comparison = compareResults(results, storage.readFromJson(args.baseline), args.threshold)
+		printComparison(comparison)
+		if any(row[4] == 'slower' for row in comparison):
+			sys.exit(1)
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
@@ -2,9 +2,15 @@
 Functions responsible for processing the data from fis-ski.com formatting it consistantly 
 '''
 
+import os
+import re
+
+import numpy as np
+
 import scrape
 import fisData
 import storage
+import instrumentation
 
 # Constants
 athletes_fName = './data/athletes.json'
@@ -15,7 +21,15 @@ rankingIdsWorkQueue_fName = './data/rankingIdsWorkQueue.json'
 raceIdsWorkQueue_fName = './data/raceIdsWorkQueue.json'
 racesIndex_fName = './data/racesIndex.json'
 
+# Race results and points lists are records in segment stores (see storage.appendRecords)
+#	a plain directory ('./data/races/') works too, entries in the indexes keep whatever address they were stored at
+races_directory = './data/segments/races#'
+points_directory = './data/segments/points#'
+
+rankingListsUrl = 'https://data.fis-ski.com/cross-country/fis-points-lists.html'
+
 defaultFisPoints = 200
+fisNs = [1, 5, 15, 30] # Race strength is the average of the best N fis points in the race for each N
 
 def initAthletes():
 	# !!! Should only be run 1 time ever !!!
@@ -63,12 +77,32 @@ def getRanking(listId):
 	storage.storeAsJson(athletes, athletes_fName)
 	return ranking
 
+def getRankingLists(html=None):
+	# Expects the html of the points lists index page (None -> fetch it, revalidating the copy fetched before)
+	# Returns the id and date range of all of the current FIS points lists, in page order (most recent first)
+	# Output: [[listId, listBeginDate, listEndDate], ...], listId is None if the row doesn't link to its list
+
+	if html is None:
+		html = scrape.getHtml(rankingListsUrl, True)
+	indexTable = scrape.getTables(html)[0]
+	rowsHtml = scrape.getElementContent('tr', scrape.getElementContent('table', html)[0])
+	rows = [[listInfo, rowHtml] for listInfo, rowHtml in zip(indexTable[1:], rowsHtml[1:]) \
+		if len(listInfo) == len(indexTable[0]) and listInfo[1] != '']
+	beginDates = fisData.getDatesAsInt([listInfo[2] for listInfo, rowHtml in rows])
+	endDates = fisData.getDatesAsInt([listInfo[3] for listInfo, rowHtml in rows])
+	if np.ma.is_masked(beginDates) or np.ma.is_masked(endDates):
+		raise ValueError('Invalid date on the points lists index page')
+	lists = []
+	for i in range(0, len(rows)):
+		listId = re.search(r'listid=(\d+)', rows[i][1])
+		lists.append([int(listId.group(1)) if listId else None, int(beginDates[i]), int(endDates[i])])
+	return lists
+
 def getRankingDateRanges():
 	# Returns a list of dates ranges for all of the current FIS points lists
 	# Output: [[listBeginDate, listEndDate], ...]
 
-	indexTable = scrape.getTables(scrape.getHtml('https://data.fis-ski.com/cross-country/fis-points-lists.html'))[0]
-	return [[fisData.getDateAsInt(listInfo[2]), fisData.getDateAsInt(listInfo[3])] for listInfo in indexTable[1:] if len(listInfo) == len(indexTable[0]) and listInfo[1] != '']
+	return [listInfo[1:] for listInfo in getRankingLists()]
 
 def initRankingsIndex(dateAsStr):
 	# !!! Should only be run 1 time ever !!!
@@ -103,23 +137,44 @@ def updateNewRankings():
 
 	rankingsIndex = storage.readFromJson(rankingsIndex_fName)
 	rankingIdsWorkQueue = storage.readFromJson(rankingIdsWorkQueue_fName)
-	newDateRanges = [row for row in getRankingDateRanges() if row[0] > rankingsIndex[0][3]]
-	if len(rankingIdsWorkQueue) != len(newDateRanges):
-		print(str(len(rankingIdsWorkQueue)) + ' new list ids, but ' + str(len(newDateRanges)) + ' new date ranges -> Update aborted')
-		return
+	newLists = [row for row in getRankingLists() if row[1] > rankingsIndex[0][3]]
+	dateRanges = dict((row[0], row[1:]) for row in newLists)
+	if all(listId in dateRanges for listId in rankingIdsWorkQueue):
+		# Every queued list links from the index page, so each gets its own date range
+		newDateRanges = [dateRanges[listId] for listId in reversed(rankingIdsWorkQueue)]
+	else:
+		newDateRanges = [row[1:] for row in newLists]
+		if len(rankingIdsWorkQueue) != len(newDateRanges):
+			print(str(len(rankingIdsWorkQueue)) + ' new list ids, but ' + str(len(newDateRanges)) + ' new date ranges -> Update aborted')
+			return
 	for i in range(0, len(rankingIdsWorkQueue)):
 		listId = rankingIdsWorkQueue[i]
 		ranking = getRanking(listId)
 		if not ranking:
 			print('List ' + str(listId) + ' is empty.')
-		fName = './data/points/points'+str(listId)+'.json'
+		fName = points_directory + 'points' + str(listId) + '.json'
 		storage.storeAsJson(ranking, fName)
 		rankingsIndex.insert(0, [listId, fName, newDateRanges[-(i+1)][0], newDateRanges[-(i+1)][1]])
 	storage.storeAsJson(rankingsIndex, rankingsIndex_fName)
 	resetRankingIdsWorkQueue()
 
-def storeRace(raceId):
+def getAverageFisPoints(fisPoints):
+	# Expects a matrix of fis points with a row for each race, padded with np.inf where a race has fewer athletes
+	# Returns a matrix with a row of [Fis1, Fis5, Fis15, Fis30] for each race, where FisN = (Sum of best N fis points in race)/N
+	#	A race with fewer than N athletes sums the points it has
+
+	nBest = max(fisNs)
+	if fisPoints.shape[1] > nBest:
+		fisPoints = np.partition(fisPoints, nBest - 1, axis=1)[:,:nBest]
+	best = np.zeros((fisPoints.shape[0], nBest))
+	best[:,:fisPoints.shape[1]] = np.sort(fisPoints, axis=1)
+	best[np.isinf(best)] = 0
+	sums = np.cumsum(best, axis=1)
+	return sums[:,[n - 1 for n in fisNs]] / np.array(fisNs, dtype=np.float64)
+
+def storeRace(raceId, directory=races_directory):
 	# Expects the race id for a sprint final or mass or interval start world cup ski race
+	# and the directory its results are stored in
 	# Formats this race into specif format: 
 	#   distance: {'Fis Id':[Rank, Percent Back], ...}
 	#   sprint final: {'Fis Id':Rank, ...}
@@ -137,9 +192,11 @@ def storeRace(raceId):
 	isSprintFinal = info[3] == fisData.raceTypes.index('Sprint Final')
 	if not isWorldLevel:
 		print(str(raceId) + ': not a World Cup or Championship (Aborted)')
+		instrumentation.increment('dataPreparation.racesAborted', 1, {'reason': 'notWorldLevel'})
 		return None
 	if not (isIndividual or isMass or isSprintFinal):
 		print(str(raceId) + ': not a sprint final or an individual or mass start race (Aborted)')
+		instrumentation.increment('dataPreparation.racesAborted', 1, {'reason': 'raceType'})
 		return None
 
 	# Filter the results data into a standard template
@@ -149,12 +206,18 @@ def storeRace(raceId):
 		idIndex = headers.index('FIS Code')
 	else:
 		print(str(raceId)+': no FIS Code column (Aborted)')
+		instrumentation.increment('dataPreparation.racesAborted', 1, {'reason': 'noFisCode'})
 		return None
 	rankIndex = headers.index('Rank')
 	try:
 		timeIndex = headers.index('Time')
 		winningTime = fisData.getTimeAsFloat(results[0][timeIndex])
-		results = [[row[idIndex], int(row[rankIndex]), (fisData.getTimeAsFloat(row[timeIndex]) - winningTime) / winningTime] for row in results if row[rankIndex] != '']
+		results = [row for row in results if row[rankIndex] != '']
+		times = fisData.getTimesAsFloat([row[timeIndex] for row in results])
+		if np.ma.is_masked(times):
+			raise ValueError('Ranked athlete without a time')
+		percentBack = ((times.data - winningTime) / winningTime).tolist()
+		results = [[results[i][idIndex], int(results[i][rankIndex]), percentBack[i]] for i in range(0, len(results))]
 	except ValueError:
 		results = [[row[idIndex], int(row[rankIndex])] for row in results if row[rankIndex] != '']
 	
@@ -172,11 +235,12 @@ def storeRace(raceId):
 				return ranking[id][int(isSprintFinal)]
 			else:
 				return defaultFisPoints
-		fisPoints = sorted([getPoints(row[0]) for row in results])
-		averageFisPoints = [sum(fisPoints[0:i])/i for i in [1, 5, 15, 30]]
+		fisPoints = np.array([[getPoints(row[0]) for row in results]], dtype=np.float64)
+		averageFisPoints = getAverageFisPoints(fisPoints)[0].tolist()
 	else:
 		averageFisPoints = [defaultFisPoints] * 4
-		print(str(raceid)+': points List not found')
+		print(str(raceId)+': points List not found')
+		instrumentation.increment('dataPreparation.racesWithoutPointsList')
 	info.append(averageFisPoints)
 
 	# Create results dictionary
@@ -194,8 +258,9 @@ def storeRace(raceId):
 		info[6] = None
 
 	# Store results and return info
-	fName = './data/races/race' + str(raceId) + '.json'
+	fName = directory + 'race' + str(raceId) + '.json'
 	storage.storeAsJson(resultsDict, fName)
+	instrumentation.increment('dataPreparation.racesStored')
 	info.insert(0, raceId)
 	info.insert(1, fName)
 	return info
@@ -222,15 +287,26 @@ def initRacesIndex():
 
 def updateNewRaces():
 	# Stores race results for all ids in raceIdsWorkQueue
+	# Races which fail (for example results which aren't published yet) stay in raceIdsWorkQueue to be tried again
 	# Adds info for each race to the beginning of racesIndex
 	# racesIndex is updated to: [[Race id, File name, Race category, Date (as int), Location, Race Type, Technique, Gender, Distance, [Fis1, Fis5, Fis15, Fis30]], ...]
+	# Returns the ids of the races which were stored
 
 	raceIdsWorkQueue = storage.readFromJson(raceIdsWorkQueue_fName)
 	racesIndex = storage.readFromJson(racesIndex_fName)
+	storedIds = []
+	failedIds = []
 	for race in raceIdsWorkQueue:
-		info = storeRace(race)
+		try:
+			info = storeRace(race)
+		except Exception as e: # Results which aren't published yet or a page which couldn't be fetched
+			print(str(race) + ': ' + repr(e) + ' (Kept in work queue)')
+			instrumentation.increment('dataPreparation.racesAborted', 1, {'reason': 'error'})
+			failedIds.append(race)
+			continue
 		# Figure out where to insert info in racesIndex to maintain order of most recent first
 		if info:
+			storedIds.append(info[0])
 			location = 0 # Initialize to 0 for empty racesIndex case
 			isDuplicate = False
 			for raceIndex in racesIndex:
@@ -245,7 +321,101 @@ def updateNewRaces():
 			else:
 				racesIndex.insert(location, info)
 	storage.storeAsJson(racesIndex, racesIndex_fName)
-	resetRaceIdsWorkQueue()
+	storage.storeAsJson(failedIds, raceIdsWorkQueue_fName)
+	return storedIds
+
+def storeIndex(index, fName):
+	# Replaces an index in one rename, so it never refers to a mix of old and new entries
+
+	storage.storeAsJson(index, fName + '.tmp')
+	os.replace(fName + '.tmp', fName)
+
+def packStoredData():
+	# Moves the race results and points lists which are still separate files into the segment stores
+	#	races_directory and points_directory, then deletes the files
+	# Returns [number of races packed, number of points lists packed]
+
+	nPacked = []
+	for index_fName, directory in [[racesIndex_fName, races_directory], [rankingsIndex_fName, points_directory]]:
+		index = storage.readFromJson(index_fName)
+		fNames = [row[1] for row in index if row[1] and not storage.segmentSeparator in row[1]]
+		addresses = storage.packFiles(fNames, storage.getStoreName(directory)) if fNames else {}
+		for row in index:
+			row[1] = addresses.get(row[1], row[1])
+		storeIndex(index, index_fName)
+		for fName in fNames:
+			os.remove(fName)
+		nPacked.append(len(fNames))
+	return nPacked
+
+def getPointsTable(rankingsIndex):
+	# Joins the points lists in rankingsIndex into one array
+	# Returns [points, athleteColumns]
+	#	points[list, athlete, discipline]: fis points of each athlete on each list, defaultFisPoints if not on the list
+	#		The last athlete column is for athletes who aren't on any list
+	#	athleteColumns: {fisNumber: column}
+
+	rankings = [storage.readFromJson(rankingHandle[1]) for rankingHandle in rankingsIndex]
+	athleteColumns = {}
+	for ranking in rankings:
+		for fisNumber in ranking:
+			if not fisNumber in athleteColumns:
+				athleteColumns[fisNumber] = len(athleteColumns)
+	points = np.full((len(rankings), len(athleteColumns) + 1, 2), defaultFisPoints, dtype=np.float64)
+	for i in range(0, len(rankings)):
+		if rankings[i]:
+			columns = [athleteColumns[fisNumber] for fisNumber in rankings[i]]
+			points[i,columns,:] = np.array(list(rankings[i].values()), dtype=np.float64)
+	return [points, athleteColumns]
+
+def recomputeAverageFisPoints():
+	# Recomputes [Fis1, Fis5, Fis15, Fis30] for every race in racesIndex from the stored points lists, without refetching races
+	# Every result is joined with its race's points list and the best points of all races are found at once
+	# racesIndex is stored with the new values
+	# Returns the number of races whose values changed
+
+	racesIndex = storage.readFromJson(racesIndex_fName)
+	rankingsIndex = storage.readFromJson(rankingsIndex_fName)[:-1] # The last entry is a fake list
+	if not racesIndex:
+		return 0
+	points, athleteColumns = getPointsTable(rankingsIndex)
+	unlisted = points.shape[1] - 1
+
+	# Each race uses the first list whose date range contains the race
+	dates = np.array([raceInfo[3] for raceInfo in racesIndex])
+	beginDates = np.array([rankingHandle[2] for rankingHandle in rankingsIndex], dtype=np.float64)
+	endDates = np.array([rankingHandle[3] for rankingHandle in rankingsIndex], dtype=np.float64)
+	isInRange = (beginDates[None,:] <= dates[:,None]) & (endDates[None,:] >= dates[:,None])
+	hasList = np.any(isInRange, axis=1)
+	raceLists = np.argmax(isInRange, axis=1) if len(rankingsIndex) > 0 else np.zeros(len(racesIndex), dtype=int)
+	disciplines = np.array([int(raceInfo[5] == fisData.raceTypes.index('Sprint Final')) for raceInfo in racesIndex])
+
+	# Flatten every race's results into one array of athlete columns
+	fieldSizes = np.zeros(len(racesIndex), dtype=int)
+	athletes = []
+	for i in range(0, len(racesIndex)):
+		results = storage.readFromJson(racesIndex[i][1])
+		fieldSizes[i] = len(results)
+		athletes.extend(athleteColumns.get(fisNumber, unlisted) for fisNumber in results)
+	athletes = np.array(athletes, dtype=int)
+	races = np.repeat(np.arange(len(racesIndex)), fieldSizes)
+	places = np.arange(len(athletes)) - np.repeat(np.cumsum(fieldSizes) - fieldSizes, fieldSizes)
+
+	# One row of points per race, padded so the padding is never among the best
+	fisPoints = np.full((len(racesIndex), max(np.max(fieldSizes), 1)), np.inf)
+	if len(rankingsIndex) > 0:
+		fisPoints[races,places] = points[raceLists[races],athletes,disciplines[races]]
+	averageFisPoints = getAverageFisPoints(fisPoints)
+	averageFisPoints[~hasList,:] = defaultFisPoints
+
+	nChanged = 0
+	for i in range(0, len(racesIndex)):
+		newValues = averageFisPoints[i].tolist()
+		if not np.allclose(racesIndex[i][9], newValues):
+			nChanged += 1
+		racesIndex[i][9] = newValues
+	storage.storeAsJson(racesIndex, racesIndex_fName)
+	return nChanged
 
 def main():
 	# Test Module Functionality
@@ -314,4 +484,4 @@ Race Ids:
 
 2017: [27660, 27658, 27661, 27662, 27664, 27666, 27667, 27668, 27673, 27674, 27676, 27678, 27679, 27680, 27746, 27744, 27747, 27748, 27753, 27754, 27756, 27755, 27686, 27684, 27690, 27689, 27696, 27694, 27697, 27698, 27702, 27700, 27710, 27708, 27711, 27712, 27730, 27732, 27737, 27738, 27741, 27742, 27716, 27714, 27717, 27718, 29535, 29536, 29538, 29537]
 
-'''
\ No newline at end of file
+'''
\ No newline at end of file
@@ -0,0 +1,125 @@
+'''
+Functions responsible for training ensembles of neural networks
+Members are trained in parallel from different random seeds (or bootstrap samples)
+	and predict together by averaging their output probabilities
+'''
+
+import multiprocessing
+
+import numpy as np
+
+import storage
+import sharedData
+import machineLearning
+import neuralNetwork
+
+# Each worker process attaches to the normalized features and label matrix in shared memory
+# workerState: {'X': read only matrix, 'Y': read only matrix}
+workerState = {}
+
+# ______________________________________________________________________
+# Worker functions
+def initWorker(XDescriptor, YDescriptor):
+	# Attaches to the shared training matrices once per worker process
+
+	workerState['X'] = sharedData.attachSharedMatrix(XDescriptor)
+	workerState['Y'] = sharedData.attachSharedMatrix(YDescriptor)
+
+def trainMember(task):
+	# Expects [seed, bootstrap, layers, reg, alpha, batchSize, nEpochs]
+	# Trains one member of the ensemble, on a bootstrap sample of the rows if bootstrap is True
+	# Returns Theta
+
+	seed, bootstrap, layers, reg, alpha, batchSize, nEpochs = task
+	np.random.seed(seed)
+	X = workerState['X']
+	Y = workerState['Y']
+	if bootstrap:
+		rows = np.random.randint(0, X.shape[0], X.shape[0])
+		X = X[rows,:]
+		Y = Y[rows,:]
+	Theta = neuralNetwork.initializeTheta(layers)
+	return neuralNetwork.miniBatchDescent(X, Y, Theta, reg, alpha, batchSize, nEpochs)[0]
+
+# ______________________________________________________________________
+# Primary functions
+def stackMembers(Thetas):
+	# Combines the members' coefficient matrices into one wide network
+	#	The first layer is concatenated, so every member reads the same inputs
+	#	Later layers are block diagonal, so members never mix
+	# Returns a list of coefficient matrices for neuralNetwork.forwardPropagation
+	#	Its output has N*K columns: member k's output is columns k*K to (k+1)*K
+
+	stacked = [np.concatenate([Theta[0] for Theta in Thetas], axis=1)]
+	for l in range(1, len(Thetas[0])):
+		rows = sum(Theta[l].shape[0] - 1 for Theta in Thetas)
+		cols = sum(Theta[l].shape[1] for Theta in Thetas)
+		Theta_l = np.zeros((rows + 1, cols))
+		row = 1
+		col = 0
+		for Theta in Thetas:
+			nRows, nCols = Theta[l].shape
+			Theta_l[0,col:col+nCols] = Theta[l][0,:]
+			Theta_l[row:row+nRows-1,col:col+nCols] = Theta[l][1:,:]
+			row += nRows - 1
+			col += nCols
+		stacked.append(Theta_l)
+	return stacked
+
+def averageMembers(X, stacked, nMembers):
+	# Expects normalized features (X) and a stacked network from stackMembers
+	# Returns the average of the members' output probabilities
+
+	H = neuralNetwork.forwardPropagation(X, stacked)
+	return np.mean(H.reshape((X.shape[0], nMembers, -1)), axis=1)
+
+def trainEnsemble(data, layers, reg, nMembers=16, bootstrap=False, alpha=.001, batchSize=128, nEpochs=100, \
+	seed=0, nProcesses=None):
+	# data is numpy matrix of X and y values (data should not include the bias column)
+	# layers is a list of layer sizes (see neuralNetwork.trainNeuralNetwork)
+	# nMembers: number of networks, member i is trained from random seed (seed + i)
+	# bootstrap: if True each member trains on its own bootstrap sample of the rows
+	# nProcesses: size of the process pool (None -> one process per core)
+	# Returns an ensemble: {'Thetas': [Theta, ...], 'stacked': stackMembers(Thetas), 'scaler': scaler}
+
+	scaler = machineLearning.fitScaler(data[:,:-1])
+	X = machineLearning.applyScaler(scaler, data[:,:-1])
+	Y = neuralNetwork.getYMatrix(data[:,-1:], layers[-1])
+	tasks = [[seed + i, bootstrap, layers, reg, alpha, batchSize, nEpochs] for i in range(0, nMembers)]
+
+	with sharedData.sharedMatrix(X) as XDescriptor, sharedData.sharedMatrix(Y) as YDescriptor:
+		del X # Workers only need the shared copy
+		pool = multiprocessing.Pool(nProcesses, initWorker, (XDescriptor, YDescriptor))
+		try:
+			Thetas = pool.map(trainMember, tasks, 1)
+		finally:
+			pool.close()
+			pool.join()
+	return {'Thetas': Thetas, 'stacked': stackMembers(Thetas), 'scaler': scaler}
+
+def predictProb(ensemble, X):
+	# Expects an ensemble from trainEnsemble and a matrix of raw (unnormalized) features
+	# Returns the members' output probabilities averaged, from one forward pass through the stacked network
+
+	X = machineLearning.applyScaler(ensemble['scaler'], X)
+	return averageMembers(X, ensemble['stacked'], len(ensemble['Thetas']))
+
+def predict(ensemble, X):
+	# Classifies X with the averaged output of the ensemble
+
+	return neuralNetwork.getLabels(predictProb(ensemble, X))
+
+def main():
+	# Test Module Functionality
+
+	data = machineLearning.matrix(storage.read2DListFromCsv('./data/trainingData/distanceRankCategory.csv'))
+	print(data.shape)
+	n = data.shape[1] - 1
+	K = int(np.max(data[:,-1]) + 1)
+	ensemble = trainEnsemble(data, [n, 10, K], 0, 16)
+	metrics = neuralNetwork.getMetricsFromOutput(predictProb(ensemble, data[:,:-1]), data[:,-1:])
+	print('Training Accuracy: ' + str(metrics['accuracy']))
+	print('Training Accuracy within 1 category: ' + str(metrics['accuracyWithin1']))
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
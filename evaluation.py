@@ -0,0 +1,216 @@
+'''
+Functions responsible for evaluating models on data they were not trained on
+Supports shuffled k-fold cross validation and season by season walk forward backtesting
+'''
+
+import multiprocessing
+
+import numpy as np
+
+import fisData
+import sharedData
+import trainingData
+import machineLearning
+import linearRegression
+import logisticRegression
+import neuralNetwork
+
+# The metric used to rank models of each type, and whether lower values are better
+primaryMetrics = {'linear': 'meanAbsError', 'logistic': 'accuracy', 'neuralNetwork': 'accuracy'}
+lowerIsBetter = ['meanAbsError', 'rootMeanSquaredError', 'logLoss']
+
+# Each worker process attaches to the data matrix in shared memory and only receives row indices per fold
+# workerState: {'data': read only matrix}
+workerState = {}
+
+# ______________________________________________________________________
+# Fitting and scoring a single model
+def getDesignMatrices(train, test, order):
+	# Expects training and testing matrices of X and y values (without the bias column)
+	# Returns [Xtrain, ytrain, Xtest, ytest]
+	# Both X matrices are expanded to this polynomial order, include the constant column
+	#	and are normalized with the training mean and sd
+
+	Xtrain = machineLearning.expandFeatures(train[:,:-1], order)
+	Xtest = machineLearning.expandFeatures(test[:,:-1], order)
+	scaler = machineLearning.fitScaler(Xtrain[:,1:])
+	machineLearning.applyScaler(scaler, Xtrain[:,1:], Xtrain[:,1:])
+	machineLearning.applyScaler(scaler, Xtest[:,1:], Xtest[:,1:])
+	return [Xtrain, train[:,-1:], Xtest, test[:,-1:]]
+
+def fitModel(config, X, y, theta=None, f_callback=None):
+	# Expects a configuration dictionary:
+	#	'model' ('linear', 'logistic' or 'neuralNetwork'), 'alpha', 'reg'
+	#	optionally 'nIterations' (default 5000)
+	#	optionally 'recordEvery' (default: only the first and last iterations, or every epoch with mini batches)
+	#	and for neural networks 'hidden' (list of hidden layer sizes) and 'nLabels'
+	#		optionally 'batchSize' to train on mini batches for 'nEpochs' (default 100) with 'method' (default 'adam')
+	# Expects a design matrix (X) from getDesignMatrices and labels (y)
+	# theta: starting coefficients, None -> default initialization
+	# f_callback: training callback, see machineLearning.gradientDescent
+	# Returns [theta, finalCost]
+
+	nIterations = config.get('nIterations', 5000)
+	recordEvery = config.get('recordEvery', max(nIterations, 1))
+
+	if config['model'] == 'linear' or config['model'] == 'logistic':
+		if theta is None:
+			theta = np.zeros((X.shape[1], 1))
+		if config['model'] == 'linear':
+			f_cost = linearRegression.cost
+		else:
+			f_cost = logisticRegression.cost
+		theta, costHistory = machineLearning.gradientDescent(X, y, theta, f_cost, config['alpha'], config['reg'], nIterations, \
+			recordEvery, f_callback)
+		return [theta, costHistory[-1]]
+
+	elif config['model'] == 'neuralNetwork':
+		# The network adds its own bias col, so drop the constant col
+		X = X[:,1:]
+		K = config['nLabels']
+		if theta is None:
+			theta = neuralNetwork.initializeTheta([X.shape[1]] + list(config['hidden']) + [K])
+		else:
+			theta = [Theta_i.copy() for Theta_i in theta]
+		Y = neuralNetwork.getYMatrix(y, K)
+		if 'batchSize' in config:
+			theta, costHistory = neuralNetwork.miniBatchDescent(X, Y, theta, config['reg'], config['alpha'], \
+				config['batchSize'], config.get('nEpochs', 100), config.get('method', 'adam'), \
+				recordEvery=config.get('recordEvery', 1), f_callback=f_callback)[0:2]
+		else:
+			theta, costHistory = neuralNetwork.gradientDescent(X, Y, theta, config['alpha'], config['reg'], nIterations, \
+				recordEvery, f_callback)
+		return [theta, costHistory[-1]]
+
+	raise ValueError('Unknown model: ' + str(config['model']))
+
+def getMetrics(model, X, y, theta):
+	# Expects a design matrix (X) from getDesignMatrices, labels (y) and a fitted theta
+	# Returns a dictionary of metrics: {metricName: value, ...}
+
+	if model == 'linear':
+		error = linearRegression.predict(X, theta) - y
+		return {'meanAbsError': np.mean(np.absolute(error)), 'rootMeanSquaredError': np.sqrt(np.mean(error**2))}
+
+	elif model == 'logistic':
+		h = np.clip(logisticRegression.predictProb(X, theta), 1e-15, 1 - 1e-15)
+		return {'accuracy': logisticRegression.accuracy(X, y, theta), \
+			'logLoss': -np.mean(y * np.log(h) + (1-y) * np.log(1-h))}
+
+	elif model == 'neuralNetwork':
+		metrics = neuralNetwork.evaluate(X[:,1:], y, theta, [1])
+		del metrics['confusionMatrix']
+		return metrics
+
+	raise ValueError('Unknown model: ' + str(model))
+
+# ______________________________________________________________________
+# Building folds
+def getKFolds(m, k):
+	# Expects the number of training examples (m) and the number of folds (k)
+	# Returns a list of folds: [[name, trainRows, testRows], ...]
+	# Rows are shuffled before they are split
+
+	rows = np.random.permutation(m)
+	parts = np.array_split(rows, k)
+	return [['fold' + str(i), np.concatenate(parts[:i] + parts[i+1:]), parts[i]] for i in range(0, k)]
+
+def getWalkForwardFolds(dates, minTrainSeasons=1):
+	# Expects the race date (as int) behind each training example
+	# Returns a list of folds: [[season, trainRows, testRows], ...]
+	# Each fold trains on every season before season and tests on season
+
+	seasons = np.array([fisData.getSeason(dateAsInt) for dateAsInt in dates])
+	uniqueSeasons = np.unique(seasons)
+	folds = []
+	for season in uniqueSeasons[minTrainSeasons:]:
+		folds.append([int(season), np.where(seasons < season)[0], np.where(seasons == season)[0]])
+	return folds
+
+# ______________________________________________________________________
+# Worker functions
+def initWorker(descriptor):
+	# Attaches to the shared data matrix once per worker process
+
+	workerState['data'] = sharedData.attachSharedMatrix(descriptor)
+
+def evaluateFold(task):
+	# Expects [config, fold, seed]
+	# Trains on the fold's training rows and scores on its testing rows
+	#	The random state is seeded first, so the fold's result doesn't depend on which worker runs it
+	# Returns [name, trainMetrics, testMetrics]
+
+	config, (name, trainRows, testRows), seed = task
+	np.random.seed(seed)
+	data = workerState['data']
+	Xtrain, ytrain, Xtest, ytest = getDesignMatrices(data[trainRows,:], data[testRows,:], config.get('order', 1))
+	theta = fitModel(config, Xtrain, ytrain)[0]
+	return [name, getMetrics(config['model'], Xtrain, ytrain, theta), getMetrics(config['model'], Xtest, ytest, theta)]
+
+# ______________________________________________________________________
+# Primary functions
+def summarize(foldResults):
+	# Expects a list of fold results: [[name, trainMetrics, testMetrics], ...]
+	# Returns {metricName: [mean, sd], ...} of the test metrics across folds
+
+	summary = {}
+	for metric in foldResults[0][2]:
+		values = [testMetrics[metric] for name, trainMetrics, testMetrics in foldResults]
+		summary[metric] = [np.mean(values), np.std(values)]
+	return summary
+
+def evaluate(data, config, folds, nProcesses=None, seed=0):
+	# Expects numpy matrix of X and y values (data should not include the bias column),
+	#	a configuration dictionary (see fitModel) and a list of folds
+	# Folds are evaluated in parallel, nProcesses: size of the process pool (None -> one process per core)
+	# seed: fold i is trained from random seed (seed + i)
+	# Returns [foldResults, summary]
+	#	foldResults: [[name, trainMetrics, testMetrics], ...] in the order of folds
+	#	summary: {metricName: [mean, sd], ...}
+
+	config = dict(config)
+	config.setdefault('nLabels', int(np.max(data[:,-1]) + 1))
+	with sharedData.sharedMatrix(data) as descriptor:
+		pool = multiprocessing.Pool(nProcesses, initWorker, (descriptor,))
+		try:
+			foldResults = pool.map(evaluateFold, [[config, folds[i], seed + i] for i in range(0, len(folds))], 1)
+		finally:
+			pool.close()
+			pool.join()
+	return [foldResults, summarize(foldResults)]
+
+def crossValidate(data, config, k=5, nProcesses=None, seed=0):
+	# Shuffled k-fold cross validation
+	# Returns [foldResults, summary] (see evaluate)
+
+	return evaluate(data, config, getKFolds(data.shape[0], k), nProcesses, seed)
+
+def walkForward(data, dates, config, minTrainSeasons=1, nProcesses=None, seed=0):
+	# Season by season backtesting: train on every season up to Y, test on season Y+1
+	# dates: the race date (as int) behind each row of data (see trainingData.collect withDates)
+	# Returns [foldResults, summary] (see evaluate)
+
+	return evaluate(data, config, getWalkForwardFolds(dates, minTrainSeasons), nProcesses, seed)
+
+def printEvaluation(foldResults, summary):
+	# Prints the test metrics of each fold followed by their mean and sd
+
+	metrics = sorted(summary.keys())
+	print('Fold\t' + '\t'.join(metrics))
+	for name, trainMetrics, testMetrics in foldResults:
+		print(str(name) + '\t' + '\t'.join('%.5f' % testMetrics[metric] for metric in metrics))
+	print('Mean\t' + '\t'.join('%.5f' % summary[metric][0] for metric in metrics))
+	print('SD\t' + '\t'.join('%.5f' % summary[metric][1] for metric in metrics))
+
+def main():
+	# Test Module Functionality
+
+	data, dates = trainingData.collectDistanceRankCategory(True)
+	data = machineLearning.matrix(data)
+	print(data.shape)
+	config = {'model': 'neuralNetwork', 'hidden': [10], 'alpha': .05, 'reg': 0}
+	printEvaluation(*crossValidate(data, config, 5))
+	printEvaluation(*walkForward(data, dates, config, 3))
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
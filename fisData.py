@@ -5,6 +5,8 @@ Functions responsible for collecting data from the fis-ski.com website
 import re
 from datetime import date, timedelta
 
+import numpy as np
+
 import scrape
 
 raceCategories = ['Stage World Cup', 'World Cup', 'Championship', 'Junior Championship', 'U23 Championship', 'Other']
@@ -13,6 +15,16 @@ raceTechniques = ['Classic', 'Freestyle', 'Classic/Freestyle']
 genders = ['Male', 'Female']
 disciplines = ['Distance', 'Sprint']
 
+firstDay = np.datetime64('1900-01-01') # Dates are stored as the number of days since this day
+# Each captures [day, month, year] or [hours, minutes, seconds] of a valid value
+reDate = r'[ \t]*(\d+)[-.]+(\d+)[-.]+(\d+)[ \t]*'
+reTime = r'[ \t]*(?:(?:(\d+):)?(\d+):)?(\d+(?:\.\d*)?)[ \t]*'
+reoDate = re.compile(reDate)
+reoTime = re.compile(reTime)
+# Each matches a whole line, capturing nothing if the line isn't a valid value
+reoDateLine = re.compile('^(?:' + reDate + '|.*)$', re.M)
+reoTimeLine = re.compile('^(?:' + reTime + '|.*)$', re.M)
+
 def isDistance(raceTypeIndex):
 	# Expects an index for the raceTypes list
 	# Returns whethor or not this index corresponds to a sprint or distance race
@@ -20,31 +32,95 @@ def isDistance(raceTypeIndex):
 	return (raceTypeIndex == raceTypes.index('Individual') or raceTypeIndex == raceTypes.index('Mass') or \
 		raceTypeIndex == raceTypes.index('Skiathlon') or raceTypeIndex == raceTypes.index('Pursuit'))
 
+def parseLines(reoLine, values):
+	# Expects a compiled multiline regular expression which matches any line, capturing nothing for invalid values
+	# Returns a numpy array of the captured groups, with a row for each value ('' for groups which weren't captured)
+	# All of the values are matched in a single pass over one string, values with a line break are invalid
+
+	if len(values) == 0:
+		return np.zeros((0, reoLine.groups), dtype='U32')
+	groups = reoLine.findall('\n'.join('' if not value or '\n' in value else value for value in values))
+	return np.array(groups, dtype='U32').reshape((len(values), reoLine.groups)) # Fixed width is faster to build
+
+def getDatesAsInt(datesAsStrings):
+	# Expects a list of dates in dd.mm.yyyy format
+	# Returns a masked numpy array with the number of days since 01.01.1900 of each date
+	#	Missing and invalid dates are masked
+
+	parts = parseLines(reoDateLine, datesAsStrings)
+	isValid = parts[:,2] != ''
+	days, months, years = [np.where(isValid, parts[:,i], '1').astype(np.int64) for i in range(0, 3)]
+	isValid &= (months >= 1) & (months <= 12) & (days >= 1)
+	months = np.where(isValid, months, 1)
+	firstOfMonth = (np.array(years - 1970, dtype='datetime64[Y]').astype('datetime64[M]') + (months - 1))
+	dates = firstOfMonth.astype('datetime64[D]') + (np.where(isValid, days, 1) - 1)
+	isValid &= dates.astype('datetime64[M]') == firstOfMonth # Days past the end of the month
+	return np.ma.array((dates - firstDay).astype(np.int64), mask=~isValid)
+
 def getDateAsInt(dateAsString):
 	# Expects date in dd.mm.yyyy format
 	# Returns number of days since 01.01.1900
+	# Raises ValueError if this isn't a valid date (the same dates getDatesAsInt masks)
 
-	reoDelimiter = re.compile('[-\.]+')
-	parts = reoDelimiter.split(dateAsString)
-	delta = date(int(parts[2]), int(parts[1]), int(parts[0])) - date(1900,1,1)
+	match = reoDate.fullmatch(dateAsString or '')
+	if match is None:
+		raise ValueError('Invalid date: ' + repr(dateAsString))
+	delta = date(int(match.group(3)), int(match.group(2)), int(match.group(1))) - date(1900,1,1)
 	return delta.days
 
 def getDateAsStr(dateAsInt):
 	# Expects date as number of days since 01.01.1900
 	# Returns date in dd.mm.yyyy format
 
-	dt = date(1900,1,1) + timedelta(dateAsInt)
+	dt = date(1900,1,1) + timedelta(int(dateAsInt))
 	return str(dt.day)+'.'+str(dt.month)+'.'+str(dt.year)
 
+def getSeason(dateAsInt):
+	# Expects date as number of days since 01.01.1900
+	# Returns the season this date falls in, named by the year it ends
+	#	Seasons run from July 1st to June 30th, so 1.12.2016 -> 2017
+
+	dt = date(1900,1,1) + timedelta(int(dateAsInt))
+	if dt.month >= 7:
+		return dt.year + 1
+	return dt.year
+
+def getTimesAsFloat(timesAsStrings):
+	# Expects a list of times in HH:MM:SS.S format (hours and minutes are optional)
+	# Returns a masked numpy array with each time as a number of seconds
+	#	Missing times and values such as DNF or DSQ are masked
+
+	parts = parseLines(reoTimeLine, timesAsStrings)
+	isValid = parts[:,2] != ''
+	hours, minutes, seconds = [np.where(parts[:,i] != '', parts[:,i], '0').astype(np.float64) for i in range(0, 3)]
+	return np.ma.array(seconds + minutes * 60 + hours * 3600, mask=~isValid)
+
 def getTimeAsFloat(timeAsString):
-	# Expects a time in HH:MM:SS:S format
+	# Expects a time in HH:MM:SS.S format
 	# Returns this time as a float representing the number of seconds
-
-	parts = timeAsString.split(':')
-	time = 0
-	for i in range(0, len(parts)):
-		time += float(parts[-i-1]) * 60**i
-	return time
+	# Raises ValueError if this isn't a valid time (the same times getTimesAsFloat masks)
+
+	match = reoTime.fullmatch(timeAsString or '')
+	if match is None:
+		raise ValueError('Invalid time: ' + repr(timeAsString))
+	hours, minutes, seconds = [float(part or 0) for part in match.groups()]
+	return seconds + minutes * 60 + hours * 3600 # Summed in the same order as getTimesAsFloat
+
+def getCalendarRaces(pageHtml):
+	# Expects the html of a page which links to race results (for example the results calendar)
+	# Returns [[raceId, date], ...] for the races it links to, in ascending order of race id
+	#	date: the first dd.mm.yyyy date in the table row linking to the race (as int), None if the row has none
+
+	raceDates = {}
+	for rowHtml in re.split(r'<tr[\s>]|</tr>', pageHtml):
+		raceIds = re.findall(r'raceid=(\d+)', rowHtml)
+		if raceIds:
+			dates = re.findall(r'\d{1,2}\.\d{1,2}\.\d{4}', rowHtml)
+			rowDate = getDatesAsInt(dates[:1] or [None])[0]
+			for raceId in raceIds:
+				if raceDates.get(int(raceId)) is None:
+					raceDates[int(raceId)] = None if rowDate is np.ma.masked else int(rowDate)
+	return [[raceId, raceDates[raceId]] for raceId in sorted(raceDates)]
 
 def getRaceResults(raceId):
 	# Expects the FIS race id for a cross country ski race
@@ -52,7 +128,8 @@ def getRaceResults(raceId):
 	# output[0] -> Information about the race
 	# output[1] -> A 2d List of the results
 
-	pageHtml = scrape.getHtml('https://data.fis-ski.com/dynamic/results.html?sector=CC&raceid=' + str(raceId))
+	pageHtml = scrape.getHtml('https://data.fis-ski.com/dynamic/results.html?sector=CC&raceid=' + str(raceId), False, \
+		'races/race' + str(raceId))
 
 	def getRaceInfo(pageHtml):
 		# Returns a list with information about this race
@@ -163,7 +240,8 @@ def getPointsList(pointsId, genderIndex, disciplineIndex):
 	if genderIndex == genders.index('Female'):
 		genderStr = 'L'
 	disciplineStr = disciplines[disciplineIndex][0:2].upper()
-	pageHtml = scrape.getHtml('https://data.fis-ski.com/dynamic/fis-points-details.html?sector=CC&listid='+str(pointsId)+'&seasoncode=&lastname=&gender='+genderStr+'&firstname=&nation=&order='+disciplineStr+'&fiscode=&birthyear=&Search=Search&limit=100')
+	pageHtml = scrape.getHtml('https://data.fis-ski.com/dynamic/fis-points-details.html?sector=CC&listid='+str(pointsId)+'&seasoncode=&lastname=&gender='+genderStr+'&firstname=&nation=&order='+disciplineStr+'&fiscode=&birthyear=&Search=Search&limit=100', False, \
+		'points/points' + str(pointsId) + genderStr + disciplineStr)
 	try:
 		points = scrape.getTables(pageHtml)[0]
 	except IndexError:
@@ -0,0 +1,261 @@
+'''
+Functions responsible for fetching pages politely and efficiently
+Connections are kept alive and reused per host, requests are throttled by a token bucket,
+	transient failures (5xx, 429, timeouts, dropped connections) are retried with exponential backoff
+	and pages fetched conditionally are revalidated with ETag / If-Modified-Since
+'''
+
+import os
+import time
+import gzip
+import socket
+import threading
+import http.client
+import http.server
+import urllib.parse
+
+import instrumentation
+
+defaultClientConfig = {'rate': 2., 'burst': 4, 'timeout': 30., 'maxRetries': 5, 'backoff': .5, 'maxBackoff': 30., \
+	'maxRedirects': 5, 'userAgent': 'xc-ski-data/1.0'}
+retryStatuses = [429, 500, 502, 503, 504]
+redirectStatuses = [301, 302, 303, 307, 308]
+
+def newClient(config=None):
+	# Returns a client: {'config', 'pid', 'bucket', 'local' (this thread's connections), 'validators', 'validatorsLock'}
+	# config: overrides of defaultClientConfig
+	#	'rate': requests per second, 'burst': requests which can be made at once after being idle
+	#	'maxRetries': retries after the first attempt, 'backoff': seconds before the first retry (doubled each retry)
+	# The rate limit is per client, clients aren't shared between processes
+
+	config = dict(defaultClientConfig, **(config or {}))
+	return {'config': config, 'pid': os.getpid(), 'bucket': newBucket(config['rate'], config['burst']), \
+		'local': threading.local(), 'validators': {}, 'validatorsLock': threading.Lock()}
+
+# ______________________________________________________________________
+# Rate limiting
+def newBucket(rate, capacity):
+	# Returns a token bucket: {'rate': tokens per second, 'capacity', 'tokens', 'updated', 'lock'}
+
+	return {'rate': float(rate), 'capacity': float(capacity), 'tokens': float(capacity), 'updated': time.monotonic(), \
+		'lock': threading.Lock()}
+
+def takeToken(bucket):
+	# Waits until a token is available and takes it
+	# Returns the number of seconds waited
+
+	waited = 0.
+	while True:
+		with bucket['lock']:
+			now = time.monotonic()
+			bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+			bucket['updated'] = now
+			if bucket['tokens'] >= 1:
+				bucket['tokens'] -= 1
+				return waited
+			delay = (1 - bucket['tokens']) / bucket['rate']
+		time.sleep(delay)
+		waited += delay
+
+# ______________________________________________________________________
+# Connections
+def getConnection(client, scheme, netloc):
+	# Returns [connection, isReused] for a host, opening a new connection if this thread has none
+
+	connections = client['local'].__dict__.setdefault('connections', {})
+	key = (scheme, netloc)
+	if key in connections:
+		return [connections[key], True]
+	if scheme == 'https':
+		connection = http.client.HTTPSConnection(netloc, timeout=client['config']['timeout'])
+	else:
+		connection = http.client.HTTPConnection(netloc, timeout=client['config']['timeout'])
+	connections[key] = connection
+	instrumentation.increment('httpClient.connectionsOpened')
+	return [connection, False]
+
+def dropConnection(client, scheme, netloc):
+	# Closes and forgets this thread's connection to a host
+
+	connections = client['local'].__dict__.get('connections', {})
+	connection = connections.pop((scheme, netloc), None)
+	if connection is not None:
+		connection.close()
+
+def closeClient(client):
+	# Closes this thread's connections
+
+	for scheme, netloc in list(client['local'].__dict__.get('connections', {}).keys()):
+		dropConnection(client, scheme, netloc)
+
+# ______________________________________________________________________
+# Requests
+def getBody(response):
+	# Returns a response's body as text, decompressed and decoded with its charset (utf-8 by default)
+	# Raises OSError or http.client.HTTPException if the connection fails while reading
+
+	body = response.read()
+	if response.getheader('Content-Encoding', '').lower() == 'gzip':
+		body = gzip.decompress(body)
+	charset = response.headers.get_content_charset() or 'utf-8'
+	return body.decode(charset, 'replace')
+
+def getRetryDelay(client, attempt, response=None):
+	# Returns the seconds to wait before retry number attempt (0 based)
+	# A Retry-After header (in seconds) takes precedence over exponential backoff
+
+	config = client['config']
+	if response is not None:
+		retryAfter = response.getheader('Retry-After')
+		if retryAfter and retryAfter.isdigit():
+			return min(float(retryAfter), config['maxBackoff'])
+	return min(config['backoff'] * 2**attempt, config['maxBackoff'])
+
+def sendRequest(client, url, headers):
+	# Makes one request (following redirects) on a kept alive connection
+	# Returns [status, response, body]
+	# Raises OSError or http.client.HTTPException if the connection fails
+
+	for i in range(0, client['config']['maxRedirects'] + 1):
+		parts = urllib.parse.urlsplit(url)
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		connection, isReused = getConnection(client, parts.scheme, parts.netloc)
+		try:
+			connection.request('GET', path, headers=headers)
+			response = connection.getresponse()
+		except (OSError, http.client.HTTPException):
+			dropConnection(client, parts.scheme, parts.netloc)
+			if not isReused:
+				raise
+			# The server closed an idle kept alive connection, which isn't a failure of the request
+			instrumentation.increment('httpClient.staleConnections')
+			connection = getConnection(client, parts.scheme, parts.netloc)[0]
+			connection.request('GET', path, headers=headers)
+			response = connection.getresponse()
+		body = getBody(response) # Read even if it's unused, so the connection can be reused
+		if response.will_close:
+			dropConnection(client, parts.scheme, parts.netloc)
+		if response.status in redirectStatuses and response.getheader('Location'):
+			url = urllib.parse.urljoin(url, response.getheader('Location'))
+			continue
+		return [response.status, response, body]
+	raise IOError('Too many redirects from ' + url)
+
+@instrumentation.timed('httpClient.get')
+def get(client, url, conditional=False):
+	# Returns [html, isModified] for a url
+	# conditional: revalidate a page fetched before with its ETag / Last-Modified,
+	#	if the server answers 304 Not Modified the previous html is returned with isModified False
+	# Transient failures are retried with exponential backoff, other failures raise IOError
+
+	config = client['config']
+	headers = {'User-Agent': config['userAgent'], 'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+	with client['validatorsLock']:
+		validator = client['validators'].get(url) if conditional else None
+	if validator:
+		if validator['etag']:
+			headers['If-None-Match'] = validator['etag']
+		if validator['lastModified']:
+			headers['If-Modified-Since'] = validator['lastModified']
+
+	for attempt in range(0, config['maxRetries'] + 1):
+		takeToken(client['bucket'])
+		instrumentation.increment('httpClient.requests')
+		response = None
+		try:
+			status, response, html = sendRequest(client, url, headers)
+			if status == 304 and validator:
+				instrumentation.increment('httpClient.notModified')
+				return [validator['html'], False]
+			if status == 200:
+				if conditional and (response.getheader('ETag') or response.getheader('Last-Modified')):
+					with client['validatorsLock']:
+						client['validators'][url] = {'etag': response.getheader('ETag'), \
+							'lastModified': response.getheader('Last-Modified'), 'html': html}
+				return [html, True]
+			if not status in retryStatuses:
+				raise IOError('HTTP ' + str(status) + ' from ' + url)
+			error = 'HTTP ' + str(status)
+		except (socket.timeout, ConnectionError, http.client.HTTPException) as e:
+			error = repr(e)
+		if attempt < config['maxRetries']:
+			instrumentation.increment('httpClient.retries')
+			time.sleep(getRetryDelay(client, attempt, response))
+	raise IOError(error + ' from ' + url + ' after ' + str(config['maxRetries'] + 1) + ' attempts')
+
+# ______________________________________________________________________
+# Stand-in server for testing
+def getStandInHandler(pages, failures):
+	# Returns a request handler class which serves pages ({path: html}) with ETags
+	# failures: {path: number of 503 responses to give before succeeding}
+	# Every request's path is appended to the handler's requests list
+
+	class StandInHandler(http.server.BaseHTTPRequestHandler):
+		protocol_version = 'HTTP/1.1' # Keep connections alive
+		requests = []
+
+		def do_GET(self):
+			self.requests.append(self.path)
+			if failures.get(self.path, 0) > 0:
+				failures[self.path] -= 1
+				self.sendPage(503, b'')
+			elif not self.path in pages:
+				self.sendPage(404, b'')
+			elif self.headers.get('If-None-Match') == '"' + str(hash(pages[self.path])) + '"':
+				self.sendPage(304, None)
+			else:
+				self.sendPage(200, pages[self.path].encode('utf-8'))
+
+		def sendPage(self, status, body):
+			self.send_response(status)
+			if self.path in pages:
+				self.send_header('ETag', '"' + str(hash(pages[self.path])) + '"')
+			if body is not None:
+				self.send_header('Content-Type', 'text/html; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			if body:
+				self.wfile.write(body)
+
+		def log_message(self, *args):
+			pass
+
+	return StandInHandler
+
+def startStandInServer(pages, failures=None):
+	# Serves pages from a local stand-in server on a free port in a background thread
+	# Returns [server, baseUrl, handler], call server.shutdown() to stop it
+
+	handler = getStandInHandler(pages, failures or {})
+	server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return [server, 'http://127.0.0.1:' + str(server.server_address[1]), handler]
+
+def main():
+	# Test Module Functionality
+
+	pages = {'/index.html': '<table><tr><td>List</td></tr></table>', '/flaky.html': 'ok'}
+	server, baseUrl, handler = startStandInServer(pages, {'/flaky.html': 2})
+	instrumentation.enable()
+	client = newClient({'rate': 20, 'burst': 1, 'backoff': .05})
+	try:
+		started = time.monotonic()
+		for i in range(0, 10):
+			print(get(client, baseUrl + '/index.html'))
+		print('10 requests at 20 per second: ' + '%.2f' % (time.monotonic() - started) + ' seconds')
+		print(get(client, baseUrl + '/flaky.html'))
+		print(get(client, baseUrl + '/index.html', True))
+		print(get(client, baseUrl + '/index.html', True))
+		try:
+			get(client, baseUrl + '/missing.html')
+		except IOError as e:
+			print(e)
+	finally:
+		closeClient(client)
+		server.shutdown()
+	print(instrumentation.getReport()['counters'])
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
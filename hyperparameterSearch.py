@@ -0,0 +1,157 @@
+'''
+Functions responsible for searching for good hyperparameters (order, reg, layers, alpha)
+Configurations are evaluated in parallel on a held out validation set
+'''
+
+import itertools
+import multiprocessing
+
+import numpy as np
+
+import storage
+import sharedData
+import machineLearning
+import evaluation
+
+# Each worker process attaches to the data in shared memory and keeps a cache of expanded design matrices
+# workerState: {'train': read only matrix, 'validation': read only matrix, 'designMatrices': {order: [Xtrain, ytrain, Xval, yval]}}
+workerState = {}
+
+# ______________________________________________________________________
+# Building the configurations to search
+def getGrid(options):
+	# Expects a dictionary of hyperparameter name -> list of values to try
+	#	{'model': ['linear'], 'order': [1, 2, 3], 'reg': [0, 1, 10], 'alpha': [.001]}
+	# Returns a list of configuration dictionaries, one for every combination of values
+
+	names = sorted(options.keys())
+	return [dict(zip(names, values)) for values in itertools.product(*[options[name] for name in names])]
+
+def getRandomSample(options, nConfigs):
+	# Expects a dictionary of hyperparameter name -> list of values to sample from
+	# Returns a list of nConfigs unique configuration dictionaries chosen at random from the grid
+
+	grid = getGrid(options)
+	nConfigs = min(nConfigs, len(grid))
+	return [grid[i] for i in np.random.choice(len(grid), nConfigs, replace=False)]
+
+def getRegularizationPaths(configs):
+	# Groups configurations which only differ by their regularization constant
+	# Returns a list of paths: [[config, ...], ...]
+	# Each path is sorted from the largest reg to the smallest reg,
+	#	so each fit can start from the simpler solution before it
+
+	paths = {}
+	for config in configs:
+		key = str(sorted((name, value) for name, value in config.items() if name != 'reg'))
+		paths.setdefault(key, []).append(config)
+	return [sorted(path, key=lambda config: -config['reg']) for path in paths.values()]
+
+# ______________________________________________________________________
+# Worker functions
+def initWorker(trainDescriptor, validationDescriptor):
+	# Attaches to the shared training and validation matrices once per worker process
+
+	workerState['train'] = sharedData.attachSharedMatrix(trainDescriptor)
+	workerState['validation'] = sharedData.attachSharedMatrix(validationDescriptor)
+	workerState['designMatrices'] = {}
+
+def getDesignMatrices(order):
+	# Returns [Xtrain, ytrain, Xval, yval] for this polynomial order (see evaluation.getDesignMatrices)
+	# Results are cached, so every configuration with the same order reuses the same expansion
+
+	if not order in workerState['designMatrices']:
+		workerState['designMatrices'][order] = evaluation.getDesignMatrices(workerState['train'], \
+			workerState['validation'], order)
+	return workerState['designMatrices'][order]
+
+def fitConfig(config, theta):
+	# Trains one configuration starting from theta (None -> default initialization)
+	# Returns [theta, finalCost, trainScore, validationScore]
+
+	Xtrain, ytrain, Xval, yval = getDesignMatrices(config.get('order', 1))
+	theta, finalCost = evaluation.fitModel(config, Xtrain, ytrain, theta)
+	metric = evaluation.primaryMetrics[config['model']]
+	return [theta, finalCost, evaluation.getMetrics(config['model'], Xtrain, ytrain, theta)[metric], \
+		evaluation.getMetrics(config['model'], Xval, yval, theta)[metric]]
+
+def evaluatePath(task):
+	# Expects [path, seed]
+	# Fits each configuration along a regularization path
+	# Each fit is warm started from the previous theta
+	#	The random state is seeded first, so the path's results don't depend on which worker runs it
+	# Returns a list of result rows: [[validationScore, trainScore, finalCost, config], ...]
+
+	path, seed = task
+	np.random.seed(seed)
+	output = []
+	theta = None
+	for config in path:
+		theta, finalCost, trainScore, validationScore = fitConfig(config, theta)
+		output.append([validationScore, trainScore, finalCost, config])
+	return output
+
+# ______________________________________________________________________
+# Primary functions
+def search(data, configs, parts=(.8, .2), nProcesses=None, warmStart=True, seed=0):
+	# Expects numpy matrix of X and y values (data should not include the bias column)
+	#	and a list of configuration dictionaries (see getGrid and getRandomSample)
+	# Each configuration is described in evaluation.fitModel, plus an optional 'order' (default 1)
+	# Models are scored on the validation set by evaluation.primaryMetrics
+	# nProcesses: size of the process pool (None -> one process per core)
+	# seed: the ith path (longest first) is fit from random seed (seed + i)
+	# Returns a list of result rows sorted from best to worst: [[validationScore, trainScore, finalCost, config], ...]
+
+	train, validation = machineLearning.partitionData(machineLearning.shuffle(data.copy()), parts)[0:2]
+	nLabels = int(np.max(data[:,-1]) + 1)
+	configs = [dict(config) for config in configs]
+	for config in configs:
+		config.setdefault('nLabels', nLabels)
+
+	if warmStart:
+		paths = getRegularizationPaths(configs)
+	else:
+		paths = [[config] for config in configs]
+	# Start with the longest paths so the pool doesn't wait on one slow worker at the end
+	paths = sorted(paths, key=len, reverse=True)
+
+	results = []
+	with sharedData.sharedMatrix(train) as trainDescriptor, sharedData.sharedMatrix(validation) as validationDescriptor:
+		pool = multiprocessing.Pool(nProcesses, initWorker, (trainDescriptor, validationDescriptor))
+		try:
+			tasks = [[paths[i], seed + i] for i in range(0, len(paths))]
+			for pathResults in pool.imap_unordered(evaluatePath, tasks):
+				results += pathResults
+		finally:
+			pool.close()
+			pool.join()
+
+	def sortKey(row):
+		if evaluation.primaryMetrics[row[3]['model']] in evaluation.lowerIsBetter:
+			return row[0]
+		return -row[0]
+
+	results.sort(key=sortKey)
+	return results
+
+def printResults(results, limit=None):
+	# Prints a ranked table of search results
+
+	print('Rank\tValidation\tTraining\tCost\tConfiguration')
+	for i in range(0, len(results[:limit])):
+		validationScore, trainScore, finalCost, config = results[i]
+		shown = ', '.join(name + '=' + str(config[name]) for name in sorted(config) if name != 'nLabels')
+		print(str(i+1) + '\t' + '%.5f' % validationScore + '\t' + '%.5f' % trainScore + '\t' + \
+			'%.5f' % finalCost + '\t' + shown)
+
+def main():
+	# Test Module Functionality
+
+	data = machineLearning.matrix(storage.read2DListFromCsv('./data/trainingData/individualPercentBackWithFisPointsWithoutOutliers.csv'))
+	print(data.shape)
+	configs = getGrid({'model': ['linear'], 'order': [1, 2, 3], 'reg': [0, .1, 1, 10, 100], 'alpha': [.001, .003]})
+	results = search(data, configs)
+	printResults(results, 20)
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
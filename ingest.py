@@ -0,0 +1,211 @@
+'''
+Functions responsible for getting new data in without a human in the loop
+A long running daemon checks the points lists index and the results calendar on their own schedules,
+	queues list and race ids it hasn't seen before and runs the ingest stages of the pipeline
+Checks are spread out with jitter and a failing check backs off exponentially
+'''
+
+import os
+import time
+import random
+import signal
+import threading
+from datetime import date
+
+import storage
+import scrape
+import httpClient
+import fisData
+import dataPreparation
+import pipeline
+
+ingestState_fName = './data/ingestState.json'
+
+# 'rankingsInterval', 'racesInterval': seconds between checks
+# 'jitter': each interval is randomly stretched or shrunk by up to this fraction
+# 'backoff', 'maxBackoff': seconds before checking again after a failure (doubled after each consecutive failure)
+# 'maxPendingDays': how many days after it took place a race which can't be stored yet (results not published) is retried
+# 'pipelineTargets': the pipeline stages to run after new ids are queued (see pipeline.selectStages), None -> all
+defaultIngestConfig = {'rankingsInterval': 6 * 3600, 'racesInterval': 300, 'jitter': .1, 'backoff': 60, \
+	'maxBackoff': 3600, 'maxPendingDays': 3, 'calendarUrl': 'https://data.fis-ski.com/cross-country/results.html', \
+	'pipelineTargets': ['fetch', 'buildCatalogue', 'rateAthletes']}
+
+def readState():
+	# Returns the ingest state: {'calendar', 'queued', 'finished', 'lastChecks': {jobName: time}}
+	#	'calendar': {raceId: date} of the races on the results calendar when it last changed
+	#	'queued': {raceId: date} of the races ingest queued which haven't been stored or rejected yet
+	#	'finished': ids of races which were rejected or given up on, while they're still on the calendar
+	# Race ids are strings and dates are ints (see fisData.getCalendarRaces)
+
+	state = {}
+	if os.path.exists(ingestState_fName):
+		state = storage.readFromJson(ingestState_fName)
+	for key in ['calendar', 'queued', 'lastChecks']:
+		state.setdefault(key, {})
+	state.setdefault('finished', [])
+	return state
+
+def getToday():
+	# Returns today's date as an int (see fisData.getDateAsInt)
+
+	return (date.today() - date(1900,1,1)).days
+
+def readWorkQueue(fName):
+	# Returns a work queue, an empty one if it hasn't been created yet
+
+	if not os.path.exists(fName):
+		return []
+	return storage.readFromJson(fName)
+
+# ______________________________________________________________________
+# Discovery
+def getNewRankingIds(lists, rankingsIndex, rankingIdsWorkQueue):
+	# Expects the lists on the index page (see dataPreparation.getRankingLists), rankingsIndex and the queued list ids
+	# Returns the ids of lists which start after the latest stored list and aren't queued, oldest first
+
+	newLists = [listInfo for listInfo in lists if listInfo[0] is not None and listInfo[1] > rankingsIndex[0][3] and \
+		not listInfo[0] in rankingIdsWorkQueue]
+	return [listInfo[0] for listInfo in sorted(newLists, key=lambda listInfo: listInfo[1])]
+
+def updateQueuedRaces(state, storedIds, raceIdsWorkQueue):
+	# Forgets the queued races which are gone from the queue, they were stored or rejected (see dataPreparation.storeRace)
+	# Rejected races are kept in state['finished'] so they aren't queued again
+
+	queued = set(raceIdsWorkQueue)
+	for raceId in list(state['queued'].keys()):
+		if not int(raceId) in queued:
+			del state['queued'][raceId]
+			if not int(raceId) in storedIds:
+				state['finished'].append(raceId)
+
+def getNewRaceIds(calendarRaces, today, storedIds, raceIdsWorkQueue, state):
+	# Expects [[raceId, date], ...] from the results calendar (see fisData.getCalendarRaces)
+	# Returns the ids of the races which have taken place and are neither stored, queued nor finished
+	#	Races later in the calendar are returned by a check on or after their date
+	#	Races without a date are returned straight away
+
+	known = storedIds | set(raceIdsWorkQueue) | set(int(raceId) for raceId in state['finished'])
+	return [raceId for raceId, raceDate in calendarRaces if not raceId in known and (raceDate is None or raceDate <= today)]
+
+def checkRankings(state, config):
+	# Queues the points lists which were published since the latest stored list
+	# Returns the number of lists in the queue
+
+	html, isModified = httpClient.get(scrape.getClient(), dataPreparation.rankingListsUrl, True)
+	rankingIdsWorkQueue = readWorkQueue(dataPreparation.rankingIdsWorkQueue_fName)
+	if not isModified:
+		return len(rankingIdsWorkQueue)
+	newIds = getNewRankingIds(dataPreparation.getRankingLists(html), \
+		storage.readFromJson(dataPreparation.rankingsIndex_fName), rankingIdsWorkQueue)
+	if newIds:
+		storage.storeAsJson(rankingIdsWorkQueue + newIds, dataPreparation.rankingIdsWorkQueue_fName)
+	return len(rankingIdsWorkQueue) + len(newIds)
+
+def checkRaces(state, config):
+	# Queues the races on the results calendar which have taken place and haven't been seen before
+	# Queued races which still can't be stored maxPendingDays after they took place are given up on
+	# Returns the number of races in the queue, new ones and ones which are retried
+
+	today = getToday()
+	raceIdsWorkQueue = readWorkQueue(dataPreparation.raceIdsWorkQueue_fName)
+	storedIds = set(raceInfo[0] for raceInfo in storage.readFromJson(dataPreparation.racesIndex_fName))
+	updateQueuedRaces(state, storedIds, raceIdsWorkQueue)
+	pending = [raceId for raceId in raceIdsWorkQueue if today - state['queued'].get(str(raceId), today) <= \
+		config['maxPendingDays']]
+	if len(pending) < len(raceIdsWorkQueue):
+		givenUp = sorted(set(raceIdsWorkQueue) - set(pending))
+		print('Gave up on races: ' + str(givenUp))
+		for raceId in givenUp:
+			state['queued'].pop(str(raceId), None)
+			state['finished'].append(str(raceId))
+
+	html, isModified = httpClient.get(scrape.getClient(), config['calendarUrl'], True)
+	if isModified:
+		state['calendar'] = dict((str(raceId), raceDate) for raceId, raceDate in fisData.getCalendarRaces(html))
+	# Races which have left the calendar can't be queued again
+	state['finished'] = [raceId for raceId in state['finished'] if raceId in state['calendar']]
+	calendarRaces = [[int(raceId), state['calendar'][raceId]] for raceId in state['calendar']]
+	newIds = getNewRaceIds(calendarRaces, today, storedIds, pending, state)
+	for raceId in newIds:
+		raceDate = state['calendar'][str(raceId)]
+		state['queued'][str(raceId)] = today if raceDate is None else raceDate
+	if newIds or len(pending) < len(raceIdsWorkQueue):
+		storage.storeAsJson(pending + newIds, dataPreparation.raceIdsWorkQueue_fName)
+	return len(newIds) + len(pending)
+
+# ______________________________________________________________________
+# Scheduling
+def newJob(name, f_check, interval):
+	# Returns a job: {'name', 'f_check', 'interval', 'nextDue', 'nFailures'}
+	# f_check(state, config) returns the number of ids waiting in its queue
+
+	return {'name': name, 'f_check': f_check, 'interval': interval, 'nextDue': 0., 'nFailures': 0}
+
+def getDelay(interval, jitter):
+	# Returns interval randomly stretched or shrunk by up to the fraction jitter
+
+	return interval * (1 + random.uniform(-jitter, jitter))
+
+def runJob(job, state, config):
+	# Runs a job's check and schedules its next run
+	# Returns the number of ids waiting in its queue, 0 if it failed
+
+	try:
+		nQueued = job['f_check'](state, config)
+		job['nFailures'] = 0
+		job['nextDue'] = time.time() + getDelay(job['interval'], config['jitter'])
+		state['lastChecks'][job['name']] = time.time()
+		return nQueued
+	except Exception as e:
+		delay = min(config['backoff'] * 2**job['nFailures'], config['maxBackoff'])
+		job['nFailures'] += 1
+		job['nextDue'] = time.time() + getDelay(delay, config['jitter'])
+		print(job['name'] + ': ' + repr(e) + ' (Retrying in ' + str(int(delay)) + ' seconds)')
+		return 0
+
+def runIngest(config):
+	# Runs the ingest stages of the pipeline
+	# The fetch stages always run, so races still in the queue are retried even if the queue didn't change
+	# Returns {stageName: outcome} (see pipeline.run)
+
+	stages = pipeline.getStages()
+	if config['pipelineTargets'] is not None:
+		stages = pipeline.selectStages(stages, config['pipelineTargets'])
+	return pipeline.run(stages, ['fetch'])
+
+def serve(config=None, f_stop=None):
+	# Runs the ingest daemon until f_stop() returns True (None -> until SIGINT or SIGTERM)
+	# config: overrides of defaultIngestConfig
+
+	config = dict(defaultIngestConfig, **(config or {}))
+	state = readState()
+	jobs = [newJob('rankings', checkRankings, config['rankingsInterval']), \
+		newJob('races', checkRaces, config['racesInterval'])]
+	if f_stop is None:
+		stopping = threading.Event()
+		for signalNumber in [signal.SIGINT, signal.SIGTERM]:
+			signal.signal(signalNumber, lambda *args: stopping.set())
+		f_stop = stopping.is_set
+
+	while not f_stop():
+		now = time.time()
+		due = [job for job in jobs if job['nextDue'] <= now]
+		if not due:
+			time.sleep(min(1., min(job['nextDue'] for job in jobs) - now))
+			continue
+		nQueued = sum(runJob(job, state, config) for job in due)
+		storage.storeAsJson(state, ingestState_fName)
+		if nQueued > 0:
+			print(time.strftime('%Y-%m-%d %H:%M:%S') + ': ' + str(nQueued) + ' ids in work queues, running ingest')
+			try:
+				runIngest(config)
+			except Exception as e:
+				print('Ingest failed: ' + repr(e))
+
+def main():
+	# Test Module Functionality
+
+	serve()
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
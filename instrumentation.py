@@ -0,0 +1,183 @@
+'''
+Functions responsible for timing and counting what the pipeline does
+Timers and counters are aggregated in process and can be exported as a json report or in Prometheus text format
+Nothing is recorded until enable() is called, so instrumented code only pays for a flag check
+'''
+
+import os
+import re
+import json
+import time
+import functools
+import contextlib
+
+enabled = False
+# counters: {(name, labels): value}, timers: {(name, labels): [count, totalSeconds, maxSeconds]}
+#	labels is a sorted tuple of (key, value) pairs, () for none
+counters = {}
+timers = {}
+prometheusPrefix = 'xcski_'
+noTimer = contextlib.nullcontext() # Returned by timer while disabled
+
+def enable():
+	# Starts recording
+
+	global enabled
+	enabled = True
+
+def disable():
+	# Stops recording, what was recorded is kept
+
+	global enabled
+	enabled = False
+
+def reset():
+	# Forgets everything recorded
+
+	counters.clear()
+	timers.clear()
+
+def getKey(name, labels):
+	# Returns the key of a counter or timer: (name, sorted tuple of label pairs)
+
+	return (name, tuple(sorted(labels.items())) if labels else ())
+
+def increment(name, amount=1, labels=None):
+	# Adds amount to a counter
+	# labels: optional dictionary which splits a counter, for example {'reason': 'noFeatures'}
+
+	if not enabled:
+		return
+	key = getKey(name, labels)
+	counters[key] = counters.get(key, 0) + amount
+
+def recordTime(name, seconds, labels=None):
+	# Adds a measurement to a timer
+
+	if not enabled:
+		return
+	key = getKey(name, labels)
+	if key in timers:
+		timer = timers[key]
+		timer[0] += 1
+		timer[1] += seconds
+		timer[2] = max(timer[2], seconds)
+	else:
+		timers[key] = [1, seconds, seconds]
+
+@contextlib.contextmanager
+def timing(name, labels=None):
+	# Records the time spent in a with block, even if it raises
+
+	started = time.perf_counter()
+	try:
+		yield
+	finally:
+		recordTime(name, time.perf_counter() - started, labels)
+
+def timer(name, labels=None):
+	# Context manager which times a with block
+	#	with instrumentation.timer('trainingData.collect'):
+	# While disabled it returns a shared context manager which does nothing
+
+	if not enabled:
+		return noTimer
+	return timing(name, labels)
+
+def timed(name):
+	# Decorator which times every call to a function
+	#	@instrumentation.timed('scrape.getHtml')
+
+	def decorator(f):
+		@functools.wraps(f)
+		def wrapper(*args, **kwargs):
+			if not enabled:
+				return f(*args, **kwargs)
+			started = time.perf_counter()
+			try:
+				return f(*args, **kwargs)
+			finally:
+				recordTime(name, time.perf_counter() - started)
+		return wrapper
+	return decorator
+
+def getKeyAsStr(key):
+	# Returns a key as name{label="value",...}
+
+	name, labels = key
+	if not labels:
+		return name
+	return name + '{' + ','.join(label + '="' + str(value) + '"' for label, value in labels) + '}'
+
+def getReport():
+	# Returns everything recorded:
+	#	{'counters': {name: value}, 'timers': {name: {'count', 'totalSeconds', 'meanSeconds', 'maxSeconds'}}}
+
+	report = {'counters': {}, 'timers': {}}
+	for key in sorted(counters):
+		report['counters'][getKeyAsStr(key)] = counters[key]
+	for key in sorted(timers):
+		count, total, maximum = timers[key]
+		report['timers'][getKeyAsStr(key)] = {'count': count, 'totalSeconds': total, 'meanSeconds': total / count, \
+			'maxSeconds': maximum}
+	return report
+
+def storeReport(fName):
+	# Stores getReport() as json
+
+	with open(fName, 'w') as outFile:
+		json.dump(getReport(), outFile, indent=2, sort_keys=True)
+
+def getPrometheusName(name):
+	# Returns a name which is valid in Prometheus' text format: scrape.getHtml -> xcski_scrape_getHtml
+
+	return prometheusPrefix + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+def getPrometheusText():
+	# Returns everything recorded in Prometheus' text exposition format
+	#	Counters become <name>_total, timers become a summary <name>_seconds (count and sum) and a gauge <name>_seconds_max
+
+	families = {} # {family name: [type, [sample lines]]}, samples of a family have to be listed together
+	def addSample(family, metricType, name, labels, value):
+		# Adds a sample line to its metric family
+
+		if not family in families:
+			families[family] = [metricType, []]
+		families[family][1].append(getKeyAsStr((name, labels)) + ' ' + repr(value))
+
+	for key in sorted(counters):
+		name = getPrometheusName(key[0]) + '_total'
+		addSample(name, 'counter', name, key[1], counters[key])
+	for key in sorted(timers):
+		name = getPrometheusName(key[0]) + '_seconds'
+		count, total, maximum = timers[key]
+		addSample(name, 'summary', name + '_count', key[1], count)
+		addSample(name, 'summary', name + '_sum', key[1], total)
+		addSample(name + '_max', 'gauge', name + '_max', key[1], maximum)
+	lines = []
+	for family in sorted(families):
+		lines.append('# TYPE ' + family + ' ' + families[family][0])
+		lines.extend(families[family][1])
+	return '\n'.join(lines) + '\n'
+
+def storePrometheusText(fName):
+	# Stores getPrometheusText() for Prometheus' node exporter textfile collector
+	# Written to a temporary file and renamed, so the collector never reads a partial file
+
+	with open(fName + '.tmp', 'w') as outFile:
+		outFile.write(getPrometheusText())
+	os.replace(fName + '.tmp', fName)
+
+def main():
+	# Test Module Functionality
+
+	enable()
+	for i in range(0, 3):
+		with timer('example.block'):
+			increment('example.rows', 10)
+			increment('example.rowsRejected', 1, {'reason': 'noFeatures'})
+	print(json.dumps(getReport(), indent=2))
+	print(getPrometheusText())
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
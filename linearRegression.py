@@ -8,16 +8,19 @@ import storage
 import trainingData
 import machineLearning
 
-def cost(X, y, theta, reg):
+def cost(X, y, theta, reg, withCost=True):
 	# Expects training matrix (X), column vector of labels (y), 
 	# 	column vector of coefficents (theta), and regularization constant (reg)
 	# Returns linear regression cost(theta) = 1/(2m) * SUM((predictedValue - actualValue)^2)
 	# 	and gradient(theta)
+	# withCost: if False only the gradient is computed and the cost is None
 
 	m = len(y)
 	h = np.dot(X, theta)
 	d = h - y
-	J = np.sum(d**2) / (2*m) + np.sum(theta[1:]**2) * reg / (2*m) 
+	J = None
+	if withCost:
+		J = np.sum(d**2) / (2*m) + np.sum(theta[1:]**2) * reg / (2*m) 
 	grad = np.dot(np.transpose(X), d) / m
 	grad[1:] += theta[1:] * reg / m
 	return J, grad
@@ -33,11 +36,12 @@ def accuracy(X, y, theta):
 	error = np.absolute(predict(X, theta) - y)
 	return np.mean(error)
 
-def trainLinearRegression(data, order, reg):
+def trainLinearRegression(data, order, reg, scaler=None):
 	# data is numpy mxn matrix
 	# data should not include the constant column
 	# order: the maximum power of each feature combination after polynomial expansion
 	# reg: regularization constant
+	# scaler: normalization statistics for the expanded features, None -> computed from data
 
 	# Get data
 	X = data[:,:-1]
@@ -46,13 +50,16 @@ def trainLinearRegression(data, order, reg):
 	# Add nonlinear terms
 	X = machineLearning.expandFeatures(X, order)
 
-	# Normalize features so that gradient descent works well
+	# Normalize features in place so that gradient descent works well
 	# Don't normalize the constant column, because this has sigma=0
-	X[:,1:], mu, sigma = machineLearning.normalize(X[:,1:])
+	if scaler is None:
+		scaler = machineLearning.fitScaler(X[:,1:])
+	machineLearning.applyScaler(scaler, X[:,1:], X[:,1:])
+	mu, sigma = machineLearning.getScalerStats(scaler)
 
 	# Initialize theta and run gradient descent
 	theta = np.zeros((X.shape[1], 1))
-	theta, costHistory = machineLearning.gradientDescent(X, y, theta, cost, 0.001, reg, 10000)
+	theta, costHistory = machineLearning.gradientDescent(X, y, theta, cost, 0.001, reg, 10000, 100)
 	if True:
 		print('Progression of cost through gradient descent:')
 		print(costHistory[0])
@@ -71,17 +78,19 @@ def trainWithoutOutliers(data, order, reg, sds):
 	# Theoretically this could improve performance on a test set 
 
 	# Set up
-	theta = trainLinearRegression(data, order, reg)
+	# Both trainings share the scaler from the full data set
 	X = data[:,:-1]
 	X = machineLearning.expandFeatures(X, order)
 	y = data[:,-1:]
+	scaler = machineLearning.fitScaler(X[:,1:])
+	theta = trainLinearRegression(data, order, reg, scaler)
 
 	error = np.absolute(X.dot(theta) - y)
 	mu = np.mean(error)
 	sd = np.std(error)
 	goodRows = np.where(error <= (sds*sd + mu))[0]
 	print('Removed ' + str(X.shape[0] - goodRows.shape[0]) + ' training samples.')
-	return trainLinearRegression(data[goodRows,:], order, reg)
+	return trainLinearRegression(data[goodRows,:], order, reg, scaler)
 
 def main():
 	# Test Module Functionality
@@ -8,15 +8,18 @@ import storage
 import trainingData
 import machineLearning
 
-def cost(X, y, theta, reg):
+def cost(X, y, theta, reg, withCost=True):
 	# Expects training matrix (X), column vector of labels (y), 
 	# 	column vector of coefficents (theta), and regularization constant (reg)
 	# Returns logistic regression cost, gradient
+	# withCost: if False only the gradient is computed and the cost is None
 
 	m = X.shape[0]
 	h = machineLearning.sigmoid(X.dot(theta))
-	J = np.sum(np.log(h) * (-y) - np.log(1-h) * (1-y)) / m
-	J = J + np.sum(theta[1:,:] ** 2) * reg / (2*m) # add regularization
+	J = None
+	if withCost:
+		J = np.sum(np.log(h) * (-y) - np.log(1-h) * (1-y)) / m
+		J = J + np.sum(theta[1:,:] ** 2) * reg / (2*m) # add regularization
 	grad = (np.transpose(X).dot(h-y)) / m
 	grad[1:,:] = grad[1:,:] + theta[1:,:] * reg / m # add regularization
 	return J, grad
@@ -37,9 +40,10 @@ def accuracy(X, y, theta):
 	p = predictBool(X, theta)
 	return np.mean((p == y).astype(int))
 
-def trainLogisticRegression(data, order, reg):
+def trainLogisticRegression(data, order, reg, scaler=None):
 	# data is numpy matrix
 	# order is the maximum degree of each expansion
+	# scaler: normalization statistics for the expanded features, None -> computed from data
 
 	# Get data
 	X = data[:,:-1]
@@ -48,13 +52,16 @@ def trainLogisticRegression(data, order, reg):
 	# Add nonlinear terms
 	X = machineLearning.expandFeatures(X, order)
 
-	# Normalize features so that gradient descent works well
+	# Normalize features in place so that gradient descent works well
 	# Don't normalize the constant column, because this has sigma=0
-	X[:,1:], mu, sigma = machineLearning.normalize(X[:,1:])
+	if scaler is None:
+		scaler = machineLearning.fitScaler(X[:,1:])
+	machineLearning.applyScaler(scaler, X[:,1:], X[:,1:])
+	mu, sigma = machineLearning.getScalerStats(scaler)
 
 	# Initialize theta and run gradient descent
 	theta = np.zeros((X.shape[1], 1))
-	theta, costHistory = machineLearning.gradientDescent(X, y, theta, cost, .05, reg, 10000)
+	theta, costHistory = machineLearning.gradientDescent(X, y, theta, cost, .05, reg, 10000, 100)
 	if True:
 		print('Progression of cost through gradient descent:')
 		print(costHistory[0])
@@ -73,10 +80,12 @@ def trainWithoutOutliers(data, order, reg, sds):
 	# Theoretically this could improve performance on a test set 
 
 	# Set up
-	theta = trainLogisticRegression(data, order, reg)
+	# Both trainings share the scaler from the full data set
 	X = data[:,:-1]
 	X = machineLearning.expandFeatures(X, order)
 	y = data[:,-1:]
+	scaler = machineLearning.fitScaler(X[:,1:])
+	theta = trainLogisticRegression(data, order, reg, scaler)
 
 	error = np.absolute(predictProb(X, theta) - y)
 	mu = np.mean(error)
@@ -84,7 +93,7 @@ def trainWithoutOutliers(data, order, reg, sds):
 	sd = np.std(error)
 	goodRows = np.where(error < (sds*sd + mu))[0]
 	print('Removed ' + str(X.shape[0] - goodRows.shape[0]) + ' training samples.')
-	newTheta = trainLogisticRegression(data[goodRows,:], order, reg)
+	newTheta = trainLogisticRegression(data[goodRows,:], order, reg, scaler)
 	newMu = np.mean(np.absolute(predictProb(X[goodRows,:], newTheta) - y[goodRows,:]))
 	print('Average abs(error) after outlier removal: ' + str(newMu))
 	return newTheta
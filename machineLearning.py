@@ -4,6 +4,8 @@ Utility functions for machine learning
 
 import numpy as np
 
+import instrumentation
+
 def matrix(twoDList):
 	# Expects a 2 dimension python list
 	# Returns a numpy matrix with float64 types
@@ -36,19 +38,83 @@ def addBiasCol(X):
 	m = X.shape[0]
 	return np.concatenate((np.ones((m,1)),X), axis=1)
 
+def newScaler(n):
+	# Returns a feature scaler for n features which hasn't seen any data
+	# scaler: {'count': number of rows seen, 'mean': col means, 'M2': col sums of squared differences from the mean}
+
+	return {'count': 0, 'mean': np.zeros(n), 'M2': np.zeros(n)}
+
+def updateScaler(scaler, X):
+	# Merges the column statistics of the chunk X into scaler
+	# Uses the parallel form of Welford's algorithm, so chunks can be any size and only one pass is needed
+	# Returns scaler
+
+	m = X.shape[0]
+	if m == 0:
+		return scaler
+	chunkMean = np.mean(X, axis=0)
+	chunkM2 = np.sum((X - chunkMean)**2, axis=0)
+	count = scaler['count'] + m
+	delta = chunkMean - scaler['mean']
+	scaler['mean'] = scaler['mean'] + delta * (float(m) / count)
+	scaler['M2'] = scaler['M2'] + chunkM2 + delta**2 * (float(scaler['count']) * m / count)
+	scaler['count'] = count
+	return scaler
+
+def fitScaler(X, chunkSize=10000):
+	# Builds a scaler from X, reading chunkSize rows at a time
+	# X can be a memory mapped matrix which doesn't fit in memory
+
+	scaler = newScaler(X.shape[1])
+	for i in range(0, X.shape[0], chunkSize):
+		updateScaler(scaler, X[i:i+chunkSize])
+	return scaler
+
+def getScalerStats(scaler):
+	# Returns [mu, sigma] (col means and standard deviations)
+	# Columns with zero variance get sigma = 1 so they map to 0 instead of nan
+
+	sigma = np.sqrt(scaler['M2'] / max(scaler['count'], 1))
+	sigma[sigma == 0] = 1
+	return [scaler['mean'], sigma]
+
+def applyScaler(scaler, X, out=None):
+	# Returns (X - mu) / sigma
+	# out: matrix to write the result into, pass X itself to normalize in place
+
+	mu, sigma = getScalerStats(scaler)
+	out = np.subtract(X, mu, out=out)
+	return np.divide(out, sigma, out=out)
+
+def getScaledBatches(scaler, X, batchSize=10000):
+	# Generator which normalizes X lazily, batchSize rows at a time
+
+	for i in range(0, X.shape[0], batchSize):
+		yield applyScaler(scaler, X[i:i+batchSize])
+
+def storeScaler(scaler, fName):
+	# Stores a scaler in a .npz file
+
+	np.savez(fName, count=scaler['count'], mean=scaler['mean'], M2=scaler['M2'])
+
+def readScaler(fName):
+	# Reads a scaler from a .npz file
+
+	with np.load(fName) as stored:
+		return {'count': int(stored['count']), 'mean': stored['mean'], 'M2': stored['M2']}
+
 def normalize(X):
 	# Maps all of the features to the same range
 	# Each new_feature = (old_feature - col_mean) / (col_sd)
 
-	mu = np.mean(X, axis=0)
-	sigma = np.std(X, axis=0)
-	Xnorm = (X - mu) / sigma
-	return Xnorm, mu, sigma
+	scaler = fitScaler(X)
+	mu, sigma = getScalerStats(scaler)
+	return applyScaler(scaler, X), mu, sigma
 
 def undoNormalizeTheta(theta, mu, sigma):
 	# Adjusts theta coefficients so they correspond to the pre-normalized x values
 
-	theta[1:,0] = theta[1:,0] / sigma
+	theta[1:,:] = theta[1:,:] / sigma[:,None]
 	theta[0,:] = theta[0,:] - mu.dot(theta[1:,:])
 	return theta
 
@@ -77,17 +143,63 @@ def expandFeatures(X, degree):
 
 	return recExpandFeatures(X, [], degree)
 
-def gradientDescent(X, y, theta, f_cost, alpha, reg, nIterations):
+def isRecordedIteration(i, nIterations, recordEvery):
+	# Returns True if the cost is recorded on iteration i: every recordEvery-th iteration and the last one
+
+	return i % recordEvery == 0 or i == nIterations - 1
+
+def getFuncLogProgress(fName):
+	# Returns a training callback which appends 'iteration<tab>cost' to fName on every recorded iteration
+
+	def logProgress(iteration, cost, theta):
+		with open(fName, 'a') as outFile:
+			outFile.write(str(iteration) + '\t' + repr(float(cost)) + '\n')
+		return False
+
+	return logProgress
+
+def getFuncCancelOn(event):
+	# Returns a training callback which stops training once event (a threading.Event) is set
+
+	def cancelOn(iteration, cost, theta):
+		return event.is_set()
+
+	return cancelOn
+
+def combineCallbacks(fList_callback):
+	# Returns a training callback which calls every callback in the list and stops if any of them asks to
+
+	def callback(iteration, cost, theta):
+		isStopped = False
+		for f_callback in fList_callback:
+			isStopped = f_callback(iteration, cost, theta) or isStopped
+		return isStopped
+
+	return callback
+
+@instrumentation.timed('machineLearning.gradientDescent')
+def gradientDescent(X, y, theta, f_cost, alpha, reg, nIterations, recordEvery=1, f_callback=None):
 	# Returns [theta, costHistory]
 	# theta is adjusted on each iteration by:
 		# theta_j = theta_j - alpha * grad_j
 		# *Note that all theta coefficients are updated simaltaneously
+	# recordEvery: the cost is only computed on every recordEvery-th iteration and the last one,
+	#	the other iterations only compute the gradient
+	# f_callback: called as f_callback(iteration, cost, theta) on each recorded iteration,
+	#	training stops early if it returns True
+	# costHistory has the cost of each recorded iteration
 
-	costHistory = np.zeros(nIterations)
+	costHistory = []
 	for i in range(0, nIterations):
-		costHistory[i], grad = f_cost(X, y, theta, reg)
+		isRecorded = isRecordedIteration(i, nIterations, recordEvery)
+		J, grad = f_cost(X, y, theta, reg, isRecorded)
 		theta = theta - alpha * grad
-	return theta, costHistory
+		if isRecorded:
+			costHistory.append(J)
+			if f_callback and f_callback(i, J, theta):
+				break
+	instrumentation.increment('machineLearning.gradientDescent.iterations', i + 1 if nIterations > 0 else 0)
+	return theta, np.array(costHistory)
 
 def sigmoid(Z):
 	# Expects a matrix Z
@@ -0,0 +1,216 @@
+'''
+Functions responsible for packaging trained models so they can be stored, loaded and used for prediction
+A model artifact is an uncompressed .npz of coefficient matrices plus a small json manifest next to it
+'''
+
+import os
+import json
+import struct
+import hashlib
+import zipfile
+from datetime import date
+
+import numpy as np
+
+import storage
+import machineLearning
+import linearRegression
+import logisticRegression
+import neuralNetwork
+import ensemble
+
+formatVersion = 1
+modelTypes = ['linear', 'logistic', 'neuralNetwork', 'ensemble']
+verifiedArtifacts = {} # {file key (see getFileKey): sha256} of the artifacts this process stored or verified
+
+def newModel(modelType, Theta, order=1, scaler=None, fingerprint=None, columns=None):
+	# Packages a trained model
+	# modelType: one of modelTypes
+	# Theta: theta (linear, logistic), list of coefficient matrices (neuralNetwork) or list of those (ensemble)
+	# order: polynomial expansion order of the features
+	# scaler: normalization statistics for the expanded features (see machineLearning.fitScaler),
+	#	None if Theta already works on unnormalized features
+	# fingerprint: the training scheme's fingerprint (see trainingData.getSchemeFingerprint)
+	# Returns a model: {'type', 'Theta', 'order', 'scaler', 'fingerprint', 'columns'}
+
+	if not modelType in modelTypes:
+		raise ValueError('Unknown model type: ' + str(modelType))
+	return {'type': modelType, 'Theta': Theta, 'order': order, 'scaler': scaler, 'fingerprint': fingerprint, \
+		'columns': columns}
+
+def getManifestName(fName):
+	# Returns the name of the json manifest stored alongside a model artifact
+
+	return fName + '.json'
+
+def getFileHash(fName):
+	# Returns the sha256 hash of a file
+
+	hasher = hashlib.sha256()
+	with open(fName, 'rb') as inFile:
+		for block in iter(lambda: inFile.read(1 << 20), b''):
+			hasher.update(block)
+	return hasher.hexdigest()
+
+def getFileKey(fName):
+	# Returns a key which changes when a file is replaced or modified: [device, inode, modification time, size]
+	#	A file keeps its key when it's renamed, so an artifact stored next to its final name and moved into place
+	#	is still known to be verified
+
+	status = os.stat(fName)
+	return (status.st_dev, status.st_ino, status.st_mtime_ns, status.st_size)
+
+def isVerified(fName, sha256):
+	# Returns whether the artifact fName has the hash sha256, hashing it only if this process hasn't since it changed
+
+	key = getFileKey(fName)
+	if verifiedArtifacts.get(key) != sha256:
+		if getFileHash(fName) != sha256:
+			return False
+		verifiedArtifacts[key] = sha256
+	return True
+
+def getArrays(model):
+	# Flattens a model's coefficient matrices into {arrayName: matrix}
+	# Returns [arrays, layers]
+
+	arrays = {}
+	if model['type'] == 'linear' or model['type'] == 'logistic':
+		arrays['theta'] = model['Theta']
+		layers = None
+	elif model['type'] == 'neuralNetwork':
+		for l in range(0, len(model['Theta'])):
+			arrays['Theta_' + str(l)] = model['Theta'][l]
+		layers = [model['Theta'][0].shape[0] - 1] + [Theta_l.shape[1] for Theta_l in model['Theta']]
+	else:
+		for k in range(0, len(model['Theta'])):
+			for l in range(0, len(model['Theta'][k])):
+				arrays['Theta' + str(k) + '_' + str(l)] = model['Theta'][k][l]
+		layers = [model['Theta'][0][0].shape[0] - 1] + [Theta_l.shape[1] for Theta_l in model['Theta'][0]]
+	if model['scaler']:
+		arrays['scalerMean'] = model['scaler']['mean']
+		arrays['scalerM2'] = model['scaler']['M2']
+	return [arrays, layers]
+
+def storeModel(model, fName):
+	# Stores a model as an artifact: fName (.npz) and its manifest (fName + '.json')
+	# Returns the manifest
+
+	arrays, layers = getArrays(model)
+	np.savez(fName, **arrays) # Uncompressed, so the arrays can be memory mapped
+	manifest = {'formatVersion': formatVersion, 'type': model['type'], 'order': model['order'], 'layers': layers, \
+		'fingerprint': model['fingerprint'], 'columns': model['columns'], 'arrays': sorted(arrays.keys()), \
+		'scalerCount': model['scaler']['count'] if model['scaler'] else None, \
+		'nMembers': len(model['Theta']) if model['type'] == 'ensemble' else None, \
+		'created': date.today().isoformat(), 'sha256': getFileHash(fName)}
+	verifiedArtifacts[getFileKey(fName)] = manifest['sha256']
+	with open(getManifestName(fName), 'w') as outFile:
+		json.dump(manifest, outFile)
+	return manifest
+
+def mapNpz(fName, mmapMode='r'):
+	# Memory maps every array in an uncompressed .npz file, without reading their data
+	# Returns {arrayName: matrix}
+
+	arrays = {}
+	with zipfile.ZipFile(fName) as archive, open(fName, 'rb') as inFile:
+		for info in archive.infolist():
+			if info.compress_type != zipfile.ZIP_STORED:
+				raise ValueError(fName + ' is compressed and can\'t be memory mapped')
+			# Skip the zip local file header to reach the .npy data
+			inFile.seek(info.header_offset + 26)
+			nameLength, extraLength = struct.unpack('<HH', inFile.read(4))
+			inFile.seek(info.header_offset + 30 + nameLength + extraLength)
+			version = np.lib.format.read_magic(inFile)
+			if version == (1, 0):
+				shape, fortranOrder, dtype = np.lib.format.read_array_header_1_0(inFile)
+			else:
+				shape, fortranOrder, dtype = np.lib.format.read_array_header_2_0(inFile)
+			name = info.filename[:-4] # remove .npy
+			if int(np.prod(shape)) == 0:
+				arrays[name] = np.empty(shape, dtype=dtype)
+			else:
+				arrays[name] = np.memmap(fName, dtype=dtype, mode=mmapMode, offset=inFile.tell(), shape=shape, \
+					order='F' if fortranOrder else 'C')
+	return arrays
+
+def readModel(fName, fingerprint=None, verify=True, mmapMode='r'):
+	# Reads a model artifact stored by storeModel
+	# fingerprint: if given, the model must have been trained on data from this scheme
+	# verify: check the .npz against the hash in the manifest
+	#	Once per process for each version of the file, so reloading an unchanged artifact doesn't read it again
+	# mmapMode: 'r' memory maps the coefficients read only, None loads them into memory
+	# Returns a model (see newModel)
+
+	manifest = storage.readFromJson(getManifestName(fName))
+	if manifest['formatVersion'] > formatVersion:
+		raise ValueError(fName + ' has format version ' + str(manifest['formatVersion']) + \
+			', newer than ' + str(formatVersion))
+	if fingerprint and manifest['fingerprint'] != fingerprint:
+		raise ValueError(fName + ' was trained on scheme ' + str(manifest['fingerprint']) + ', not ' + str(fingerprint))
+	if verify and not isVerified(fName, manifest['sha256']):
+		raise ValueError(fName + ' does not match the hash in its manifest')
+
+	if mmapMode:
+		arrays = mapNpz(fName, mmapMode)
+	else:
+		with np.load(fName) as stored:
+			arrays = dict((name, stored[name]) for name in stored.files)
+
+	nLayers = len(manifest['layers']) - 1 if manifest['layers'] else 0
+	if manifest['type'] == 'linear' or manifest['type'] == 'logistic':
+		Theta = arrays['theta']
+	elif manifest['type'] == 'neuralNetwork':
+		Theta = [arrays['Theta_' + str(l)] for l in range(0, nLayers)]
+	else:
+		Theta = [[arrays['Theta' + str(k) + '_' + str(l)] for l in range(0, nLayers)] for k in range(0, manifest['nMembers'])]
+
+	scaler = None
+	if manifest['scalerCount'] is not None:
+		scaler = {'count': manifest['scalerCount'], 'mean': arrays['scalerMean'], 'M2': arrays['scalerM2']}
+	return newModel(manifest['type'], Theta, manifest['order'], scaler, manifest['fingerprint'], manifest['columns'])
+
+def getFeatures(model, X):
+	# Expands and normalizes raw features (X) the same way they were when the model was trained
+	# Returns a design matrix, with the constant column for linear and logistic models and without it for networks
+
+	X = machineLearning.expandFeatures(X, model['order'])
+	if model['scaler']:
+		machineLearning.applyScaler(model['scaler'], X[:,1:], X[:,1:])
+	if model['type'] == 'linear' or model['type'] == 'logistic':
+		return X
+	return X[:,1:]
+
+def predictModel(model, X):
+	# Expects a model and a matrix of raw features (X), one row per example
+	# Returns the model's output for each row:
+	#	linear -> predicted value, logistic -> probability, networks -> output layer probabilities
+
+	X = getFeatures(model, X)
+	if model['type'] == 'linear':
+		return linearRegression.predict(X, model['Theta'])
+	elif model['type'] == 'logistic':
+		return logisticRegression.predictProb(X, model['Theta'])
+	elif model['type'] == 'neuralNetwork':
+		return neuralNetwork.forwardPropagation(X, model['Theta'])
+	else:
+		if not 'stacked' in model:
+			model['stacked'] = ensemble.stackMembers(model['Theta'])
+		return ensemble.averageMembers(X, model['stacked'], len(model['Theta']))
+
+def main():
+	# Test Module Functionality
+
+	data = machineLearning.matrix(storage.read2DListFromCsv('./data/trainingData/distanceRankCategory.csv'))
+	n = data.shape[1] - 1
+	K = int(np.max(data[:,-1]) + 1)
+	scaler = machineLearning.fitScaler(data[:,:-1])
+	X = machineLearning.applyScaler(scaler, data[:,:-1])
+	Theta = neuralNetwork.miniBatchDescent(X, neuralNetwork.getYMatrix(data[:,-1:], K), \
+		neuralNetwork.initializeTheta([n, 10, K]), 0)[0]
+	storeModel(newModel('neuralNetwork', Theta, 1, scaler), './data/models/distanceRankCategory.npz')
+	model = readModel('./data/models/distanceRankCategory.npz')
+	print(neuralNetwork.getMetricsFromOutput(predictModel(model, data[:,:-1]), data[:,-1:])['accuracy'])
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
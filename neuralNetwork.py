@@ -7,108 +7,274 @@ import numpy as np
 import storage
 import trainingData
 import machineLearning
+import instrumentation
 
 def sigmoidGradient(Z):
 	# Expects Z as a matrix
 	# Returns the derivative of the sigmoid function evaluated at Z
 
-	return machineLearning.sigmoid(Z) * (1 - machineLearning.sigmoid(Z))
+	S = machineLearning.sigmoid(Z)
+	return S * (1 - S)
 
 def getYMatrix(y, K):
 	# Converts a column vector of labels to a matrix
 	#	Each column corresponds to one category of labels
 	# Assumes y contains values 0,1,...,K-1 
 
-	m = y.shape[0]
 	if K == 1:
-		Y = y
-	else:
-		Y = np.zeros((m, K))
-		for i in range(0, m):
-			Y[i,int(y[i,0])] = 1
-	return Y
-
-def cost(X, Y, Theta, reg):
+		return y
+	return (y.astype(int) == np.arange(K)).astype(np.float64)
+
+def getLabels(H):
+	# Converts a matrix of output layer activations to a column vector of labels
+	# Inverse of getYMatrix: the most active column, or a rounded probability if there is only one column
+
+	if H.shape[1] > 1:
+		return np.argmax(H, axis=1)[:,None]
+	return np.round(H, 0)
+
+def newWorkspace(layers, m):
+	# Expects a list of layer sizes (layers) and the number of training examples (m)
+	# Returns a dictionary of buffers reused by every call to cost, so no matrix is allocated per iteration
+	#	A[i]: activations of layer i without the bias col (A[0] is X itself and isn't stored)
+	#	D[i]: errors of layer i, S[i]: sigmoid gradient of hidden layer i
+	#	Grad[i], R[i]: gradient and regularization term with the same shape as Theta[i]
+	#	T: scratch space for the output layer cost
+
+	L = len(layers)
+	workspace = {'layers': list(layers), 'm': m, 'A': [None], 'D': [None], 'S': [None]}
+	for i in range(1, L):
+		workspace['A'].append(np.empty((m, layers[i])))
+		workspace['D'].append(np.empty((m, layers[i])))
+		workspace['S'].append(np.empty((m, layers[i])) if i != L-1 else None)
+	workspace['Grad'] = [np.empty((layers[i]+1, layers[i+1])) for i in range(0, L-1)]
+	workspace['R'] = [np.empty((layers[i], layers[i+1])) for i in range(0, L-1)]
+	workspace['T'] = np.empty((m, layers[-1]))
+	return workspace
+
+def getWorkspace(X, Theta, workspace=None):
+	# Returns workspace if it fits this X and Theta, otherwise a new one
+
+	layers = [Theta[0].shape[0]-1] + [Theta_i.shape[1] for Theta_i in Theta]
+	if workspace is None or workspace['m'] != X.shape[0] or workspace['layers'] != layers:
+		workspace = newWorkspace(layers, X.shape[0])
+	return workspace
+
+def sigmoidInPlace(Z):
+	# Maps each element of Z with 1/(1+e^-z) without allocating a new matrix
+
+	np.negative(Z, out=Z)
+	np.exp(Z, out=Z)
+	np.add(Z, 1, out=Z)
+	return np.reciprocal(Z, out=Z)
+
+def cost(X, Y, Theta, reg, workspace=None, withCost=True):
 	# Expects training matrix (X)
 	#	label matrix (Y), 
 	# 	list of coefficient matrices (Theta), 
-	#	and regularization constant (reg)
+	#	regularization constant (reg)
+	#	and optionally a workspace from newWorkspace to reuse
 	# Returns neural network cost and gradient
+	#	*When a workspace is passed, Grad lives in its buffers and is overwritten by the next call
+	# withCost: if False the log pass is skipped, only the gradient is computed and the cost is None
 
 	# Get dimensions
 	m = X.shape[0]
 	L = len(Theta) + 1 # number of layers
-	K = Theta[-1].shape[1] # number of output nodes
+	workspace = getWorkspace(X, Theta, workspace)
+	A = workspace['A']
+	D = workspace['D']
+	S = workspace['S']
+	Grad = workspace['Grad']
+	T = workspace['T']
 
 	# Forward Propogation
-	A = []
-	Z = []
-	A.append(machineLearning.addBiasCol(X))
-	Z.append(None)
+	# The bias col is handled by slicing its row off of Theta instead of prepending ones to A
 	for i in range(1, L):
-		Z.append(A[i-1].dot(Theta[i-1]))
-		A.append(machineLearning.sigmoid(Z[i]))
-		if i != L-1:
-			A[i] = machineLearning.addBiasCol(A[i])
-
+		prev = X if i == 1 else A[i-1]
+		np.dot(prev, Theta[i-1][1:,:], out=A[i])
+		np.add(A[i], Theta[i-1][0,:], out=A[i])
+		sigmoidInPlace(A[i])
+	H = A[-1]
 
 	# Get cost
-	J = np.sum((-Y) * np.log(A[-1]) - (1-Y) * np.log(1-A[-1])) / m
-	# Regularization
-	for i in range(0, L-1):
-		J += (reg / (2*m)) * np.sum(Theta[i][1:,:]**2)
+	# J = -SUM(Y*log(H) + (1-Y)*log(1-H)) / m
+	J = None
+	if withCost:
+		np.log(H, out=T)
+		np.multiply(T, Y, out=T)
+		J = np.sum(T)
+		np.subtract(1, H, out=T)
+		np.log(T, out=T)
+		J += np.sum(T)
+		np.multiply(T, Y, out=T)
+		J -= np.sum(T)
+		J = -J / m
+		# Regularization
+		if reg:
+			for i in range(0, L-1):
+				J += (reg / (2*m)) * np.vdot(Theta[i][1:,:], Theta[i][1:,:])
 	
 	# Get gradient
 	# Backward propagation
-	D = []
-	D.insert(0, A[-1] - Y)
+	# The sigmoid gradient is A*(1-A), reusing the activations from forward propagation
+	np.subtract(H, Y, out=D[-1])
 	for i in range(L-2, 0, -1):
-		Di = D[0].dot(Theta[i][1:,:].transpose()) * sigmoidGradient(Z[i])
-		D.insert(0, Di)
-	D.insert(0, None)
+		np.dot(D[i+1], Theta[i][1:,:].transpose(), out=D[i])
+		np.subtract(1, A[i], out=S[i])
+		np.multiply(S[i], A[i], out=S[i])
+		np.multiply(D[i], S[i], out=D[i])
 
-	Grad = []
 	for i in range(0, L-1):
-		Gradi = A[i].transpose().dot(D[i+1]) / m
+		prev = X if i == 0 else A[i]
+		np.sum(D[i+1], axis=0, out=Grad[i][0,:])
+		np.dot(prev.transpose(), D[i+1], out=Grad[i][1:,:])
+		np.divide(Grad[i], m, out=Grad[i])
 		# Regularization
-		Gradi[1:,:] = Gradi[1:,:] + (reg/m) * Theta[i][1:,:]
-		Grad.append(Gradi)
+		if reg:
+			np.multiply(Theta[i][1:,:], reg/m, out=workspace['R'][i])
+			np.add(Grad[i][1:,:], workspace['R'][i], out=Grad[i][1:,:])
 
 	return J, Grad
 
-def gradientDescent(X, Y, Theta, alpha, reg, nIterations):
+@instrumentation.timed('neuralNetwork.gradientDescent')
+def gradientDescent(X, Y, Theta, alpha, reg, nIterations, recordEvery=1, f_callback=None):
 	# Returns [Theta, costHistory]
 	# Theta is adjusted on each iteration by:
 	# 	Theta[i]_jk = Theta[i]_jk - alpha * grad[i]_jk
-	#	*Note that all Theta coefficients are updated simaltaneously
+	#	*Note that all Theta coefficients are updated simaltaneously, and in place
+	# recordEvery, f_callback: see machineLearning.gradientDescent
 
-	costHistory = np.zeros(nIterations)
+	Theta = [np.array(Theta_i, dtype=np.float64) for Theta_i in Theta]
+	workspace = getWorkspace(X, Theta)
+	costHistory = []
 	for i in range(0, nIterations):
-		costHistory[i], Grad = cost(X, Y, Theta, reg)
-		for i in range(0, len(Theta)):
-			Theta[i] = Theta[i] - alpha * Grad[i]
-	return Theta, costHistory
+		isRecorded = machineLearning.isRecordedIteration(i, nIterations, recordEvery)
+		J, Grad = cost(X, Y, Theta, reg, workspace, isRecorded)
+		for j in range(0, len(Theta)):
+			np.multiply(Grad[j], alpha, out=Grad[j])
+			np.subtract(Theta[j], Grad[j], out=Theta[j])
+		if isRecorded:
+			costHistory.append(J)
+			if f_callback and f_callback(i, J, Theta):
+				break
+	instrumentation.increment('neuralNetwork.gradientDescent.iterations', i + 1 if nIterations > 0 else 0)
+	return Theta, np.array(costHistory)
+
+@instrumentation.timed('neuralNetwork.miniBatchDescent')
+def miniBatchDescent(X, Y, Theta, reg, alpha=.001, batchSize=128, nEpochs=200, method='adam', \
+	Xval=None, Yval=None, patience=10, checkpoint_fName=None, recordEvery=1, f_callback=None):
+	# Trains Theta on shuffled mini batches of (X, Y)
+	# method: 'adam', 'momentum' or 'sgd'
+	# Xval, Yval: validation set, if given training stops early once the validation loss
+	#	hasn't improved for patience epochs, and the best Theta seen is returned
+	# checkpoint_fName: if given, the best Theta is also saved to this .npz file whenever it improves
+	# recordEvery: the training cost is only computed on every recordEvery-th epoch and the last one
+	# f_callback: called as f_callback(epoch, cost, Theta) on each recorded epoch, training stops if it returns True
+	# Returns [Theta, costHistory, validationHistory] with one cost per recorded epoch and one validation cost per epoch
+
+	beta1 = .9
+	beta2 = .999
+	epsilon = 1e-8
+	m = X.shape[0]
+	batchSize = min(batchSize, m)
+	Theta = [np.array(Theta_i, dtype=np.float64) for Theta_i in Theta]
+	velocity = [np.zeros(Theta_i.shape) for Theta_i in Theta]
+	squares = [np.zeros(Theta_i.shape) for Theta_i in Theta]
+	step = [np.empty(Theta_i.shape) for Theta_i in Theta]
+
+	# Batches are gathered into preallocated buffers, the last (smaller) batch gets its own
+	batchX = np.empty((batchSize, X.shape[1]))
+	batchY = np.empty((batchSize, Y.shape[1]))
+	workspaces = {batchSize: getWorkspace(batchX, Theta)}
+
+	costHistory = []
+	validationHistory = np.zeros(nEpochs)
+	bestLoss = np.inf
+	bestTheta = [Theta_i.copy() for Theta_i in Theta]
+	nBadEpochs = 0
+	t = 0
+	for epoch in range(0, nEpochs):
+		order = np.random.permutation(m)
+		isRecorded = machineLearning.isRecordedIteration(epoch, nEpochs, recordEvery)
+		epochCost = 0.0
+		for begin in range(0, m, batchSize):
+			rows = order[begin:begin+batchSize]
+			n = rows.shape[0]
+			if not n in workspaces:
+				workspaces[n] = getWorkspace(batchX[:n], Theta)
+			np.take(X, rows, axis=0, out=batchX[:n])
+			np.take(Y, rows, axis=0, out=batchY[:n])
+			J, Grad = cost(batchX[:n], batchY[:n], Theta, reg * n / m, workspaces[n], isRecorded)
+			if isRecorded:
+				epochCost += J * n / m
+
+			t += 1
+			instrumentation.increment('neuralNetwork.miniBatchDescent.iterations')
+			for j in range(0, len(Theta)):
+				if method == 'adam':
+					velocity[j] *= beta1
+					velocity[j] += (1 - beta1) * Grad[j]
+					squares[j] *= beta2
+					squares[j] += (1 - beta2) * np.square(Grad[j], out=step[j])
+					# step = alpha * (velocity / (1-beta1^t)) / (sqrt(squares / (1-beta2^t)) + epsilon)
+					np.divide(squares[j], 1 - beta2**t, out=step[j])
+					np.sqrt(step[j], out=step[j])
+					step[j] += epsilon
+					np.divide(velocity[j], step[j], out=step[j])
+					step[j] *= alpha / (1 - beta1**t)
+				elif method == 'momentum':
+					velocity[j] *= beta1
+					velocity[j] += Grad[j]
+					np.multiply(velocity[j], alpha, out=step[j])
+				else:
+					np.multiply(Grad[j], alpha, out=step[j])
+				Theta[j] -= step[j]
+		instrumentation.increment('neuralNetwork.miniBatchDescent.epochs')
+		if isRecorded:
+			costHistory.append(epochCost)
+			if f_callback and f_callback(epoch, epochCost, Theta):
+				validationHistory = validationHistory[:epoch]
+				break
+
+		if Xval is None:
+			continue
+		validationHistory[epoch] = getLoss(Xval, Yval, Theta)
+		if validationHistory[epoch] < bestLoss:
+			bestLoss = validationHistory[epoch]
+			bestTheta = [Theta_i.copy() for Theta_i in Theta]
+			nBadEpochs = 0
+			if checkpoint_fName:
+				np.savez(checkpoint_fName, *bestTheta)
+		else:
+			nBadEpochs += 1
+			if nBadEpochs >= patience:
+				return [bestTheta, np.array(costHistory), validationHistory[:epoch+1]]
+
+	if Xval is None or bestLoss == np.inf: # No validation, or cancelled before the first one
+		return [Theta, np.array(costHistory), validationHistory]
+	return [bestTheta, np.array(costHistory), validationHistory]
+
+def getLoss(X, Y, Theta):
+	# Returns the unregularized neural network cost of Theta on (X, Y) without computing a gradient
+
+	H = np.clip(forwardPropagation(X, Theta), 1e-15, 1 - 1e-15)
+	return -np.sum(Y * np.log(H) + (1-Y) * np.log(1-H)) / X.shape[0]
 
 def forwardPropagation(X, Theta):
 	# predict yHats
 
-	A = machineLearning.addBiasCol(X)
+	A = X
 	for i in range(0, len(Theta)):
-		Z = A.dot(Theta[i])
-		A = machineLearning.sigmoid(Z)
-		if i != len(Theta)-1:
-			A = machineLearning.addBiasCol(A)
+		Z = A.dot(Theta[i][1:,:])
+		Z += Theta[i][0,:]
+		A = sigmoidInPlace(Z)
 	return A
 
 def predict(X, Theta):
 	# classify yHat
 
-	yHat = forwardPropagation(X, Theta)
-	if yHat.shape[1] > 1:
-		yHat = np.argmax(yHat, axis=1)
-		return np.transpose([yHat])
-	else:
-		return np.round(yHat, 0)
+	return getLabels(forwardPropagation(X, Theta))
 
 def accuracy(X, y, Theta):
 	# Returns percent of training examples Theta predicts correctly
@@ -126,33 +292,84 @@ def accuracyWithin(X, y, Theta, acceptedError):
 	nGoodResults = np.where(groupError <= acceptedError)[0].shape[0]
 	return float(nGoodResults) / X.shape[0]
 
-def trainNeuralNetwork(data, layers, reg):
+def getMetricsFromOutput(H, y, within=[1]):
+	# Expects output layer activations (H) from forwardPropagation and a column vector of labels (y)
+	# within: list of accepted errors (in categories) for the accuracyWithin metrics
+	# Returns a dictionary with every metric computed from the same output:
+	#	{'accuracy', 'accuracyWithin<k>' for each k in within, 'logLoss', 'confusionMatrix'}
+	#	confusionMatrix[i,j] = number of examples with label i classified as j
+
+	m = y.shape[0]
+	K = max(H.shape[1], 2)
+	p = getLabels(H)
+	y = y.astype(int)
+	groupError = np.absolute(p - y)
+	metrics = {'accuracy': np.mean(groupError == 0)}
+	for acceptedError in within:
+		metrics['accuracyWithin' + str(acceptedError)] = np.mean(groupError <= acceptedError)
+	H = np.clip(H, 1e-15, 1 - 1e-15)
+	if H.shape[1] > 1:
+		metrics['logLoss'] = -np.mean(np.log(H[np.arange(m), y[:,0]]))
+	else:
+		metrics['logLoss'] = -np.mean(y * np.log(H) + (1-y) * np.log(1-H))
+	metrics['confusionMatrix'] = np.bincount(y[:,0] * K + p[:,0].astype(int), minlength=K*K).reshape((K, K))
+	return metrics
+
+def evaluate(X, y, Theta, within=[1]):
+	# Runs forward propagation once and computes every metric from its output
+	# Returns a dictionary of metrics (see getMetricsFromOutput)
+
+	return getMetricsFromOutput(forwardPropagation(X, Theta), y, within)
+
+def initializeTheta(layers):
+	# Expects a list of layer sizes (layers)
+	# Returns a list of coefficient matrices initialized to random values
+	#	Theta[i] has shape (layers[i]+1)x(layers[i+1]), the extra row is for the bias col
+	# Values are uniform in [-e, e] with e = sqrt(6 / (layers[i] + layers[i+1]))
+	#	so they are centered on 0 and scaled to the size of the layers
+
+	Theta = []
+	for i in range(0, len(layers)-1):
+		epsilon = np.sqrt(6.0 / (layers[i] + layers[i+1]))
+		Theta.append(np.random.uniform(-epsilon, epsilon, (layers[i]+1, layers[i+1])))
+	return Theta
+
+def trainNeuralNetwork(data, layers, reg, scaler=None):
 	# data is numpy matrix
 	# layers is a list of layer sizes
 		# layers[0] = number of features (not including bias col)
 		# layers[-1] = number of labels
+	# scaler: normalization statistics for the features, None -> computed from data
 
 	# Set up X and y
-	X = data[:,:-1]
-	X, mu, sigma = machineLearning.normalize(X)
+	if scaler is None:
+		scaler = machineLearning.fitScaler(data[:,:-1])
+	X = machineLearning.applyScaler(scaler, data[:,:-1])
+	mu, sigma = machineLearning.getScalerStats(scaler)
 	y = data[:,-1:]
 	Y = getYMatrix(y, layers[-1])
 
-	# Initialize Theta to random values
-	Theta = []
-	for i in range(0, len(layers)-1):
-		Theta.append(np.random.rand(layers[i]+1, layers[i+1]))
+	# Hold out a validation set for early stopping
+	rows = np.random.permutation(X.shape[0])
+	trainRows, validationRows = machineLearning.partitionData(rows[:,None], [.8, .2])
+	trainRows = trainRows[:,0]
+	validationRows = validationRows[:,0]
 
-	Theta, costHistory = gradientDescent(X, Y, Theta, .05, reg, 5000)
+	Theta = initializeTheta(layers)
+	Theta, costHistory, validationHistory = miniBatchDescent(X[trainRows,:], Y[trainRows,:], Theta, reg, \
+		Xval=X[validationRows,:], Yval=Y[validationRows,:])
 	if True:
+		print('Progression of cost through ' + str(len(costHistory)) + ' epochs:')
 		print(costHistory[0])
 		print(costHistory[int(len(costHistory)/2)])
 		print(costHistory[-1])
+		print('Best validation cost: ' + str(np.min(validationHistory)))
 
 	# Output
-	print('Training Accuracy: ' + str(accuracy(X, y, Theta)))
-	print('Training Accuracy within 0 categories: ' + str(accuracyWithin(X, y, Theta, 0)))
-	print('Training Accuracy withing 1 category: ' + str(accuracyWithin(X, y, Theta, 1)))
+	metrics = evaluate(X, y, Theta, [1])
+	print('Training Accuracy: ' + str(metrics['accuracy']))
+	print('Training Accuracy within 1 category: ' + str(metrics['accuracyWithin1']))
+	print('Training Log Loss: ' + str(metrics['logLoss']))
 	Theta[0] = machineLearning.undoNormalizeTheta(Theta[0], mu, sigma)
 	return Theta
 
@@ -163,8 +380,10 @@ def trainWithoutOutliers(data, layers, reg, sds):
 	# Theoretically this could improve performance on a test set 
 
 	# Set up
-	Theta = trainNeuralNetwork(data, layers, reg)
+	# Both trainings share the scaler from the full data set
 	X = data[:,:-1]
+	scaler = machineLearning.fitScaler(X)
+	Theta = trainNeuralNetwork(data, layers, reg, scaler)
 	Y = getYMatrix(data[:,-1:], layers[-1])
 
 	error = np.absolute(forwardPropagation(X, Theta) - Y)
@@ -177,7 +396,7 @@ def trainWithoutOutliers(data, layers, reg, sds):
 	print('Removed ' + str(outlierRows.shape[0]) + ' training samples.')
 	goodRows = np.arange(0, X.shape[0])
 	goodRows = np.delete(goodRows, outlierRows, axis=0)
-	newTheta = trainNeuralNetwork(data[goodRows,:], layers, reg)
+	newTheta = trainNeuralNetwork(data[goodRows,:], layers, reg, scaler)
 	newMu = np.mean(np.absolute(forwardPropagation(X[goodRows,:], newTheta) - Y[goodRows,:]))
 	print('Average abs(error) after outlier removal: ' + str(newMu))
 	return newTheta
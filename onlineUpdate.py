@@ -0,0 +1,110 @@
+'''
+Functions responsible for updating a stored model with newly ingested races instead of retraining it
+The stored coefficients are the starting point for a bounded number of optimizer steps over the new rows
+	mixed with a replayed sample of the rows the model was trained on, so it doesn't forget them
+'''
+
+import os
+import time
+
+import numpy as np
+
+import storage
+import dataPreparation
+import trainingData
+import machineLearning
+import evaluation
+import models
+
+# Settings for the optimizer steps of an update, see evaluation.fitModel
+#	Linear and logistic models take nIterations full batch steps, networks take nEpochs epochs of mini batches
+defaultUpdateConfig = {'alpha': .001, 'reg': 0, 'nIterations': 200, 'batchSize': 128, 'nEpochs': 5, 'method': 'adam'}
+
+def getReplaySample(history, nRows, seed=None):
+	# Expects a matrix of earlier rows (may be memory mapped, see storage.readTrainingSet)
+	# Returns nRows rows drawn at random (with replacement), read in file order
+
+	random = np.random.RandomState(seed)
+	rows = np.sort(random.randint(0, history.shape[0], nRows))
+	return np.asarray(history[rows,:], dtype=np.float64)
+
+def updateModel(model, newData, history=None, config=None, replayRatio=1., seed=None):
+	# Expects a model (see models.newModel) and a numpy matrix of X and y values for the new races
+	# history: matrix of rows the model was trained on, None -> only newData is used
+	# config: overrides for defaultUpdateConfig
+	# replayRatio: rows replayed from history per new row
+	# The model's scaler is kept as it is, so the stored coefficients keep their meaning
+	# Returns the updated model, the given model is not modified
+
+	config = dict(defaultUpdateConfig, **(config or {}))
+	data = newData
+	if history is not None and history.shape[0] > 0 and replayRatio > 0:
+		replay = getReplaySample(history, int(round(replayRatio * newData.shape[0])), seed)
+		data = np.concatenate((newData, replay), axis=0)
+	X = models.getFeatures(model, data[:,:-1])
+	y = data[:,-1:]
+
+	if model['type'] == 'linear' or model['type'] == 'logistic':
+		config['model'] = model['type']
+		Theta = evaluation.fitModel(config, X, y, model['Theta'])[0]
+	else:
+		# evaluation.fitModel expects a constant column, which it drops for networks
+		X = machineLearning.addBiasCol(X)
+		config['model'] = 'neuralNetwork'
+		if model['type'] == 'neuralNetwork':
+			config['nLabels'] = model['Theta'][-1].shape[1]
+			Theta = evaluation.fitModel(config, X, y, model['Theta'])[0]
+		else:
+			config['nLabels'] = model['Theta'][0][-1].shape[1]
+			Theta = [evaluation.fitModel(config, X, y, member)[0] for member in model['Theta']]
+	return models.newModel(model['type'], Theta, model['order'], model['scaler'], model['fingerprint'], model['columns'])
+
+def replaceModel(model, fName):
+	# Stores a model over an existing artifact
+	# The new artifact is written next to the old one and moved into place, so readers never see a partial file
+	# Returns the manifest
+
+	temp_fName = fName + '.' + str(os.getpid()) + '.tmp.npz'
+	manifest = models.storeModel(model, temp_fName)
+	os.replace(temp_fName, fName)
+	os.replace(models.getManifestName(temp_fName), models.getManifestName(fName))
+	return manifest
+
+def updateArtifact(model_fName, f_scheme, raceIds, history_fName=None, config=None, replayRatio=1., seed=None):
+	# Updates a stored model with the rows of newly ingested races
+	# f_scheme: the trainingData scheme the model was trained on, raceIds: the new races (see dataPreparation.updateNewRaces)
+	# history_fName: binary training set of the scheme (see trainingData.storeScheme) to replay rows from
+	#	The new rows are appended to it afterwards, so later updates replay them too
+	# Returns [model, nNewRows]
+
+	fingerprint = trainingData.getSchemeFingerprint(f_scheme)
+	model = models.readModel(model_fName, fingerprint, mmapMode=None)
+	newData = machineLearning.matrix(f_scheme(raceIds=raceIds))
+	if newData.shape[0] == 0:
+		return [model, 0]
+
+	history = None
+	if history_fName:
+		history, header = storage.readTrainingSet(history_fName)
+		if header['fingerprint'] != fingerprint:
+			raise ValueError(history_fName + ' was built by scheme ' + str(header['fingerprint']) + ', not ' + fingerprint)
+	model = updateModel(model, newData, history, config, replayRatio, seed)
+	del history # Release the memory map before the training set grows
+
+	replaceModel(model, model_fName)
+	if history_fName:
+		storage.appendToTrainingSet(newData, history_fName)
+	return [model, newData.shape[0]]
+
+def main():
+	# Test Module Functionality
+
+	started = time.time()
+	raceIds = dataPreparation.updateNewRaces()
+	model, nNewRows = updateArtifact('./data/models/distanceRankCategory.npz', trainingData.collectDistanceRankCategory, \
+		raceIds, './data/trainingData/distanceRankCategory.npy')
+	print('Updated with ' + str(nNewRows) + ' rows from ' + str(len(raceIds)) + ' races in ' + \
+		str(time.time() - started) + ' seconds')
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
@@ -0,0 +1,321 @@
+'''
+Functions responsible for running the whole system end to end as a graph of cached stages
+fetch rankings -> fetch races -> build race catalogue -> rate athletes -> collect each scheme -> train -> evaluate
+A stage only runs when the content of one of its inputs changed, its version changed or one of its outputs is missing
+Stages which don't depend on each other (for example the training schemes) run in parallel
+'''
+
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import multiprocessing
+
+import numpy as np
+
+import storage
+import dataPreparation
+import trainingData
+import ratings
+import machineLearning
+import evaluation
+import models
+
+pipelineState_fName = './data/pipelineState.json'
+trainingData_directory = './data/trainingData/'
+models_directory = './data/models/'
+evaluations_directory = './data/evaluations/'
+
+# Training configuration for each scheme (see evaluation.fitModel), 'order' is the polynomial expansion order
+networkConfig = {'model': 'neuralNetwork', 'order': 1, 'hidden': [10], 'alpha': .001, 'reg': 0, 'batchSize': 128, \
+	'nEpochs': 50}
+regressionConfig = {'model': 'linear', 'order': 1, 'alpha': .01, 'reg': 0, 'nIterations': 5000}
+schemeConfigs = {
+	'collectIndividualPercentBack': regressionConfig,
+	'collectIndividualPercentBackWithFisPoints': regressionConfig,
+	'collectIndividualPercentBackWithFisPointsWithoutOutliers': regressionConfig,
+	'collectAllRankCategory': networkConfig,
+	'collectDistanceRankCategory': networkConfig,
+	'collectDistanceRatingCategory': networkConfig,
+}
+
+# ______________________________________________________________________
+# Stage functions
+# Each runs in its own process or the main process, so they only take names and file names
+def isQueueEmpty(fName):
+	# Returns True if a work queue doesn't exist or has no ids, so its fetch stage doesn't have to go to the web
+
+	return not os.path.exists(fName) or not storage.readFromJson(fName)
+
+def runFetchRankings():
+	if not isQueueEmpty(dataPreparation.rankingIdsWorkQueue_fName):
+		dataPreparation.updateNewRankings()
+
+def runFetchRaces():
+	if not isQueueEmpty(dataPreparation.raceIdsWorkQueue_fName):
+		dataPreparation.updateNewRaces()
+
+def runBuildCatalogue():
+	dataPreparation.recomputeAverageFisPoints()
+
+def runRateAthletes():
+	ratings.updateStoredRatings()
+
+def runCollect(schemeName, data_fName):
+	trainingData.storeScheme(getattr(trainingData, schemeName), data_fName)
+
+def runTrain(schemeName, data_fName, model_fName):
+	# Trains a scheme's model on its whole training set and stores it as a model artifact
+
+	config = dict(schemeConfigs[schemeName])
+	data = storage.readTrainingSet(data_fName, None)[0]
+	X = machineLearning.expandFeatures(data[:,:-1], config['order'])
+	scaler = machineLearning.fitScaler(X[:,1:])
+	machineLearning.applyScaler(scaler, X[:,1:], X[:,1:])
+	config.setdefault('nLabels', int(np.max(data[:,-1]) + 1))
+	theta = evaluation.fitModel(config, X, data[:,-1:])[0]
+	fingerprint = trainingData.getSchemeFingerprint(getattr(trainingData, schemeName))
+	models.storeModel(models.newModel(config['model'], theta, config['order'], scaler, fingerprint), model_fName)
+
+def runEvaluate(schemeName, data_fName, report_fName):
+	# Cross validates a scheme's configuration and stores the summary as json
+
+	data = storage.readTrainingSet(data_fName, None)[0]
+	foldResults, summary = evaluation.crossValidate(data, schemeConfigs[schemeName], 5)
+	with open(report_fName, 'w') as outFile:
+		json.dump({'config': schemeConfigs[schemeName], 'summary': summary, 'folds': foldResults}, outFile, indent=2)
+
+# ______________________________________________________________________
+# Graph functions
+def newStage(name, f_run, args, inputs, outputs, version='', inPool=True):
+	# Returns a stage: {'name', 'f_run', 'args', 'inputs', 'outputs', 'version', 'inPool'}
+	# inputs, outputs: file names, a stage depends on every stage which outputs one of its inputs
+	# version: changes whenever the stage would produce different outputs from the same inputs
+	# inPool: False for stages which fetch from the web or start their own process pool, they run in the main process
+
+	return {'name': name, 'f_run': f_run, 'args': args, 'inputs': inputs, 'outputs': outputs, 'version': version, \
+		'inPool': inPool}
+
+def getSchemeFileName(schemeName):
+	# Returns the base file name of a scheme's outputs: collectDistanceRankCategory -> distanceRankCategory
+
+	name = schemeName[len('collect'):]
+	return name[0].lower() + name[1:]
+
+def getStages():
+	# Returns the pipeline's stages, in an order where every stage comes after the stages it depends on
+
+	stages = [
+		newStage('fetchRankings', runFetchRankings, (), [dataPreparation.rankingIdsWorkQueue_fName], \
+			[dataPreparation.rankingsIndex_fName, dataPreparation.athletes_fName], inPool=False),
+		newStage('fetchRaces', runFetchRaces, (), [dataPreparation.raceIdsWorkQueue_fName, \
+			dataPreparation.rankingsIndex_fName], [dataPreparation.racesIndex_fName], inPool=False),
+		newStage('buildCatalogue', runBuildCatalogue, (), [dataPreparation.racesIndex_fName, \
+			dataPreparation.rankingsIndex_fName], [dataPreparation.racesIndex_fName]),
+		newStage('rateAthletes', runRateAthletes, (), [dataPreparation.racesIndex_fName], [ratings.ratings_fName], \
+			str(ratings.defaultWeight)),
+	]
+	for schemeName in sorted(schemeConfigs):
+		fName = getSchemeFileName(schemeName)
+		data_fName = trainingData_directory + fName + '.npy'
+		model_fName = models_directory + fName + '.npz'
+		report_fName = evaluations_directory + fName + '.json'
+		fingerprint = trainingData.getSchemeFingerprint(getattr(trainingData, schemeName))
+		config = json.dumps(schemeConfigs[schemeName], sort_keys=True)
+		inputs = [dataPreparation.racesIndex_fName]
+		if 'Rating' in schemeName:
+			inputs.append(ratings.ratings_fName)
+		stages.append(newStage('collect:' + fName, runCollect, (schemeName, data_fName), inputs, \
+			[data_fName, storage.getTrainingSetHeaderName(data_fName)], fingerprint))
+		stages.append(newStage('train:' + fName, runTrain, (schemeName, data_fName, model_fName), [data_fName], \
+			[model_fName, models.getManifestName(model_fName)], fingerprint + config))
+		stages.append(newStage('evaluate:' + fName, runEvaluate, (schemeName, data_fName, report_fName), [data_fName], \
+			[report_fName], config, inPool=False))
+	return stages
+
+def getDependencies(stages):
+	# Returns {stageName: [names of the earlier stages which output one of its inputs]}
+
+	dependencies = {}
+	for i in range(0, len(stages)):
+		dependencies[stages[i]['name']] = [stage['name'] for stage in stages[:i] \
+			if any(fName in stage['outputs'] for fName in stages[i]['inputs'])]
+	return dependencies
+
+def getFileHash(fName, hashCache):
+	# Returns the sha256 of a file's content, None if it doesn't exist
+	# hashCache: {fName: [mtime, size, hash]}, files whose modification time and size haven't changed aren't read again
+
+	if not os.path.exists(fName):
+		return None
+	status = os.stat(fName)
+	cached = hashCache.get(fName)
+	if cached and cached[0] == status.st_mtime_ns and cached[1] == status.st_size:
+		return cached[2]
+	hasher = hashlib.sha256()
+	with open(fName, 'rb') as inFile:
+		for block in iter(lambda: inFile.read(1 << 20), b''):
+			hasher.update(block)
+	hashCache[fName] = [status.st_mtime_ns, status.st_size, hasher.hexdigest()]
+	return hashCache[fName][2]
+
+def getStaleReason(stage, state, hashCache):
+	# Returns why a stage has to run, None if its recorded run is still up to date
+
+	record = state['stages'].get(stage['name'])
+	if record is None:
+		return 'never run'
+	if record['version'] != stage['version']:
+		return 'version changed'
+	for fName in stage['outputs']:
+		if not os.path.exists(fName):
+			return fName + ' missing'
+	for fName in stage['inputs']:
+		if getFileHash(fName, hashCache) != record['inputs'].get(fName):
+			return fName + ' changed'
+	return None
+
+def recordRun(stage, state, hashCache):
+	# Records the hashes of a stage's inputs and outputs after it ran
+
+	state['stages'][stage['name']] = {'version': stage['version'], 'finished': time.time(), \
+		'inputs': dict((fName, getFileHash(fName, hashCache)) for fName in stage['inputs']), \
+		'outputs': dict((fName, getFileHash(fName, hashCache)) for fName in stage['outputs'])}
+
+def readState():
+	# Returns the pipeline state: {'stages': {stageName: record}, 'hashes': hashCache}
+
+	if not os.path.exists(pipelineState_fName):
+		return {'stages': {}, 'hashes': {}}
+	return storage.readFromJson(pipelineState_fName)
+
+def selectStages(stages, targets):
+	# Returns the stages whose names contain one of targets, with every stage they depend on
+
+	dependencies = getDependencies(stages)
+	selected = set()
+	pending = [stage['name'] for stage in stages if any(target in stage['name'] for target in targets)]
+	while pending:
+		name = pending.pop()
+		if not name in selected:
+			selected.add(name)
+			pending.extend(dependencies[name])
+	return [stage for stage in stages if stage['name'] in selected]
+
+def run(stages, force=(), nProcesses=None, dryRun=False):
+	# Runs every stale stage once the stages it depends on have finished
+	# force: stage names (or parts of them) to run even if they are up to date
+	# dryRun: only print what would run
+	# Returns {stageName: 'skipped', 'ran', 'failed' or 'blocked'}
+
+	state = readState()
+	hashCache = state['hashes']
+	dependencies = getDependencies(stages)
+	for directory in [trainingData_directory, models_directory, evaluations_directory]:
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+
+	outcomes = {}
+	running = {} # {stageName: AsyncResult}
+	pool = None
+	try:
+		while len(outcomes) < len(stages):
+			isProgress = False
+			for stage in stages:
+				name = stage['name']
+				if name in outcomes or name in running:
+					continue
+				if any(outcomes.get(dependency) in ['failed', 'blocked'] for dependency in dependencies[name]):
+					outcomes[name] = 'blocked'
+					isProgress = True
+					continue
+				if not all(dependency in outcomes for dependency in dependencies[name]):
+					continue
+				reason = getStaleReason(stage, state, hashCache)
+				if reason is None and not any(target in name for target in force):
+					outcomes[name] = 'skipped'
+				elif dryRun:
+					print(name + ': would run (' + str(reason or 'forced') + ')')
+					outcomes[name] = 'skipped'
+				elif stage['inPool']:
+					print(name + ': running (' + str(reason or 'forced') + ')')
+					if pool is None:
+						pool = multiprocessing.Pool(nProcesses)
+					running[name] = pool.apply_async(stage['f_run'], stage['args'])
+				else:
+					# Stages in the main process run one at a time while the pool keeps working
+					print(name + ': running (' + str(reason or 'forced') + ')')
+					try:
+						stage['f_run'](*stage['args'])
+						recordRun(stage, state, hashCache)
+						outcomes[name] = 'ran'
+					except Exception as e:
+						print(name + ': failed (' + repr(e) + ')')
+						outcomes[name] = 'failed'
+					storage.storeAsJson(state, pipelineState_fName)
+				isProgress = True
+				break # Rescan, since a finished stage may have unblocked earlier ones
+
+			for name in list(running.keys()):
+				if running[name].ready():
+					stage = [stage for stage in stages if stage['name'] == name][0]
+					try:
+						running.pop(name).get()
+						recordRun(stage, state, hashCache)
+						outcomes[name] = 'ran'
+					except Exception as e:
+						print(name + ': failed (' + repr(e) + ')')
+						outcomes[name] = 'failed'
+					storage.storeAsJson(state, pipelineState_fName)
+					isProgress = True
+			if not isProgress:
+				time.sleep(.05)
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
+	if not dryRun:
+		storage.storeAsJson(state, pipelineState_fName)
+	return outcomes
+
+def printStages(stages):
+	# Prints every stage with the stages it depends on and whether it is up to date
+
+	state = readState()
+	dependencies = getDependencies(stages)
+	for stage in stages:
+		reason = getStaleReason(stage, state, state['hashes'])
+		print('%-45s %-25s <- %s' % (stage['name'], reason or 'up to date', ', '.join(dependencies[stage['name']])))
+
+def main():
+	# Test Module Functionality
+	# python pipeline.py                         run every stale stage
+	# python pipeline.py --list                  show the stages and whether they are up to date
+	# python pipeline.py --only train:distance   run these stages (and what they depend on)
+	# python pipeline.py --force collect         run these stages even if they are up to date
+
+	parser = argparse.ArgumentParser(description='Run the pipeline, skipping stages whose inputs are unchanged')
+	parser.add_argument('--list', action='store_true', help='show the stages and whether they are up to date')
+	parser.add_argument('--only', nargs='*', help='run the stages whose names contain these strings')
+	parser.add_argument('--force', nargs='*', default=[], help='run the stages whose names contain these strings')
+	parser.add_argument('--processes', type=int, default=None, help='size of the process pool')
+	parser.add_argument('--dry-run', action='store_true', help='only print the stages which would run')
+	args = parser.parse_args()
+
+	stages = getStages()
+	if args.only:
+		stages = selectStages(stages, args.only)
+	if args.list:
+		printStages(stages)
+		return
+	started = time.time()
+	outcomes = run(stages, args.force, args.processes, args.dry_run)
+	counts = dict((outcome, list(outcomes.values()).count(outcome)) for outcome in set(outcomes.values()))
+	print('Finished in ' + '%.2f' % (time.time() - started) + ' seconds: ' + str(counts))
+	if 'failed' in counts:
+		sys.exit(1)
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
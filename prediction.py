@@ -0,0 +1,89 @@
+'''
+Functions responsible for predicting the results of an upcoming race from its start list
+'''
+
+import numpy as np
+
+import storage
+import fisData
+import dataPreparation
+import trainingData
+import resultsMatrix
+import models
+
+def newRaceInfo(genderIndex, raceTypeIndex, techniqueIndex, dateAsInt, categoryIndex=1, location='', distance=None, \
+	averageFisPoints=None):
+	# Returns a racesIndex entry for an upcoming race, which doesn't have a race id or results yet
+	# [Race id, File name, Race category, Date (as int), Location, Race Type, Technique, Gender, Distance, [Fis1, Fis5, Fis15, Fis30]]
+
+	if averageFisPoints is None:
+		averageFisPoints = [dataPreparation.defaultFisPoints] * 4
+	return [None, None, categoryIndex, dateAsInt, location, raceTypeIndex, techniqueIndex, genderIndex, distance, \
+		averageFisPoints]
+
+def getStartListFeatures(matrix, raceInfo, fisCodes, f_getLookBack):
+	# Builds the features of every athlete on the start list for an upcoming race with one query of a results matrix
+	# matrix: see trainingData.readResultsMatrix
+	# f_getLookBack: the features the model was trained on (for example trainingData.getFuncGetDistanceRankCategoryFeatures())
+	#	Features built one athlete at a time are wrapped with trainingData.getFuncGetLookBackFromRows
+	# Returns [X, fisCodesWithFeatures, fisCodesWithoutFeatures]
+	#	Athletes without enough previous races can't be predicted
+
+	known = [fisCode for fisCode in fisCodes if fisCode in matrix['athleteIndex']]
+	athletes = np.array([matrix['athleteIndex'][fisCode] for fisCode in known], dtype=np.int64)
+	races = np.full(len(known), resultsMatrix.getUpcomingPosition(matrix, raceInfo), dtype=np.int64)
+	X, isFound = f_getLookBack(matrix, athletes, races, raceInfo)
+	found = [known[i] for i in np.nonzero(isFound)[0]]
+	foundSet = set(found)
+	missing = [fisCode for fisCode in fisCodes if not fisCode in foundSet]
+	return [X[isFound], found, missing]
+
+def getScores(model, output):
+	# Expects a model and its output (see models.predictModel)
+	# Returns one score per row where lower is better
+	#	linear -> predicted value (rank or % back), logistic -> -probability,
+	#	networks -> expected category (or -probability with one output)
+
+	if model['type'] == 'linear':
+		return output[:,0]
+	if output.shape[1] == 1:
+		return -output[:,0]
+	return output.dot(np.arange(output.shape[1])) / np.sum(output, axis=1)
+
+def rankPredictions(model, fisCodes, output):
+	# Expects a model, the fis codes which were predicted and the model's output for them
+	# Returns [[fisCode, score, output], ...] sorted from best to worst predicted result
+
+	scores = getScores(model, output)
+	order = np.argsort(scores, kind='mergesort')
+	return [[fisCodes[i], float(scores[i]), output[i,:].tolist()] for i in order]
+
+def predictRace(model, raceInfo, fisCodes, f_getLookBack, matrix=None):
+	# Predicts an upcoming race (see newRaceInfo) for a start list of fis codes
+	# All athletes are scored with a single batched call to the model
+	# matrix: results matrix to look back on, None -> every stored race (see trainingData.readResultsMatrix)
+	# Returns [ranking, fisCodesWithoutFeatures]
+	#	ranking: [[fisCode, score, output], ...] sorted from best to worst predicted result
+
+	if matrix is None:
+		matrix = trainingData.readResultsMatrix()
+	X, found, missing = getStartListFeatures(matrix, raceInfo, fisCodes, f_getLookBack)
+	if not found:
+		return [[], missing]
+	return [rankPredictions(model, found, models.predictModel(model, X)), missing]
+
+def main():
+	# Test Module Functionality
+
+	model = models.readModel('./data/models/distanceRankCategory.npz', \
+		trainingData.getSchemeFingerprint(trainingData.collectDistanceRankCategory))
+	raceInfo = newRaceInfo(fisData.genders.index('Male'), fisData.raceTypes.index('Individual'), \
+		fisData.raceTechniques.index('Classic'), fisData.getDateAsInt('1.12.2017'))
+	fisCodes = list(storage.readFromJson(dataPreparation.athletes_fName).keys())
+	ranking, missing = predictRace(model, raceInfo, fisCodes, trainingData.getFuncGetDistanceRankCategoryFeatures())
+	for i in range(0, min(len(ranking), 30)):
+		print(str(i+1) + '\t' + ranking[i][0] + '\t' + str(ranking[i][1]))
+	print(str(len(missing)) + ' athletes without enough previous races')
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
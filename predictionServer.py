@@ -0,0 +1,295 @@
+'''
+Functions responsible for serving race predictions from a long lived local http server
+The model and every athlete's results (see resultsMatrix) are kept in memory between requests
+Requests arriving together are answered from one batched call to the model
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import fisData
+import dataPreparation
+import trainingData
+import models
+import prediction
+
+maxBatchSize = 64 # Requests answered by one call to the model
+maxBatchDelay = .005 # Seconds to wait for more requests before running a batch
+nLatencies = 10000 # Latencies kept for the percentiles
+maxCachedRaces = 256 # Races whose start list features are kept, the least recently requested are dropped first
+
+# serverState: {'model', 'model_fName', 'fingerprint', 'f_getLookBack', 'matrix', 'mtimes', 'features',
+#	'lock', 'statsLock', 'requests', 'latencies', 'counters', 'started'}
+serverState = {}
+
+# ______________________________________________________________________
+# State functions
+def getMtimes(model_fName):
+	# Returns the modification times of the files the server keeps in memory
+
+	return [os.path.getmtime(models.getManifestName(model_fName)), os.path.getmtime(dataPreparation.racesIndex_fName)]
+
+def loadState(model_fName, f_scheme, f_getLookBack):
+	# Reads the model artifact and the results of every race into serverState
+	# f_scheme: the trainingData scheme the model was trained on, f_getLookBack: its feature builder
+
+	fingerprint = trainingData.getSchemeFingerprint(f_scheme)
+	serverState['model_fName'] = model_fName
+	serverState['fingerprint'] = fingerprint
+	serverState['f_getLookBack'] = f_getLookBack
+	serverState['mtimes'] = getMtimes(model_fName)
+	serverState['model'] = models.readModel(model_fName, fingerprint)
+	serverState['matrix'] = readMatrix(f_getLookBack)
+	serverState['features'] = collections.OrderedDict() # {race descriptor: {fisCode: features or None}}, see getFeatures
+	serverState['lock'] = threading.Lock() # Held while the model, results matrix or feature cache are taken or replaced
+	serverState['statsLock'] = threading.Lock()
+	serverState['requests'] = queue.Queue()
+	serverState['latencies'] = collections.deque(maxlen=nLatencies)
+	serverState['counters'] = {'requests': 0, 'athletes': 0, 'batches': 0, 'errors': 0, 'refreshes': 0}
+	serverState['started'] = time.time()
+
+def readMatrix(f_getLookBack):
+	# Returns the results matrix of every stored race with the race codes f_getLookBack queries already built
+	#	so the first request doesn't build them
+
+	matrix = trainingData.readResultsMatrix()
+	f_getLookBack(matrix, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+	return matrix
+
+def refresh(force=False):
+	# Reloads the model and the race catalogue if their files changed (or if force is True)
+	# Everything is rebuilt before the lock is taken, requests keep being answered from the old state meanwhile
+	# Returns whether anything was reloaded
+
+	mtimes = getMtimes(serverState['model_fName'])
+	if not force and mtimes == serverState['mtimes']:
+		return False
+	model = models.readModel(serverState['model_fName'], serverState['fingerprint'])
+	trainingData.clearResultsCache()
+	matrix = readMatrix(serverState['f_getLookBack'])
+	with serverState['lock']:
+		serverState['model'] = model
+		serverState['matrix'] = matrix
+		serverState['mtimes'] = mtimes
+		serverState['features'] = collections.OrderedDict() # Features of the old matrix aren't used again
+	with serverState['statsLock']:
+		serverState['counters']['refreshes'] += 1
+	return True
+
+def runRefresher(refreshInterval):
+	# Checks for updated files every refreshInterval seconds, forever
+
+	while True:
+		time.sleep(refreshInterval)
+		try:
+			refresh()
+		except Exception as e:
+			print('Refresh failed: ' + str(e))
+
+# ______________________________________________________________________
+# Batching functions
+def getRaceInfo(request):
+	# Expects a decoded request: {'gender', 'raceType', 'technique', 'date', 'category' (optional), 'distance' (optional)}
+	#	Names are those in fisData's lists and the date is in dd.mm.yyyy format
+	# Returns the race's racesIndex entry (see prediction.newRaceInfo)
+
+	return prediction.newRaceInfo(fisData.genders.index(request['gender']), \
+		fisData.raceTypes.index(request['raceType']), fisData.raceTechniques.index(request['technique']), \
+		fisData.getDateAsInt(request['date']), fisData.raceCategories.index(request.get('category', 'World Cup')), \
+		distance=request.get('distance'))
+
+def getFeatures(matrix, f_getLookBack, cache, raceInfo, fisCodes):
+	# Returns [X, fisCodesWithFeatures, fisCodesWithoutFeatures] for a start list
+	# Athletes' features are cached per race, so repeated requests for a race only build new athletes' features
+	#	cache holds the maxCachedRaces most recently requested races, and only athletes who are in the matrix
+	#	Only the batcher thread uses the cache, so it's used without serverState['lock']
+
+	race = tuple(raceInfo[2:9])
+	if race in cache:
+		cache.move_to_end(race)
+	else:
+		cache[race] = {}
+		if len(cache) > maxCachedRaces:
+			cache.popitem(last=False)
+	raceCache = cache[race]
+	uncached = [fisCode for fisCode in fisCodes if not fisCode in raceCache and fisCode in matrix['athleteIndex']]
+	if uncached:
+		X, found, missing = prediction.getStartListFeatures(matrix, raceInfo, uncached, f_getLookBack)
+		for i in range(0, len(found)):
+			raceCache[found[i]] = X[i,:]
+		for fisCode in missing:
+			raceCache[fisCode] = None
+	rows = []
+	found = []
+	missing = []
+	for fisCode in fisCodes:
+		if raceCache.get(fisCode) is None:
+			missing.append(fisCode)
+		else:
+			rows.append(raceCache[fisCode])
+			found.append(fisCode)
+	return [np.array(rows) if rows else None, found, missing]
+
+def processBatch(batch):
+	# Answers a batch of requests with one call to the model
+	# Expects [[request, done (threading.Event), response (dictionary)], ...]
+	#	Each response is filled in with {'ranking', 'missing'} or {'error'} before done is set
+
+	with serverState['lock']:
+		model = serverState['model']
+		matrix = serverState['matrix']
+		cache = serverState['features']
+	parts = [] # [response, found, missing, X]
+	for request, done, response in batch:
+		try:
+			X, found, missing = getFeatures(matrix, serverState['f_getLookBack'], cache, getRaceInfo(request), \
+				request['fisCodes'])
+			parts.append([response, found, missing, X])
+		except (KeyError, ValueError, IndexError, TypeError) as e:
+			response['error'] = 'Bad request: ' + str(e)
+	Xs = [X for response, found, missing, X in parts if X is not None]
+	if Xs:
+		output = models.predictModel(model, np.concatenate(Xs, axis=0))
+	row = 0
+	for response, found, missing, X in parts:
+		if X is None:
+			response['ranking'] = []
+		else:
+			response['ranking'] = prediction.rankPredictions(model, found, output[row:row+len(found),:])
+			row += len(found)
+		response['missing'] = missing
+	with serverState['statsLock']:
+		serverState['counters']['batches'] += 1
+	for request, done, response in batch:
+		done.set()
+
+def runBatcher():
+	# Waits for requests and answers them in batches, forever
+	# A batch is run once maxBatchSize requests are waiting or maxBatchDelay has passed since the first one
+
+	requests = serverState['requests']
+	while True:
+		batch = [requests.get()]
+		deadline = time.time() + maxBatchDelay
+		while len(batch) < maxBatchSize:
+			timeLeft = deadline - time.time()
+			if timeLeft <= 0:
+				break
+			try:
+				batch.append(requests.get(timeout=timeLeft))
+			except queue.Empty:
+				break
+		try:
+			processBatch(batch)
+		except Exception as e:
+			for request, done, response in batch:
+				response['error'] = str(e)
+				done.set()
+
+def predict(request):
+	# Queues a decoded request for the batcher and waits for its response
+	# Returns {'ranking': [[fisCode, score, output], ...], 'missing': [fisCode, ...]} or {'error': message}
+
+	started = time.time()
+	done = threading.Event()
+	response = {}
+	serverState['requests'].put([request, done, response])
+	done.wait()
+	with serverState['statsLock']:
+		counters = serverState['counters']
+		counters['requests'] += 1
+		if 'error' in response:
+			counters['errors'] += 1
+		else:
+			counters['athletes'] += len(response['ranking'])
+		serverState['latencies'].append(time.time() - started)
+	return response
+
+def getStats():
+	# Returns the server's counters with p50/p99 latency (ms) and throughput (requests per second)
+
+	with serverState['statsLock']: # Copy both so requests finishing meanwhile can't change them under us
+		stats = dict(serverState['counters'])
+		latencies = np.array(serverState['latencies'])
+	if len(latencies) > 0:
+		stats['p50'] = float(np.percentile(latencies, 50) * 1000)
+		stats['p99'] = float(np.percentile(latencies, 99) * 1000)
+	uptime = time.time() - serverState['started']
+	stats['uptime'] = uptime
+	stats['throughput'] = stats['requests'] / uptime if uptime > 0 else 0.
+	stats['races'] = serverState['matrix']['nRaces']
+	return stats
+
+# ______________________________________________________________________
+# Http functions
+class RequestHandler(BaseHTTPRequestHandler):
+	# POST /predict: json request (see getRaceInfo) with 'fisCodes': [fisCode, ...]
+	# POST /refresh: reload the model and race catalogue now
+	# GET /stats: counters and latencies
+
+	def sendJson(self, status, body):
+		encoded = json.dumps(body).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(encoded)))
+		self.end_headers()
+		self.wfile.write(encoded)
+
+	def do_GET(self):
+		if self.path == '/stats':
+			self.sendJson(200, getStats())
+		else:
+			self.sendJson(404, {'error': 'Not found'})
+
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		if self.path == '/predict':
+			try:
+				request = json.loads(body.decode('utf-8'))
+			except ValueError:
+				self.sendJson(400, {'error': 'Request is not json'})
+				return
+			response = predict(request)
+			self.sendJson(400 if 'error' in response else 200, response)
+		elif self.path == '/refresh':
+			self.sendJson(200, {'refreshed': refresh(True)})
+		else:
+			self.sendJson(404, {'error': 'Not found'})
+
+	def log_message(self, format, *args):
+		pass # Latencies are in /stats, logging every request would slow the server down
+
+def serve(model_fName, f_scheme, f_getLookBack, host='127.0.0.1', port=8642, refreshInterval=60):
+	# Loads everything into memory and serves predictions until interrupted
+	# refreshInterval: seconds between checks for a new model or newly ingested races
+
+	loadState(model_fName, f_scheme, f_getLookBack)
+	threading.Thread(target=runBatcher, daemon=True).start()
+	threading.Thread(target=runRefresher, args=(refreshInterval,), daemon=True).start()
+	server = ThreadingHTTPServer((host, port), RequestHandler)
+	server.daemon_threads = True
+	print('Serving predictions on http://' + host + ':' + str(port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+def main():
+	# Test Module Functionality
+
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8642
+	serve('./data/models/distanceRankCategory.npz', trainingData.collectDistanceRankCategory, \
+		trainingData.getFuncGetDistanceRankCategoryFeatures(), port=port)
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
@@ -0,0 +1,162 @@
+'''
+Functions responsible for rating athletes incrementally as races are added
+An athlete's ratings are exponentially weighted averages of their rank and % back,
+	kept per discipline and per discipline and technique
+Races are applied in date order and each race only touches the athletes in it,
+	so the ratings every athlete had going into a race are recorded before any race on its date is applied
+'''
+
+import os
+
+import storage
+import fisData
+import dataPreparation
+
+ratings_fName = './data/ratings.json'
+defaultWeight = .3 # Weight of the newest race in each average
+
+def newRatings(weight=defaultWeight):
+	# Returns empty ratings:
+	# {'weight': weight of the newest race, 'lastDate': date (as int) of the latest race applied, 'raceIds': [applied race ids],
+	#	'athletes': {fisCode: {categoryKey: [rank, percentBack, nRaces, lastDate]}},
+	#	'preRace': {raceId: {fisCode: features}}}
+
+	return {'weight': weight, 'lastDate': None, 'raceIds': [], 'athletes': {}, 'preRace': {}}
+
+def getCategoryKeys(raceInfo):
+	# Returns the names of the rating categories a race counts towards: [discipline, discipline/technique]
+
+	discipline = fisData.disciplines[0] if fisData.isDistance(raceInfo[5]) else fisData.disciplines[1]
+	return [discipline, discipline + '/' + fisData.raceTechniques[raceInfo[6]]]
+
+def getResultValues(result):
+	# Expects a result from a race's results: [rank, % back] (distance) or rank (sprint final)
+	# Returns [rank, percentBack] with None for values which aren't in the result
+
+	try:
+		return [result[0], result[1] if len(result) > 1 else None]
+	except TypeError:
+		return [result, None]
+
+def updateAverage(average, value, weight):
+	# Returns the exponentially weighted average after value, starting from value if there is no average yet
+
+	if value is None:
+		return average
+	if average is None:
+		return value
+	return (1 - weight) * average + weight * value
+
+def getRatingFeatures(athlete, raceInfo):
+	# Expects an athlete's ratings ({categoryKey: [rank, percentBack, nRaces, lastDate]}) and a race
+	# Returns [rank, % back, nRaces, days since last race] for each of the race's categories (distance races)
+	#	or [rank, nRaces, days since last race] for each category (sprint races)
+	# Returns None if the athlete hasn't been rated in one of the categories yet
+
+	isDistance = fisData.isDistance(raceInfo[5])
+	features = []
+	for key in getCategoryKeys(raceInfo):
+		if not key in athlete:
+			return None
+		rank, percentBack, nRaces, lastDate = athlete[key]
+		if rank is None or (isDistance and percentBack is None):
+			return None
+		if isDistance:
+			features += [rank, percentBack, nRaces, raceInfo[3] - lastDate]
+		else:
+			features += [rank, nRaces, raceInfo[3] - lastDate]
+	return features
+
+def recordPreRace(ratings, raceInfo, results):
+	# Records the pre race features of every athlete in results for this race
+
+	athletes = ratings['athletes']
+	preRace = {}
+	for fisCode in results:
+		features = getRatingFeatures(athletes.get(fisCode, {}), raceInfo)
+		if features is not None:
+			preRace[fisCode] = features
+	ratings['preRace'][str(raceInfo[0])] = preRace
+
+def applyRace(ratings, raceInfo, results):
+	# Updates the ratings of every athlete in results with their result in this race
+	# Only the athletes in results are touched
+
+	athletes = ratings['athletes']
+	weight = ratings['weight']
+	for fisCode in results:
+		athlete = athletes.setdefault(fisCode, {})
+		rank, percentBack = getResultValues(results[fisCode])
+		for key in getCategoryKeys(raceInfo):
+			if key in athlete:
+				rating = athlete[key]
+				athlete[key] = [updateAverage(rating[0], rank, weight), updateAverage(rating[1], percentBack, weight), \
+					rating[2] + 1, raceInfo[3]]
+			else:
+				athlete[key] = [rank, percentBack, 1, raceInfo[3]]
+	ratings['raceIds'].append(raceInfo[0])
+	ratings['lastDate'] = raceInfo[3]
+
+def updateRatings(ratings, racesIndex):
+	# Applies every race in racesIndex which hasn't been applied yet, oldest first
+	#	Races on the same date all record their pre race features before any of them is applied,
+	#	so no race sees the results of another race held that day
+	# If one of them isn't newer than the latest race already applied, the ratings are rebuilt from scratch
+	#	since every later rating (or another race on its date) depends on it
+	# Returns [ratings, number of races applied]
+
+	applied = set(ratings['raceIds'])
+	newRaces = [raceInfo for raceInfo in reversed(racesIndex) if not raceInfo[0] in applied]
+	if ratings['lastDate'] is not None and any(raceInfo[3] <= ratings['lastDate'] for raceInfo in newRaces):
+		ratings = newRatings(ratings['weight'])
+		newRaces = list(reversed(racesIndex))
+	start = 0
+	while start < len(newRaces):
+		end = start + 1
+		while end < len(newRaces) and newRaces[end][3] == newRaces[start][3]:
+			end += 1
+		day = [[raceInfo, storage.readFromJson(raceInfo[1])] for raceInfo in newRaces[start:end]]
+		for raceInfo, results in day:
+			recordPreRace(ratings, raceInfo, results)
+		for raceInfo, results in day:
+			applyRace(ratings, raceInfo, results)
+		start = end
+	return [ratings, len(newRaces)]
+
+def getPreRaceFeatures(ratings, raceInfo, fisCode):
+	# Returns the rating features an athlete had going into a race (see getRatingFeatures), None if they had none
+	#	Applied races are a dictionary lookup
+	#	Upcoming races (after every applied race) use the athlete's current ratings
+
+	raceKey = str(raceInfo[0])
+	if raceKey in ratings['preRace']:
+		return ratings['preRace'][raceKey].get(fisCode)
+	if ratings['lastDate'] is None or raceInfo[3] > ratings['lastDate']:
+		return getRatingFeatures(ratings['athletes'].get(fisCode, {}), raceInfo)
+	return None
+
+def readRatings(fName=ratings_fName):
+	# Returns the stored ratings, or empty ratings if none have been stored yet
+
+	if not os.path.exists(fName):
+		return newRatings()
+	return storage.readFromJson(fName)
+
+def updateStoredRatings(racesIndex=None, fName=ratings_fName):
+	# Applies the races in racesIndex which the stored ratings haven't seen and stores the ratings again
+	# Returns the number of races applied
+
+	if racesIndex is None:
+		racesIndex = storage.readFromJson(dataPreparation.racesIndex_fName)
+	ratings, nApplied = updateRatings(readRatings(fName), racesIndex)
+	if nApplied > 0:
+		storage.storeAsJson(ratings, fName)
+	return nApplied
+
+def main():
+	# Test Module Functionality
+
+	print('Applied ' + str(updateStoredRatings()) + ' races')
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
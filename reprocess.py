@@ -0,0 +1,146 @@
+'''
+Functions responsible for rebuilding the race catalogue and results store from archived pages
+Every archived race page is parsed, classified, filtered and has its FisN computed again (see dataPreparation.storeRace)
+	in parallel and without the network, into a new build of the results store next to the old one
+The new racesIndex is switched in with a single rename, so readers see either the old or the new catalogue
+'''
+
+import os
+import re
+import sys
+import glob
+import time
+import shutil
+import argparse
+import multiprocessing
+
+import storage
+import scrape
+import dataPreparation
+import ratings
+
+# workerState: {'directory': results directory of the build}
+workerState = {}
+
+def initWorker(directory):
+	# Puts a worker process in offline mode once
+
+	scrape.isOffline = True
+	workerState['directory'] = directory
+
+def reprocessRace(raceId):
+	# Returns [raceId, info (None if the race was filtered out), error (None if it was parsed)]
+
+	try:
+		return [raceId, dataPreparation.storeRace(raceId, workerState['directory']), None]
+	except Exception as e:
+		return [raceId, None, repr(e)]
+
+def getArchivedRaceIds():
+	# Returns the ids of every race whose page is in the archive, in ascending order
+
+	fNames = glob.glob(scrape.getArchiveName('races/race*'))
+	return sorted(int(re.search(r'race(\d+)\.html\.gz$', fName).group(1)) for fName in fNames)
+
+def getBuildName():
+	# Returns the name of a new build of the results store: ./data/segments/races.<date and time>
+
+	return storage.getStoreName(dataPreparation.races_directory) + '.' + time.strftime('%Y%m%d%H%M%S')
+
+def removeUnusedBuilds(racesIndex):
+	# Deletes the results of earlier builds (directories or segment stores) which racesIndex no longer refers to
+	# Returns the deleted builds
+
+	used = set(os.path.normpath(storage.getStoreName(raceInfo[1])) for raceInfo in racesIndex)
+	base = storage.getStoreName(dataPreparation.races_directory)
+	removed = []
+	for directory in glob.glob(base + '.*/'):
+		if not os.path.normpath(directory) in used:
+			shutil.rmtree(directory)
+			removed.append(directory)
+	for indexName in glob.glob(storage.getSegmentIndexName(base + '.*')):
+		store = indexName[:-len(storage.getSegmentIndexName(''))]
+		if not os.path.normpath(store) in used:
+			storage.removeSegmentStore(store)
+			removed.append(store)
+	return removed
+
+def rebuild(raceIds=None, nProcesses=None, switch=True):
+	# Rebuilds the races in raceIds (None -> every archived race) from the archive into a new build of the results store
+	# Races which aren't archived, or which fail to parse, keep their current entry and results
+	# Races which the filters in storeRace now reject are dropped
+	# switch: replace the stored racesIndex, rebuild the ratings and delete unused builds
+	# If no race was rebuilt, the new build is discarded and the stored racesIndex is returned unchanged
+	# Returns [racesIndex, {'stored': [raceIds], 'rejected': [raceIds], 'failed': {raceId: error}, 'kept': nKept}]
+
+	if raceIds is None:
+		raceIds = getArchivedRaceIds()
+	build = getBuildName()
+	directory = build + '/' # Workers store results as separate files, which are packed afterwards if races are in segments
+	os.makedirs(directory)
+	pool = multiprocessing.Pool(nProcesses, initWorker, (directory,))
+	try:
+		reprocessed = pool.map(reprocessRace, raceIds, max(1, len(raceIds) // (4 * os.cpu_count())))
+	finally:
+		pool.close()
+		pool.join()
+
+	report = {'stored': [], 'rejected': [], 'failed': {}}
+	newRaces = []
+	for raceId, info, error in reprocessed:
+		if error is not None:
+			report['failed'][raceId] = error
+		elif info is None:
+			report['rejected'].append(raceId)
+		else:
+			report['stored'].append(raceId)
+			newRaces.append(info)
+	if len(newRaces) == 0: # Nothing to pack, so keep the live store rather than switching to an empty build
+		shutil.rmtree(directory)
+		racesIndex = storage.readFromJson(dataPreparation.racesIndex_fName)
+		report['kept'] = len(racesIndex)
+		return [racesIndex, report]
+	if storage.segmentSeparator in dataPreparation.races_directory:
+		addresses = storage.packFiles([info[1] for info in newRaces], build)
+		for info in newRaces:
+			info[1] = addresses[info[1]]
+		shutil.rmtree(directory)
+	rebuilt = set(report['stored'] + report['rejected'])
+	kept = [raceInfo for raceInfo in storage.readFromJson(dataPreparation.racesIndex_fName) if not raceInfo[0] in rebuilt]
+	report['kept'] = len(kept)
+	racesIndex = sorted(newRaces + kept, key=lambda raceInfo: (raceInfo[3], raceInfo[0]), reverse=True) # Most recent first
+
+	if switch:
+		dataPreparation.storeIndex(racesIndex, dataPreparation.racesIndex_fName)
+		# Every rating depends on the results before it, so they are rebuilt from scratch
+		weight = ratings.readRatings()['weight']
+		storage.storeAsJson(ratings.updateRatings(ratings.newRatings(weight), racesIndex)[0], ratings.ratings_fName)
+		removeUnusedBuilds(racesIndex)
+	return [racesIndex, report]
+
+def main():
+	# Test Module Functionality
+	# python reprocess.py                  rebuild every archived race and switch to the new catalogue
+	# python reprocess.py --races 1 2 3    rebuild these races only
+	# python reprocess.py --dry-run        rebuild without switching, to compare with the current catalogue
+
+	parser = argparse.ArgumentParser(description='Rebuild the race catalogue and results from archived pages')
+	parser.add_argument('--races', type=int, nargs='*', help='race ids to rebuild (default: every archived race)')
+	parser.add_argument('--processes', type=int, default=None, help='size of the process pool')
+	parser.add_argument('--dry-run', action='store_true', help="build the new results but don't switch to them")
+	args = parser.parse_args()
+
+	started = time.time()
+	racesIndex, report = rebuild(args.races, args.processes, not args.dry_run)
+	print('Rebuilt in ' + '%.1f' % (time.time() - started) + ' seconds: ' + str(len(report['stored'])) + ' stored, ' + \
+		str(len(report['rejected'])) + ' rejected, ' + str(len(report['failed'])) + ' failed, ' + str(report['kept']) + ' kept')
+	for raceId in sorted(report['failed']):
+		print(str(raceId) + ': ' + report['failed'][raceId])
+	if args.dry_run:
+		storage.storeAsJson(racesIndex, dataPreparation.racesIndex_fName + '.new')
+		print('New catalogue stored in ' + dataPreparation.racesIndex_fName + '.new')
+	if report['failed']:
+		sys.exit(1)
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
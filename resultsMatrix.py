@@ -0,0 +1,229 @@
+'''
+Functions responsible for holding every race result in a sparse athlete x race matrix
+Results are stored twice, by race (like CSC) and by athlete (like CSR), with race positions in racesIndex order
+	so an athlete's results run from their most recent race back
+Look-back queries ("the last N results of athlete a before race r in similar races") are answered for many
+	(athlete, race) pairs at once with array operations instead of scanning racesIndex per result
+'''
+
+import numpy as np
+
+import storage
+import fisData
+import ratings
+import dataPreparation
+
+athleteFields = ['rank', 'percentBack'] # Values from an athlete's result, NaN where the result has none
+raceFields = {'fisPoints1': 0, 'fisPoints5': 1, 'fisPoints15': 2, 'fisPoints30': 3} # Columns of raceInfo[9]
+raceAttributes = {'gender': 7, 'type': 5, 'technique': 6} # Columns of raceInfo which races can be matched on
+
+def newResultsMatrix(racesIndex, f_readResults=storage.readFromJson):
+	# Expects racesIndex and a function which reads a race's results from its file name
+	# Returns a results matrix:
+	#	'fisCodes': [fisCode of each athlete], 'athleteIndex': {fisCode: athlete}
+	#	'raceStart', 'raceAthletes', 'raceRank', 'racePercentBack': results by race,
+	#		race p's results are entries raceStart[p] to raceStart[p+1] in the order of its results dictionary
+	#	'athleteStart', 'athleteRaces', 'athleteRank', 'athletePercentBack', 'athleteKeys': results by athlete,
+	#		athlete a's results are entries athleteStart[a] to athleteStart[a+1], most recent race first
+	#		athleteKeys = athlete * nRaces + race position, which is sorted
+	#	'gender', 'type', 'technique', 'discipline' (0 distance, 1 sprint), 'date', 'fisPoints': attributes of each race
+	#	'masks': {attribute: {value: boolean mask over races}}
+	#	'codes': {criteria: [code, rankInCode, bases, raceKeys]} cache (see getRaceCodes)
+	#	'racesIndex': the racesIndex the matrix was built from
+
+	athleteIndex = {}
+	fisCodes = []
+	raceStart = [0]
+	entryAthletes = []
+	entryValues = []
+	for raceInfo in racesIndex:
+		results = f_readResults(raceInfo[1])
+		for fisCode in results:
+			if not fisCode in athleteIndex:
+				athleteIndex[fisCode] = len(fisCodes)
+				fisCodes.append(fisCode)
+			entryAthletes.append(athleteIndex[fisCode])
+			entryValues.append(ratings.getResultValues(results[fisCode]))
+		raceStart.append(len(entryAthletes))
+
+	nRaces = len(racesIndex)
+	raceStart = np.array(raceStart, dtype=np.int64)
+	raceAthletes = np.array(entryAthletes, dtype=np.int64)
+	values = np.array(entryValues, dtype=np.float64).reshape((-1, 2)) # None -> NaN
+	entryRaces = np.repeat(np.arange(0, nRaces), np.diff(raceStart))
+	order = np.lexsort((entryRaces, raceAthletes))
+	matrix = {'fisCodes': fisCodes, 'athleteIndex': athleteIndex, 'nRaces': nRaces, \
+		'raceStart': raceStart, 'raceAthletes': raceAthletes, 'raceRank': values[:,0], 'racePercentBack': values[:,1], \
+		'athleteStart': np.concatenate(([0], np.cumsum(np.bincount(raceAthletes, minlength=len(fisCodes))))), \
+		'athleteRaces': entryRaces[order], 'athleteRank': values[order,0], 'athletePercentBack': values[order,1], \
+		'athleteKeys': raceAthletes[order] * nRaces + entryRaces[order], \
+		'fisPoints': np.array([raceInfo[9] for raceInfo in racesIndex], dtype=np.float64).reshape((nRaces, 4)), \
+		'date': np.array([raceInfo[3] for raceInfo in racesIndex], dtype=np.int64), \
+		'masks': {}, 'codes': {}, 'racesIndex': racesIndex}
+	for attribute in list(raceAttributes.keys()) + ['discipline']:
+		matrix[attribute] = np.array([getAttribute(raceInfo, attribute) for raceInfo in racesIndex], dtype=np.int64)
+		matrix['masks'][attribute] = dict((int(value), matrix[attribute] == value) for value in np.unique(matrix[attribute]))
+	return matrix
+
+def getAttribute(raceInfo, attribute):
+	# Returns the value of one of raceAttributes or 'discipline' for a race
+
+	if attribute == 'discipline':
+		return 0 if fisData.isDistance(raceInfo[5]) else 1
+	return raceInfo[raceAttributes[attribute]]
+
+def getUpcomingPosition(matrix, raceInfo):
+	# Expects an upcoming race which isn't in the matrix
+	# Returns the race position it would be inserted at in racesIndex, after every race on or after its date
+	#	so only earlier races are looked back on
+
+	return int(np.searchsorted(-matrix['date'], -raceInfo[3], side='right'))
+
+def getRaceMask(matrix, conditions):
+	# Expects {attribute: value}, for example {'gender': 0, 'discipline': 1}
+	# Returns a boolean mask of the races which meet every condition
+
+	mask = np.ones(matrix['nRaces'], dtype=bool)
+	for attribute in conditions:
+		mask &= matrix['masks'][attribute].get(conditions[attribute], np.zeros(matrix['nRaces'], dtype=bool))
+	return mask
+
+def getRaceCodes(matrix, criteria):
+	# Expects a list of attributes races are matched on, gender is always included
+	# Returns [code, rankInCode, bases, raceKeys], cached in the matrix
+	#	code[p]: races with the same code match each other on every attribute
+	#	rankInCode[p]: the number of more recent races with the same code as race p
+	#	bases: the number of values of each attribute in the code, raceKeys: code * nRaces + p, sorted
+
+	key = tuple(sorted(set(['gender'] + list(criteria))))
+	if not key in matrix['codes']:
+		code = np.zeros(matrix['nRaces'], dtype=np.int64)
+		bases = []
+		for attribute in key:
+			values = matrix[attribute]
+			bases.append(int(values.max(initial=0)) + 1)
+			code = code * bases[-1] + values
+		order = np.argsort(code, kind='stable')
+		sortedCodes = code[order]
+		groupStart = np.searchsorted(sortedCodes, sortedCodes, side='left')
+		rankInCode = np.empty(matrix['nRaces'], dtype=np.int64)
+		rankInCode[order] = np.arange(0, matrix['nRaces']) - groupStart
+		matrix['codes'][key] = [code, rankInCode, bases, sortedCodes * matrix['nRaces'] + order]
+	return matrix['codes'][key]
+
+def getUpcomingRaceCodes(matrix, criteria, raceInfo, races):
+	# Expects an upcoming race which isn't in the matrix and the positions it's inserted at (see getUpcomingPosition)
+	# Returns [code, rankInCode] of the upcoming race at each position, as if it were in the matrix (see getRaceCodes)
+	#	code is -1 if no race in the matrix matches it
+
+	code, rankInCode, bases, raceKeys = getRaceCodes(matrix, criteria)
+	key = tuple(sorted(set(['gender'] + list(criteria))))
+	upcomingCode = 0
+	for attribute, base in zip(key, bases):
+		value = getAttribute(raceInfo, attribute)
+		if value < 0 or value >= base:
+			return [np.full(len(races), -1, dtype=np.int64), np.zeros(len(races), dtype=np.int64)]
+		upcomingCode = upcomingCode * base + value
+	nRaces = matrix['nRaces']
+	# The number of races with this code before each position, less one since a race isn't counted in its own rank
+	nBefore = np.searchsorted(raceKeys, upcomingCode * nRaces + races, side='left') - \
+		np.searchsorted(raceKeys, upcomingCode * nRaces, side='left')
+	return [np.full(len(races), upcomingCode, dtype=np.int64), nBefore - 1]
+
+def getLastResults(matrix, athletes, races, criteria, n, fields, searchLimit=20, raceInfo=None):
+	# Expects arrays of athletes and race positions, one pair per query
+	# Finds the n most recent results of each athlete before their race, in races of the same gender which match
+	#	their race on criteria (see getRaceCodes) and in which every athlete field in fields has a value
+	# raceInfo: an upcoming race which isn't in the matrix, races are then the positions it's inserted at
+	# A query fails if the athlete has fewer such results, or if searchLimit or more similar races without a result
+	#	separate two of them (as in trainingData.getNextFeatures)
+	# Returns [features, isFound]
+	#	features: matrix with a row for each query of [fields of the 1st result, ..., fields of the nth result]
+	#	isFound: boolean array, rows of features are only meaningful where it's True
+
+	athletes = np.asarray(athletes, dtype=np.int64)
+	races = np.asarray(races, dtype=np.int64)
+	nQueries = athletes.shape[0]
+	code, rankInCode = getRaceCodes(matrix, criteria)[:2]
+	if raceInfo is None:
+		queryCodes = code[races]
+		queryRanks = rankInCode[races]
+	else:
+		queryCodes, queryRanks = getUpcomingRaceCodes(matrix, criteria, raceInfo, races)
+	isValid = np.ones(matrix['athleteRaces'].shape[0], dtype=bool)
+	for field in fields:
+		if field in athleteFields:
+			isValid &= ~np.isnan(matrix['athlete' + field[0].upper() + field[1:]])
+
+	# Search a window of each athlete's results after their race, doubling it for the queries it was too small for
+	# An upcoming race goes before the race at its position, so that race is looked back on
+	start = np.searchsorted(matrix['athleteKeys'], athletes * matrix['nRaces'] + races, \
+		side='right' if raceInfo is None else 'left')
+	end = matrix['athleteStart'][athletes + 1]
+	entries = np.zeros((nQueries, n), dtype=np.int64)
+	isFound = np.zeros(nQueries, dtype=bool)
+	pending = np.arange(0, nQueries)
+	window = 4 * n
+	lastEntry = max(matrix['athleteRaces'].shape[0] - 1, 0)
+	while pending.shape[0] > 0 and n > 0:
+		candidates = start[pending,None] + np.arange(0, window)
+		isCandidate = candidates < end[pending,None]
+		candidates = np.minimum(candidates, lastEntry)
+		isCandidate &= isValid[candidates] & (code[matrix['athleteRaces'][candidates]] == queryCodes[pending][:,None])
+		nCandidates = np.cumsum(isCandidate, axis=1)
+		isDone = nCandidates[:,-1] >= n
+		taken = isCandidate[isDone] & (nCandidates[isDone] <= n)
+		entries[pending[isDone]] = candidates[isDone][taken].reshape((-1, n))
+		isFound[pending[isDone]] = True
+		isExhausted = start[pending] + window >= end[pending]
+		pending = pending[~isDone & ~isExhausted]
+		window *= 2
+	if n == 0:
+		isFound[:] = True
+
+	# Similar races between consecutive results which the athlete has no result in
+	ranks = np.concatenate((queryRanks[:,None], rankInCode[matrix['athleteRaces'][entries]]), axis=1)
+	nMissed = np.diff(ranks, axis=1) - 1
+	isFound &= np.all(nMissed < searchLimit, axis=1)
+
+	columns = []
+	for field in fields:
+		if field in athleteFields:
+			columns.append(matrix['athlete' + field[0].upper() + field[1:]][entries])
+		else:
+			columns.append(matrix['fisPoints'][matrix['athleteRaces'][entries], raceFields[field]])
+	features = np.stack(columns, axis=2).reshape((nQueries, n * len(fields)))
+	return [features, isFound]
+
+def getFuncGetLookBack(criteriaList, counts, fields, searchLimit=20):
+	# Returns a function which builds look-back features for many (athlete, race) pairs at once:
+	#	f(matrix, athletes, races, raceInfo=None) -> [features, isFound] (see getLastResults)
+	# criteriaList: for each category of races, the attributes they have to match the race on, for example [['type']]
+	# counts: the number of results from each category, fields: the values taken from each result
+
+	def getLookBack(matrix, athletes, races, raceInfo=None):
+		# Returns [features, isFound] with the features of every category side by side
+
+		features = []
+		isFound = np.ones(len(athletes), dtype=bool)
+		for criteria, n in zip(criteriaList, counts):
+			categoryFeatures, isCategoryFound = getLastResults(matrix, athletes, races, criteria, n, fields, searchLimit, \
+				raceInfo)
+			features.append(categoryFeatures)
+			isFound &= isCategoryFound
+		return [np.concatenate(features, axis=1), isFound]
+
+	return getLookBack
+
+def main():
+	# Test Module Functionality
+
+	matrix = newResultsMatrix(storage.readFromJson(dataPreparation.racesIndex_fName))
+	print(str(len(matrix['fisCodes'])) + ' athletes, ' + str(matrix['nRaces']) + ' races, ' + \
+		str(matrix['raceAthletes'].shape[0]) + ' results')
+	athletes = matrix['raceAthletes'][:10]
+	features, isFound = getLastResults(matrix, athletes, np.zeros(10, dtype=np.int64), ['type'], 3, ['rank'])
+	print(features[isFound])
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
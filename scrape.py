@@ -2,8 +2,12 @@
 Functions responsible for general scraping of data in html format
 '''
 
-import urllib2
+import os
 import re
+import gzip
+
+import httpClient
+import instrumentation
 
 reTag = '<[^>]*>'
 reRestOfTag = '[^>]*>'
@@ -11,6 +15,15 @@ reUntilTag = '[^<]*'
 reNotAComment = '(?<!<!--)'
 reAllNotGreedy = '[\d\D]*?'
 
+# Each process gets its own client (see getClient), clientConfig: overrides of httpClient.defaultClientConfig
+client = None
+clientConfig = {}
+
+# Pages fetched with an archive name are kept as gzipped html, so everything derived from them can be rebuilt offline
+archive_directory = './data/pages/'
+isArchiving = True # Store a copy of every page fetched with an archive name
+isOffline = False # Read pages from the archive only, never from the web
+
 def reCapture(contents):
 	return '('+contents+')'
 
@@ -26,11 +39,56 @@ def reCaptureInList(list):
 		re += '|'+reGroup(item)
 	return reCapture(re)
 
-def getHtml(url):
-	# Returns the html at the given url
+def getClient():
+	# Returns this process' http client, connections opened by a parent process are never reused after a fork
+
+	global client
+	if client is None or client['pid'] != os.getpid():
+		client = httpClient.newClient(clientConfig)
+	return client
+
+def getArchiveName(name):
+	# Returns the file name of an archived page: races/race123 -> ./data/pages/races/race123.html.gz
 
-	response = urllib2.urlopen(url)
-	return response.read()
+	return archive_directory + name + '.html.gz'
+
+def archivePage(name, html):
+	# Stores a page in the archive, written to a temporary file and renamed so a partial page is never archived
+
+	fName = getArchiveName(name)
+	if not os.path.exists(os.path.dirname(fName)):
+		os.makedirs(os.path.dirname(fName), exist_ok=True)
+	with gzip.open(fName + '.tmp', 'wt', encoding='utf-8') as outFile:
+		outFile.write(html)
+	os.replace(fName + '.tmp', fName)
+
+def readArchivedPage(name):
+	# Returns the html of an archived page
+	# Raises IOError if the page isn't in the archive
+
+	fName = getArchiveName(name)
+	if not os.path.exists(fName):
+		raise IOError(name + ' is not in the archive')
+	with gzip.open(fName, 'rt', encoding='utf-8') as inFile:
+		return inFile.read()
+
+@instrumentation.timed('scrape.getHtml')
+def getHtml(url, conditional=False, archiveName=None):
+	# Returns the html at the given url
+	# conditional: revalidate the page if it was fetched before (see httpClient.get)
+	# archiveName: name the page is archived under (see archivePage), None -> the page isn't archived
+	#	while isOffline the page is read from the archive instead, pages without an archive name raise IOError
+
+	if isOffline:
+		if archiveName is None:
+			raise IOError(url + ' is not archived and pages are read offline')
+		return readArchivedPage(archiveName)
+	html = httpClient.get(getClient(), url, conditional)[0]
+	if isArchiving and archiveName is not None:
+		archivePage(archiveName, html)
+	instrumentation.increment('scrape.requests')
+	instrumentation.increment('scrape.bytes', len(html))
+	return html
 
 def extractText(html):
 	# Returns a string with the screen visible text from an html sample
@@ -0,0 +1,110 @@
+'''
+Functions responsible for sharing numpy matrices between processes without copying them
+The parent process copies a matrix into shared memory once,
+	then worker processes attach to it by name and get a read only view of the same memory
+'''
+
+import os
+import atexit
+import contextlib
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Segments created by this process which have not been released yet: {name: [SharedMemory, creatorPid]}
+createdSegments = {}
+# Segments this process has attached to: {name: SharedMemory}
+attachedSegments = {}
+
+def createSharedMatrix(matrix):
+	# Copies matrix into a new shared memory segment
+	# Returns a descriptor: [name, shape, dtype]
+	#	The descriptor is tiny, so it can be sent to other processes instead of the matrix itself
+	# The segment lives until releaseSharedMatrix is called or this process exits
+
+	matrix = np.ascontiguousarray(matrix)
+	segment = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+	shared = np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=segment.buf)
+	shared[...] = matrix
+	createdSegments[segment.name] = [segment, os.getpid()]
+	return [segment.name, matrix.shape, matrix.dtype.str]
+
+def attachSharedMatrix(descriptor):
+	# Expects a descriptor from createSharedMatrix
+	# Returns a read only numpy view of the shared matrix (no data is copied)
+
+	name, shape, dtype = descriptor
+	if name in createdSegments:
+		segment = createdSegments[name][0]
+	else:
+		if not name in attachedSegments:
+			attachedSegments[name] = shared_memory.SharedMemory(name=name)
+		segment = attachedSegments[name]
+	view = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+	view.flags.writeable = False
+	return view
+
+def closeSegment(segment):
+	# Unmaps a segment from this process
+	# Views of the segment which are still alive keep the memory mapped until they are garbage collected
+
+	try:
+		segment.close()
+	except BufferError:
+		pass
+
+def releaseSharedMatrix(descriptor):
+	# Frees a shared matrix created by this process
+	# Processes which are still attached keep their view until they detach
+
+	name = descriptor[0]
+	if name in createdSegments:
+		segment, creatorPid = createdSegments.pop(name)
+		closeSegment(segment)
+		if creatorPid == os.getpid():
+			segment.unlink()
+
+def detachAll():
+	# Unmaps every segment this process attached to
+
+	for name in list(attachedSegments.keys()):
+		closeSegment(attachedSegments.pop(name))
+
+def releaseAll():
+	# Frees every segment created by this process and detaches from all others
+	# Registered with atexit so that segments don't outlive the parent
+	# 	If the parent is killed, multiprocessing's resource tracker unlinks the leaked segments
+
+	for name in list(createdSegments.keys()):
+		segment, creatorPid = createdSegments.pop(name)
+		closeSegment(segment)
+		if creatorPid == os.getpid(): # Forked children inherit this dictionary but don't own the segments
+			segment.unlink()
+	detachAll()
+
+atexit.register(releaseAll)
+
+@contextlib.contextmanager
+def sharedMatrix(matrix):
+	# Context manager which shares matrix for the duration of a with block
+	# Yields the descriptor, the segment is released on exit even if an exception was raised
+	#	with sharedData.sharedMatrix(data) as descriptor:
+	#		pool = multiprocessing.Pool(nProcesses, initWorker, (descriptor,))
+
+	descriptor = createSharedMatrix(matrix)
+	try:
+		yield descriptor
+	finally:
+		releaseSharedMatrix(descriptor)
+
+def main():
+	# Test Module Functionality
+
+	data = np.random.rand(1000, 10)
+	with sharedMatrix(data) as descriptor:
+		view = attachSharedMatrix(descriptor)
+		print(descriptor)
+		print(np.array_equal(view, data))
+
+if __name__ == '__main__': # Call main() if this was run from the command line
+	main()
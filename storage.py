@@ -2,33 +2,280 @@
 Functions responsible for storing and recovering data
 '''
 
-import json
+import os
 import csv
+import gzip
+import json
+import lzma
+import zlib
+import struct
+
+import numpy as np
+
+import instrumentation
+
+# Binary training sets are .npy files with a fixed size header so that rows can be appended in place
+# The column names, scheme fingerprint, dtype and shape are kept in a small json file next to it
+npyHeaderSize = 128
+trainingSetChunkSize = 10000
+
+segmentSeparator = '#' # Separates a segment store from a record's key: './data/segments/races#race123.json'
+maxSegmentBytes = 64 * 2**20
+segmentIndexCache = {} # {store: [(index mtime, index size), index]}
+
+def countFile(direction, fName, nBytes=None):
+	# Counts a file 'Read', 'Written' or 'Mapped' and its size (or nBytes) while instrumentation is enabled
 
+	if instrumentation.enabled:
+		instrumentation.increment('storage.files' + direction)
+		instrumentation.increment('storage.bytes' + direction, os.path.getsize(fName) if nBytes is None else nBytes)
+
+def openFile(fName, mode):
+	# Opens a file, compressed with gzip (.gz) or lzma (.xz) if its name ends with that extension
+
+	if fName.endswith('.gz'):
+		return gzip.open(fName, mode, compresslevel=6)
+	if fName.endswith('.xz'):
+		return lzma.open(fName, mode)
+	return open(fName, mode)
+
+@instrumentation.timed('storage.storeAsJson')
 def storeAsJson(anObject, fName):
 	# Store object in json file
 	# Note: Dictionaries converted to javascript objects
 	# Datetime objects not supported
+	# fName: a file (compressed if it ends with .gz or .xz) or a record in a segment store: 'store#key' (see appendRecords)
 
-	with open(fName, 'wb') as outFile:
+	if segmentSeparator in fName:
+		store, key = fName.split(segmentSeparator, 1)
+		appendRecords(store, {key: anObject})
+		return
+	with openFile(fName, 'wt') as outFile:
 		json.dump(anObject, outFile)
+	countFile('Written', fName)
 
+@instrumentation.timed('storage.readFromJson')
 def readFromJson(fName):
 	# Reads object from .json file
+	# fName: a file (compressed if it ends with .gz or .xz) or a record in a segment store: 'store#key'
 
-	with open(fName, 'rb') as inFile:
+	if segmentSeparator in fName:
+		store, key = fName.split(segmentSeparator, 1)
+		return readRecord(store, key)
+	countFile('Read', fName)
+	with openFile(fName, 'rb') as inFile:
 		return json.load(inFile)
 
+# ______________________________________________________________________
+# Segment stores
+# Many small json objects packed into a few append-only segment files: store.000.seg, store.001.seg, ...
+# Each record is compressed on its own, so one can be read without decompressing the others
+# The index (store.idx.json) maps each key to the latest record stored under it:
+#	{'segments': [segment file names], 'records': {key: [segment number, offset, length]}}
+# Records are appended before the index is replaced, so a crash never leaves the index pointing at a partial record
+def getSegmentIndexName(store):
+	return store + '.idx.json'
+
+def getSegmentName(store, segmentNumber):
+	return store + '.' + '%03d' % segmentNumber + '.seg'
+
+def readSegmentIndex(store):
+	# Returns a segment store's index, cached until the index file changes
+
+	fName = getSegmentIndexName(store)
+	if not os.path.exists(fName):
+		return {'segments': [], 'records': {}}
+	status = os.stat(fName)
+	cached = segmentIndexCache.get(store)
+	if cached and cached[0] == (status.st_mtime_ns, status.st_size):
+		return cached[1]
+	with open(fName, 'rb') as inFile:
+		index = json.load(inFile)
+	segmentIndexCache[store] = [(status.st_mtime_ns, status.st_size), index]
+	return index
+
+def readRecord(store, key):
+	# Returns the object stored under key in a segment store
+	# Raises KeyError if there is none
+
+	segmentNumber, offset, length = readSegmentIndex(store)['records'][key]
+	with open(getSegmentName(store, segmentNumber), 'rb') as inFile:
+		inFile.seek(offset)
+		data = inFile.read(length)
+	countFile('Read', store, length)
+	return json.loads(zlib.decompress(data))
+
+def openSegment(store, index):
+	# Returns [segment number, file] for the last segment of a store opened for appending
+	# A new segment is started (and added to index) if the last one is larger than maxSegmentBytes or there is none
+
+	if not index['segments'] or os.path.getsize(getSegmentName(store, len(index['segments']) - 1)) > maxSegmentBytes:
+		index['segments'].append(os.path.basename(getSegmentName(store, len(index['segments']))))
+	segmentNumber = len(index['segments']) - 1
+	return [segmentNumber, open(getSegmentName(store, segmentNumber), 'ab')]
+
+def closeSegment(outFile):
+	# Makes sure what was appended to a segment is on disk before the index refers to it
+
+	outFile.flush()
+	os.fsync(outFile.fileno())
+	outFile.close()
+
+def appendRecords(store, objects):
+	# Appends json objects ({key: object}) to a segment store, replacing earlier records with the same keys
+	# Only one process should append to a store at a time
+
+	if os.path.dirname(store) and not os.path.exists(os.path.dirname(store)):
+		os.makedirs(os.path.dirname(store), exist_ok=True)
+	index = readSegmentIndex(store)
+	index = {'segments': list(index['segments']), 'records': dict(index['records'])}
+	nBytes = 0
+	segmentNumber, outFile = openSegment(store, index)
+	try:
+		for key in objects:
+			if outFile.tell() > maxSegmentBytes:
+				closeSegment(outFile)
+				segmentNumber, outFile = openSegment(store, index)
+			data = zlib.compress(json.dumps(objects[key]).encode('utf-8'), 6)
+			index['records'][key] = [segmentNumber, outFile.tell(), len(data)]
+			outFile.write(data)
+			nBytes += len(data)
+	finally:
+		closeSegment(outFile)
+	countFile('Written', store, nBytes)
+	fName = getSegmentIndexName(store)
+	with open(fName + '.tmp', 'w') as outFile:
+		json.dump(index, outFile)
+	os.replace(fName + '.tmp', fName)
+
+def getSegmentKeys(store):
+	# Returns the keys in a segment store
+
+	return list(readSegmentIndex(store)['records'].keys())
+
+def getStoreName(fName):
+	# Returns the segment store a record is in, or the directory of a file
+
+	if segmentSeparator in fName:
+		return fName.split(segmentSeparator, 1)[0]
+	return os.path.dirname(fName)
+
+def removeSegmentStore(store):
+	# Deletes a segment store's segments and index
+
+	for segment in readSegmentIndex(store)['segments']:
+		fName = os.path.join(os.path.dirname(store), segment)
+		if os.path.exists(fName):
+			os.remove(fName)
+	os.remove(getSegmentIndexName(store))
+	segmentIndexCache.pop(store, None)
+
+def packFiles(fNames, store):
+	# Appends json files to a segment store, each under its base name
+	# Returns {fName: address of its record ('store#key')}, the files themselves are left in place
+
+	objects = dict((os.path.basename(fName), readFromJson(fName)) for fName in fNames)
+	appendRecords(store, objects)
+	return dict((fName, store + segmentSeparator + os.path.basename(fName)) for fName in fNames)
+
 def store2DListAsCsv(a2DList, fName):
 	# Stores a 2D python list as a .csv file
 
-	with open(fName, 'wb') as outFile:
+	with open(fName, 'w', newline='') as outFile:
 		writer = csv.writer(outFile)
 		writer.writerows(a2DList)
+	countFile('Written', fName)
 
 def read2DListFromCsv(fName):
 	# Reads a 2d List from a .csv file
 
-	with open(fName, 'rb') as inFile:
+	countFile('Read', fName)
+	with open(fName, 'r', newline='') as inFile:
 		reader = csv.reader(inFile)
 		return [row for row in reader]
+
+def getTrainingSetHeaderName(fName):
+	# Returns the name of the json header stored alongside a binary training set
+
+	return fName + '.json'
+
+def writeNpyHeader(outFile, dtype, shape):
+	# Writes a version 1.0 .npy header padded to npyHeaderSize bytes
+	# The fixed size lets the row count be rewritten without moving the data
+
+	header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (dtype.str, shape[0], shape[1])
+	header = header.ljust(npyHeaderSize - 11) + '\n'
+	outFile.seek(0)
+	outFile.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+def storeTrainingSet(matrix, fName, columns=None, fingerprint=None, dtype=np.float64):
+	# Stores a 2D numpy matrix (or 2D list) as a binary training set (.npy)
+	# columns: list of column names, fingerprint: identifies the scheme which produced the data
+	# Returns the header: {'columns': [...], 'fingerprint': str, 'dtype': str, 'shape': [m, n]}
+
+	matrix = np.ascontiguousarray(matrix, dtype=dtype)
+	if matrix.size == 0 and matrix.ndim != 2:
+		matrix = matrix.reshape((0, len(columns or [])))
+	with open(fName, 'wb') as outFile:
+		writeNpyHeader(outFile, matrix.dtype, matrix.shape)
+		outFile.write(matrix.tobytes())
+	header = {'columns': columns, 'fingerprint': fingerprint, 'dtype': matrix.dtype.str, 'shape': list(matrix.shape)}
+	with open(getTrainingSetHeaderName(fName), 'w') as outFile:
+		json.dump(header, outFile)
+	countFile('Written', fName)
+	return header
+
+def appendToTrainingSet(rows, fName):
+	# Appends a chunk of rows (2D numpy matrix or 2D list) to a binary training set created by storeTrainingSet
+	# Rows are converted to the dtype of the training set
+	# Returns the updated header
+
+	header = readFromJson(getTrainingSetHeaderName(fName))
+	dtype = np.dtype(header['dtype'])
+	rows = np.ascontiguousarray(rows, dtype=dtype)
+	if rows.size == 0:
+		return header
+	if rows.ndim != 2 or rows.shape[1] != header['shape'][1]:
+		raise ValueError('Expected rows with ' + str(header['shape'][1]) + ' columns, got shape ' + str(rows.shape))
+	with open(fName, 'r+b') as outFile:
+		outFile.seek(0, 2)
+		outFile.write(rows.tobytes())
+		header['shape'][0] += rows.shape[0]
+		writeNpyHeader(outFile, dtype, header['shape'])
+	with open(getTrainingSetHeaderName(fName), 'w') as outFile:
+		json.dump(header, outFile)
+	countFile('Written', fName, rows.nbytes)
+	return header
+
+def readTrainingSet(fName, mmapMode='r'):
+	# Reads a binary training set
+	# mmapMode: passed to np.load, 'r' maps the file read only instead of reading it, None loads it into memory
+	# Returns [matrix, header]
+
+	header = readFromJson(getTrainingSetHeaderName(fName))
+	if header['shape'][0] == 0:
+		return [np.empty(header['shape'], dtype=np.dtype(header['dtype'])), header]
+	countFile('Mapped' if mmapMode else 'Read', fName)
+	return [np.load(fName, mmap_mode=mmapMode), header]
+
+def convertCsvToTrainingSet(csvFName, fName, columns=None, fingerprint=None, dtype=np.float64):
+	# Converts a .csv training set (see store2DListAsCsv) to a binary training set
+	# The csv is streamed in chunks, so it is never held in memory as a list of strings
+	# Returns the header
+
+	with open(csvFName, 'r', newline='') as inFile:
+		reader = csv.reader(inFile)
+		chunk = []
+		header = None
+		for row in reader:
+			if not row:
+				continue
+			chunk.append(row)
+			if header is None:
+				header = storeTrainingSet(np.empty((0, len(row))), fName, columns, fingerprint, dtype)
+			if len(chunk) == trainingSetChunkSize:
+				header = appendToTrainingSet(chunk, fName)
+				chunk = []
+		if header is None:
+			return storeTrainingSet(np.empty((0, len(columns or []))), fName, columns, fingerprint, dtype)
+		return appendToTrainingSet(chunk, fName)
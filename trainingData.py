@@ -3,11 +3,40 @@ Functions responsible for creating training matrices for machine learning
 A key idea is passing functions as arguments to other functions to optimize flexibility
 '''
 
+import inspect
+import hashlib
+
 import numpy as np
 
 import storage
 import dataPreparation
 import fisData
+import ratings
+import resultsMatrix
+import instrumentation
+
+# Race results are read from disk once and then kept in memory: {fName: results}
+resultsCache = {}
+
+def readResults(fName):
+	# Returns the results dictionary stored in fName, reading it only the first time
+
+	if not fName in resultsCache:
+		instrumentation.increment('trainingData.resultsCacheMisses')
+		resultsCache[fName] = storage.readFromJson(fName)
+	elif instrumentation.enabled: # Checked here since this runs for every race looked back on
+		instrumentation.increment('trainingData.resultsCacheHits')
+	return resultsCache[fName]
+
+def clearResultsCache():
+	# Forgets every cached race, so updated race files are read again
+
+	resultsCache.clear()
+
+def readResultsMatrix():
+	# Returns a results matrix of every stored race (see resultsMatrix.newResultsMatrix), read through the cache
+
+	return resultsMatrix.newResultsMatrix(storage.readFromJson(dataPreparation.racesIndex_fName), readResults)
 
 # _____________________________________________________________________
 # Arguments for collect f_isValidRace
@@ -66,6 +95,22 @@ def getFuncIsTop(x):
 
 	return isTop
 
+# ______________________________________________________________________
+# Arguments for collectFromMatrix f_selectResponses
+# Expect a results matrix and the positions of results in it (by race), return a column of responses (NaN if missing)
+def getPercentBacks(matrix, entries):
+	# Returns the % back of each result
+
+	return matrix['racePercentBack'][entries][:,None]
+
+def getRankCategories(matrix, entries):
+	# Categorizes the rank of each result like getRankCategory
+
+	ranks = matrix['raceRank'][entries]
+	categories = np.searchsorted([3, 8, 15, 30], ranks, side='left').astype(np.float64)
+	categories[np.isnan(ranks)] = np.nan
+	return categories[:,None]
+
 # ______________________________________________________________________
 # Arguments for getFuncGetFeatures f_selectFromRaceInfo
 def getFuncGetAverageBestFisPoints(fisPointIndices):
@@ -113,7 +158,7 @@ def getFuncGetFeatures(f_selectFromRaceInfo, f_selectFromResult):
 	def getFeature(raceInfo, fisNumber):
 		# Builds feature(s) from this training example
 
-		results = storage.readFromJson(raceInfo[1])
+		results = readResults(raceInfo[1])
 		if fisNumber in results:
 			features = []
 			if f_selectFromRaceInfo:
@@ -186,9 +231,98 @@ def getNextFeatures(racesIndex, currentRI, beginRI, fisNumber, f_isSimilarRace,
 				return i, None
 	return len(racesIndex) - 1, None
 
+def getFuncGetLookBackFeatures(fList_prevRaceCriteria, prevRaceCounts, f_selectFeatures, fList_sdCriteria):
+	# Returns a function to build the look back features of an athlete before a race
+
+	def getLookBackFeatures(racesIndex, currentRI, fisNumber):
+		# Returns the features from the races before racesIndex[currentRI] for this athlete
+		# Returns None if the athlete doesn't have enough previous races
+
+		features = []
+		for i in range(0, len(fList_prevRaceCriteria)):
+			categoryFeatures = np.array([])
+			beginRI = currentRI + 1
+			while True:
+				while categoryFeatures.shape[0] < prevRaceCounts[i]:
+					endRI, raceFeatures = getNextFeatures(racesIndex, currentRI, beginRI, \
+						fisNumber, fList_prevRaceCriteria[i], f_selectFeatures)
+					if not raceFeatures:
+						return None
+					beginRI = endRI + 1
+					if categoryFeatures.shape[0] == 0:
+						categoryFeatures = np.array([raceFeatures])
+					else:
+						categoryFeatures = np.concatenate((categoryFeatures, [raceFeatures]), axis=0)
+
+				# Get the standard deviation and mean of each column
+				mu = np.mean(categoryFeatures, axis=0)
+				# Build a 1D vector of maximum standard deviations
+				maxSDs = np.array([])
+				for i in range(0, len(fList_sdCriteria)):
+					mSD = None
+					if fList_sdCriteria[i] is None:
+						mSD = np.inf
+					else:
+						mSD = fList_sdCriteria[i](mu[i])
+					maxSDs = np.concatenate((maxSDs, [mSD]))
+
+				std = np.std(categoryFeatures, axis=0)
+				fail = std > maxSDs # represents which columns have a std greater than whats tolerated
+				
+				if np.any(fail):
+					test = np.absolute(categoryFeatures - mu)
+					test = test[:,np.where(fail)[0]]
+					locations = np.argmax(test, axis=0)
+					nRaces = categoryFeatures.shape[0]
+					categoryFeatures = np.delete(categoryFeatures, locations, axis=0)
+					instrumentation.increment('trainingData.outliersRemoved', nRaces - categoryFeatures.shape[0])
+				else:
+					# All of the standard deviations are less then the maximum amount
+					break
+
+			categoryFeatures = categoryFeatures.flatten().tolist()
+			features += categoryFeatures
+
+		return features
+
+	return getLookBackFeatures
+
+def getFuncGetLookBackFromRows(f_getLookBackFeatures):
+	# Returns a function which builds look-back features from a results matrix like resultsMatrix.getFuncGetLookBack,
+	#	from f_getLookBackFeatures which builds one athlete's features (see getFuncGetLookBackFeatures)
+	# For features which can't be built with array operations (outliers removed, ratings), each row is built in turn
+
+	def getLookBack(matrix, athletes, races, raceInfo=None):
+		# Returns [features, isFound] (see resultsMatrix.getLastResults)
+
+		racesIndexes = {} # {position: racesIndex with the upcoming race inserted at position}
+		rows = []
+		for athlete, position in zip(athletes, races):
+			racesIndex = matrix['racesIndex']
+			if raceInfo is not None:
+				if not position in racesIndexes:
+					racesIndexes[position] = racesIndex[:position] + [raceInfo] + racesIndex[position:]
+				racesIndex = racesIndexes[position]
+			rows.append(f_getLookBackFeatures(racesIndex, int(position), matrix['fisCodes'][athlete]))
+		isFound = np.array([row is not None for row in rows], dtype=bool)
+		width = len(rows[np.argmax(isFound)]) if np.any(isFound) else 0
+		features = np.full((len(rows), width), np.nan)
+		for i in np.nonzero(isFound)[0]:
+			features[i,:] = rows[i]
+		return [features, isFound]
+
+	return getLookBack
+
 def getFuncProcessResult(f_isValidResult, fList_prevRaceCriteria, prevRaceCounts, f_selectFeatures, fList_sdCriteria, f_selectResponce):
 	# Returns a function to process the result
 
+	getLookBackFeatures = getFuncGetLookBackFeatures(fList_prevRaceCriteria, prevRaceCounts, f_selectFeatures, fList_sdCriteria)
+	return getFuncProcessResultFromLookBack(f_isValidResult, getLookBackFeatures, f_selectResponce)
+
+def getFuncProcessResultFromLookBack(f_isValidResult, f_getLookBackFeatures, f_selectResponce):
+	# Returns a function to process the result
+	# f_getLookBackFeatures: builds the features (see getFuncGetLookBackFeatures)
+
 	def processResult(result, racesIndex, currentRI, fisNumber):
 		# Returns a training row from a result
 		# Returns None if this result doesn't meet the criteria
@@ -197,82 +331,111 @@ def getFuncProcessResult(f_isValidResult, fList_prevRaceCriteria, prevRaceCounts
 			# Check that this result has a valid response
 			y = f_selectResponce(result)
 			if y is None:
+				instrumentation.increment('trainingData.rowsRejected', 1, {'reason': 'noResponse'})
 				return None
 
-			# Begin building the features
-			features = []
-			for i in range(0, len(fList_prevRaceCriteria)):
-				categoryFeatures = np.array([])
-				beginRI = currentRI + 1
-				while True:
-					while categoryFeatures.shape[0] < prevRaceCounts[i]:
-						endRI, raceFeatures = getNextFeatures(racesIndex, currentRI, beginRI, \
-							fisNumber, fList_prevRaceCriteria[i], f_selectFeatures)
-						if not raceFeatures:
-							return None
-						beginRI = endRI + 1
-						if categoryFeatures.shape[0] == 0:
-							categoryFeatures = np.array([raceFeatures])
-						else:
-							categoryFeatures = np.concatenate((categoryFeatures, [raceFeatures]), axis=0)
-
-					# Get the standard deviation and mean of each column
-					mu = np.mean(categoryFeatures, axis=0)
-					# Build a 1D vector of maximum standard deviations
-					maxSDs = np.array([])
-					for i in range(0, len(fList_sdCriteria)):
-						mSD = None
-						if fList_sdCriteria[i] is None:
-							mSD = np.inf
-						else:
-							mSD = fList_sdCriteria[i](mu[i])
-						maxSDs = np.concatenate((maxSDs, [mSD]))
-
-					std = np.std(categoryFeatures, axis=0)
-					fail = std > maxSDs # represents which columns have a std greater than whats tolerated
-					
-					if np.any(fail):
-						test = np.absolute(categoryFeatures - mu)
-						test = test[:,np.where(fail)[0]]
-						locations = np.argmax(test, axis=0)
-						categoryFeatures = np.delete(categoryFeatures, locations, axis=0)
-					else:
-						# All of the standard deviations are less then the maximum amount
-						break
-
-				categoryFeatures = categoryFeatures.flatten().tolist()
-				features += categoryFeatures
+			# Build the features
+			features = f_getLookBackFeatures(racesIndex, currentRI, fisNumber)
+			if features is None:
+				instrumentation.increment('trainingData.rowsRejected', 1, {'reason': 'noFeatures'})
+				return None
 
 			# Return training row
 			return features + y
 		else:
+			instrumentation.increment('trainingData.rowsRejected', 1, {'reason': 'invalidResult'})
 			return None
 
 	return processResult
 
-def collect(f_isValidRace, f_processResult):
+@instrumentation.timed('trainingData.collect')
+def collect(f_isValidRace, f_processResult, withDates=False, raceIds=None):
 	# Build training matrices for machine learning
 	# f_isValidRace: function which determines which races to consider
+	# withDates: if True, returns [dataMatrix, dates] where dates[i] is the date (as int) of the race behind dataMatrix[i]
+	# raceIds: if given, only rows for these races are built (for example the races just added by updateNewRaces)
 
 	limit = None
 	dataMatrix = []
+	dates = []
 	racesIndex = storage.readFromJson(dataPreparation.racesIndex_fName)
+	if raceIds is not None:
+		raceIds = set(raceIds)
 
 	# Loop through each race
 	for i in range(0, len(racesIndex)):
-		if f_isValidRace(racesIndex[i]):
-			currentResults = storage.readFromJson(racesIndex[i][1])
+		if (raceIds is None or racesIndex[i][0] in raceIds) and f_isValidRace(racesIndex[i]):
+			currentResults = readResults(racesIndex[i][1])
 			# Loop through the result of each athlete in the race
 			for fisNumber in currentResults:
 				dataRow = f_processResult(currentResults[fisNumber], racesIndex, i, fisNumber)
 				if dataRow:
+					instrumentation.increment('trainingData.rowsEmitted')
 					dataMatrix.append(dataRow)
+					dates.append(racesIndex[i][3])
 					if limit:
 						limit -= 1
 						if limit == 0:
-							return dataMatrix
+							break
+			if limit == 0:
+				break
+	if withDates:
+		return [dataMatrix, dates]
+	return dataMatrix
+
+@instrumentation.timed('trainingData.collectFromMatrix')
+def collectFromMatrix(f_isValidRace, f_getLookBack, f_selectResponses, withDates=False, raceIds=None):
+	# Builds the same training matrices as collect, for every result at once from a results matrix
+	# f_getLookBack: builds look-back features for many results (see resultsMatrix.getFuncGetLookBack)
+	# f_selectResponses: builds the response of many results, NaN where there is none (see getPercentBacks)
+
+	matrix = readResultsMatrix()
+	racesIndex = matrix['racesIndex']
+	if raceIds is not None:
+		raceIds = set(raceIds)
+	isValidRace = np.array([(raceIds is None or raceInfo[0] in raceIds) and bool(f_isValidRace(raceInfo)) \
+		for raceInfo in racesIndex], dtype=bool)
+
+	# Every result in a valid race, in the order collect visits them
+	entryRaces = np.repeat(np.arange(0, len(racesIndex)), np.diff(matrix['raceStart']))
+	entries = np.nonzero(isValidRace[entryRaces])[0]
+	races = entryRaces[entries]
+	y = f_selectResponses(matrix, entries)
+	hasResponse = ~np.any(np.isnan(y), axis=1)
+	X, isFound = f_getLookBack(matrix, matrix['raceAthletes'][entries], races)
+	isKept = hasResponse & isFound
+	instrumentation.increment('trainingData.rowsRejected', int(np.sum(~hasResponse)), {'reason': 'noResponse'})
+	instrumentation.increment('trainingData.rowsRejected', int(np.sum(hasResponse & ~isFound)), {'reason': 'noFeatures'})
+	instrumentation.increment('trainingData.rowsEmitted', int(np.sum(isKept)))
+
+	dataMatrix = np.concatenate((X[isKept], y[isKept]), axis=1).tolist()
+	if withDates:
+		dates = np.array([raceInfo[3] for raceInfo in racesIndex], dtype=np.int64)
+		return [dataMatrix, dates[races[isKept]].tolist()]
 	return dataMatrix
 
+def getSchemeFingerprint(f_scheme):
+	# Expects one of the prebuilt schemes below (for example collectDistanceRankCategory)
+	# 	or the function which builds its features (for example getFuncGetDistanceRankCategoryFeatures)
+	# Returns a short hash of the scheme's name and source code,
+	#	including the source of the functions in this module it calls directly
+	# Schemes build their features with the same getFuncGet...Features function prediction uses,
+	#	so a change to the features changes the fingerprint of the scheme and of models trained on it
+	# Stored with training sets and models so data built by an older version of a scheme can be detected
+
+	source = f_scheme.__name__ + inspect.getsource(f_scheme)
+	for name in sorted(set(f_scheme.__code__.co_names)):
+		f = globals().get(name)
+		if inspect.isfunction(f) and f is not f_scheme:
+			source += inspect.getsource(f)
+	return hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+
+def storeScheme(f_scheme, fName):
+	# Collects the training set for a prebuilt scheme and stores it as a binary training set
+	# Returns the training set header (see storage.storeTrainingSet)
+
+	return storage.storeTrainingSet(f_scheme(), fName, None, getSchemeFingerprint(f_scheme))
+
 # ______________________________________________________________________
 # Prebuilt schemes to collect data
 def collect0():
@@ -292,54 +455,95 @@ def collect1():
 		[2, 2], getFuncSelect(getRank), [lambda mu: 12+.1*mu], getFuncIsTop(10))
 	return collect(isDistanceRace, processResult)
 
-def collectIndividualPercentBack():
-	# y: % behind winner
+def getFuncGetIndividualPercentBackFeatures():
 	# X: % back in last 5 races each in individual races and individual races of this technique
 
-	selectFeatures = getFuncGetFeatures(None, getPercentBack)
-	processResult = getFuncProcessResult(lambda result: True, [isSameType, isSameTypeAndTechnique], \
-		[5, 5], selectFeatures, [None], getPercentBack)
-	return collect(isIndividualRace, processResult)
+	return resultsMatrix.getFuncGetLookBack([['type'], ['type', 'technique']], [5, 5], ['percentBack'])
 
-def collectIndividualPercentBackWithFisPoints():
+def collectIndividualPercentBack(withDates=False, raceIds=None):
 	# y: % behind winner
+	# X: see getFuncGetIndividualPercentBackFeatures
+
+	return collectFromMatrix(isIndividualRace, getFuncGetIndividualPercentBackFeatures(), getPercentBacks, withDates, \
+		raceIds)
+
+def getFuncGetIndividualPercentBackWithFisPointsFeatures():
 	# X: % back and average of the top 15 Fis points in last 5 races each 
 	#	in individual races 
 	#	and individual races of same technique
 
-	selectFeatures = getFuncGetFeatures(getFuncGetAverageBestFisPoints([2]), getPercentBack)
-	processResult = getFuncProcessResult(lambda result: True, [isSameType, isSameTypeAndTechnique], \
-		[5, 5], selectFeatures, [None], getPercentBack)
-	return collect(isIndividualRace, processResult)
+	return resultsMatrix.getFuncGetLookBack([['type'], ['type', 'technique']], [5, 5], ['fisPoints15', 'percentBack'])
 
-def collectIndividualPercentBackWithFisPointsWithoutOutliers():
+def collectIndividualPercentBackWithFisPoints(withDates=False, raceIds=None):
 	# y: % behind winner
+	# X: see getFuncGetIndividualPercentBackWithFisPointsFeatures
+
+	return collectFromMatrix(isIndividualRace, getFuncGetIndividualPercentBackWithFisPointsFeatures(), getPercentBacks, \
+		withDates, raceIds)
+
+def getFuncGetIndividualPercentBackWithFisPointsWithoutOutliersFeatures():
 	# X: % back and average of the top 15 Fis points in last 5 races each 
 	#	in individual races 
 	#	and individual races of same technique
 	# Avoids outliers
 
 	selectFeatures = getFuncGetFeatures(getFuncGetAverageBestFisPoints([2]), getPercentBack)
-	processResult = getFuncProcessResult(lambda result: True, [isSameType, isSameTypeAndTechnique], \
-		[5, 5], selectFeatures, [getFuncLinearSdCriteria(5, 0), getFuncLinearSdCriteria(.05, .5)], \
-		getPercentBack)
-	return collect(isIndividualRace, processResult)
+	return getFuncGetLookBackFeatures([isSameType, isSameTypeAndTechnique], [5, 5], selectFeatures, \
+		[getFuncLinearSdCriteria(5, 0), getFuncLinearSdCriteria(.05, .5)])
+
+def collectIndividualPercentBackWithFisPointsWithoutOutliers(withDates=False, raceIds=None):
+	# y: % behind winner
+	# X: see getFuncGetIndividualPercentBackWithFisPointsWithoutOutliersFeatures
+
+	processResult = getFuncProcessResultFromLookBack(lambda result: True, \
+		getFuncGetIndividualPercentBackWithFisPointsWithoutOutliersFeatures(), getPercentBack)
+	return collect(isIndividualRace, processResult, withDates, raceIds)
 
-def collectAllRankCategory():
+def getFuncGetAllRankCategoryFeatures():
+	# X: rank in last race for discipline, type, technique, and typeAndTechnique
+
+	return resultsMatrix.getFuncGetLookBack([['discipline'], ['type'], ['technique'], ['type', 'technique']], \
+		[1]*4, ['rank'])
+
+def collectAllRankCategory(withDates=False, raceIds=None):
 	# y: rank
-	# X: rank in last 5 races for discipline, type, technique, and typeAndTechnique
+	# X: see getFuncGetAllRankCategoryFeatures
+
+	return collectFromMatrix(lambda raceInfo: True, getFuncGetAllRankCategoryFeatures(), getRankCategories, withDates, \
+		raceIds)
+
+def getFuncGetDistanceRankCategoryFeatures():
+	# X: rank in last 2 races for discipline, type and technique, and last 5 races for typeAndTechnique
 
-	selectFeatures = getFuncGetFeatures(None, getRank)
-	processResult = getFuncProcessResult(lambda result: True, [isSameDiscipline, isSameType, isSameTechnique, isSameTypeAndTechnique], \
-		[1]*4, selectFeatures, [None], getRankCategory)
-	return collect(lambda raceInfo: True, processResult)
+	return resultsMatrix.getFuncGetLookBack([['discipline'], ['type'], ['technique'], ['type', 'technique']], \
+		[2, 2, 2, 5], ['rank'])
 
-def collectDistanceRankCategory():
+def collectDistanceRankCategory(withDates=False, raceIds=None):
 	# y: rank
-	# X: rank in last 5 races for discipline, type, technique, and typeAndTechnique
+	# X: see getFuncGetDistanceRankCategoryFeatures
 	# *Only considering distance races
 
-	selectFeatures = getFuncGetFeatures(None, getRank)
-	processResult = getFuncProcessResult(lambda result: True, [isSameDiscipline, isSameType, isSameTechnique, isSameTypeAndTechnique], \
-		[2, 2, 2, 5], selectFeatures, [None], getRankCategory)
-	return collect(isDistanceRace, processResult)
+	return collectFromMatrix(isDistanceRace, getFuncGetDistanceRankCategoryFeatures(), getRankCategories, withDates, \
+		raceIds)
+
+def getFuncGetRatingFeatures(athleteRatings=None):
+	# X: ratings going into the race (see ratings.getRatingFeatures), a lookup instead of a look-back scan
+	# athleteRatings: ratings from ratings.updateRatings, None -> the stored ratings
+
+	if athleteRatings is None:
+		athleteRatings = ratings.readRatings()
+
+	def getRatingFeatures(racesIndex, currentRI, fisNumber):
+		# Returns the rating features of athlete fisNumber going into the race at currentRI
+
+		return ratings.getPreRaceFeatures(athleteRatings, racesIndex[currentRI], fisNumber)
+
+	return getRatingFeatures
+
+def collectDistanceRatingCategory(withDates=False, raceIds=None):
+	# y: rank
+	# X: see getFuncGetRatingFeatures
+	# *Only considering distance races, run ratings.updateStoredRatings after new races are added
+
+	processResult = getFuncProcessResultFromLookBack(lambda result: True, getFuncGetRatingFeatures(), getRankCategory)
+	return collect(isDistanceRace, processResult, withDates, raceIds)